@@ -1,15 +1,21 @@
 #!/usr/bin/env python
+import asyncio
 import json
 import logging
+import math
 from optparse import OptionParser
 
 from kvoption import KVOption
 from genericpath import isfile
 from os import listdir
 import re
-from time import sleep
+import threading
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
+from time import sleep, time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 from google.cloud import storage
@@ -17,11 +23,24 @@ from google.cloud.bigquery.client import Client
 
 from loader import DelegatingFileSuffixLoader, \
     BqQueryTemplatingFileLoader, BqDataFileLoader, \
-    TableType
-from resource import BqJobs
+    TableType, renderFiles
+from resource import BqJobs, JobTracker, tables
+from date_formatter_helper import helpers
+from dateutil.relativedelta import relativedelta
+from dependency_index import DependencyIndex
+from graph_cache import GraphCache, INPUT_SUFFIXES, linkHash
+from file_watcher import openFileWatcher
+import parse_cache
+from job_watcher import AdaptiveInterval, JobWatcher, queryProgress, \
+    refreshTracker, waitForJob
+from state_store import openStateStore
+from planner import Plan, datasetOf, parseBytes
+from retry_policy import PERMANENT, RetryPolicy, classifyError
+from scheduling import SCHEDULES, CRITICAL_PATH, FIFO, PrioritySlots, \
+    RunHistory, criticalPath, criticalPaths, parsePools
 from google.cloud import bigquery
 
-from google.api_core.exceptions import PreconditionFailed
+from google.api_core.exceptions import GoogleAPICallError, PreconditionFailed
 
 
 def find_cycles(dependencies: dict):
@@ -55,45 +74,451 @@ class DependencyBuilder:
     Dependency builder loads resources from the folders specified.
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, graphCache: GraphCache = None,
+                 loadWorkers: int = 1):
+        """
+        :param loader: loads the resources of each file
+        :param graphCache: used by buildGraph
+        :param loadWorkers: when more than 1, the number of processes
+        rendering templates ahead of loading
+        """
         self.loader = loader
+        self.graphCache = graphCache
+        self.loadWorkers = loadWorkers
+        # the keys loaded from each file by buildDepend and update
+        self.keysByFile = {}
+        # what each resource was defined as, see update
+        self.fingerprints = {}
 
-    def buildDepend(self, folders, dryrun) -> tuple:
-        """ folders arg is an array of strings which should point
-        at folders containing resource descriptions loadable by
-        self.loader """
-        resources = {}
+    def listFiles(self, folders) -> list:
+        """ files of folders which self.loader handles """
+        files = []
         for folder in folders:
             folder = re.sub("/$", "", folder)
             for name in listdir(folder):
                 file = "/".join([folder, name])
                 if isfile(file) and self.loader.handles(file):
-                    for rsrc in self.loader.load(file, dryrun):
-                        resources[rsrc.key()] = rsrc
+                    files.append(file)
+        return files
 
-        resourceDependencies = {rsrc.key(): set() for rsrc in resources.values()}
+    def loadFiles(self, files, dryrun):
+        """ yields the resources loaded from each of files, in order """
+        rendered = [None] * len(files)
+        if self.loadWorkers > 1:
+            rendered = renderFiles(self.loader, files, self.loadWorkers)
+        for (file, r) in zip(files, rendered):
+            if r is None:
+                yield (file, self.loader.load(file, dryrun))
+            else:
+                yield (file, self.loader.load(file, dryrun, r))
 
-        for rsrc in resources.values():
-            for osrc in resources.values():
-                if rsrc.dependsOn(osrc):
-                    resourceDependencies[rsrc.key()].add(osrc.key())
+    def buildDepend(self, folders, dryrun) -> tuple:
+        """ folders arg is an array of strings which should point
+        at folders containing resource descriptions loadable by
+        self.loader """
+        resources = {}
+        for (file, loaded) in self.loadFiles(self.listFiles(folders), dryrun):
+            self.keysByFile[file] = [rsrc.key() for rsrc in loaded]
+            for rsrc in loaded:
+                resources[rsrc.key()] = rsrc
 
-        copy = {key: set([x for x in resourceDependencies[key]]) for key in resourceDependencies}
-        cycles = find_cycles(copy)
-        if cycles:
-            raise Exception("There are cycles in your templates.  Please make sure "
-                            "your recent changes have not introduced any cycles")
+        index = DependencyIndex(resources.values())
+        resourceDependencies = {rsrc.key(): index.dependencies(rsrc)
+                                for rsrc in resources.values()}
 
+        checkCycles(resourceDependencies)
         return (resources, resourceDependencies)
 
+    def affectedFiles(self, paths) -> set:
+        """ the files to load again once paths have changed.  A changed
+        side file, i.e. .vars or .schema, affects its template and a
+        changed local.vars every file of its folder """
+        files = set()
+        for path in paths:
+            (folder, _, name) = path.rpartition("/")
+            if name == "local.vars":
+                files.update([file for file in self.keysByFile
+                              if file.rpartition("/")[0] == folder])
+                continue
+            for suffix in INPUT_SUFFIXES:
+                if suffix and path.endswith(suffix):
+                    path = path[:-len(suffix)]
+                    break
+            if path in self.keysByFile \
+                    or (isfile(path) and self.loader.handles(path)):
+                files.add(path)
+        return files
+
+    def dateRelativeFiles(self) -> set:
+        """ the loaded files whose vars, or local.vars, mention date keys
+        so that they expand differently as time passes """
+        found = set()
+        for file in self.keysByFile:
+            paths = [file + suffix for suffix in INPUT_SUFFIXES if suffix] + \
+                ["/".join([file.rpartition("/")[0], "local.vars"])]
+            for path in paths:
+                try:
+                    if "yyyy" in parse_cache.files.read(path):
+                        found.add(file)
+                        break
+                except FileNotFoundError:
+                    continue
+        return found
+
+    def fingerprint(self, rsrc):
+        return (type(rsrc).__name__, rsrc.dump(), rsrc.definitionHash())
+
+    def update(self, files, resources: dict, dependencies: dict,
+               dryrun) -> set:
+        """ loads files, which were added, changed or removed, again into
+        the resources and dependencies buildDepend returned.  Only the
+        reloaded resources are linked again unless keys were added, which
+        any resource may refer to.  Nothing changes if loading fails.
+
+        :return: keys of the resources which are new or defined
+        differently, compared with self.fingerprints
+        """
+        present = sorted([file for file in files if isfile(file)])
+        loadedByFile = {file: list(loaded)
+                        for (file, loaded) in self.loadFiles(present, dryrun)}
+        loaded = {}
+        for rsrcs in loadedByFile.values():
+            for rsrc in rsrcs:
+                loaded[rsrc.key()] = rsrc
+
+        keysByFile = {file: keys for (file, keys) in self.keysByFile.items()
+                      if file not in files}
+        keysByFile.update({file: [rsrc.key() for rsrc in rsrcs]
+                           for (file, rsrcs) in loadedByFile.items()})
+        kept = set([key for keys in keysByFile.values() for key in keys])
+        removed = set(resources.keys()) - kept
+        added = set(loaded.keys()) - set(resources.keys())
+
+        newResources = {key: rsrc for (key, rsrc) in resources.items()
+                        if key not in removed}
+        for (key, rsrc) in loaded.items():
+            prev = resources.get(key)
+            if prev and prev.currentJob() and prev.isRunning():
+                # the job we were waiting for still creates it
+                rsrc.attachJob(prev.currentJob())
+            elif rsrc.currentJob() and not rsrc.isRunning():
+                # a job which ended, i.e. failed before the file was fixed,
+                # or the loader found at startup, is no longer waited for
+                rsrc.attachJob(None)
+            newResources[key] = rsrc
+
+        index = DependencyIndex(newResources.values())
+        relink = set(loaded.keys()) | set(
+            [key for (key, spec) in index.specs.items() if spec is None])
+        if added or any([index.specs[key] and index.specs[key].extractUris
+                         is not None for key in loaded]):
+            relink = set(newResources.keys())
+        newDependencies = {key: deps - removed
+                           for (key, deps) in dependencies.items()
+                           if key not in removed}
+        for key in relink:
+            newDependencies[key] = index.dependencies(newResources[key])
+        checkCycles(newDependencies)
+
+        changed = set()
+        for (key, rsrc) in loaded.items():
+            fingerprint = self.fingerprint(rsrc)
+            if self.fingerprints.get(key) != fingerprint:
+                changed.add(key)
+            self.fingerprints[key] = fingerprint
+        for key in removed:
+            self.fingerprints.pop(key, None)
+
+        self.keysByFile = keysByFile
+        resources.clear()
+        resources.update(newResources)
+        dependencies.clear()
+        dependencies.update(newDependencies)
+        return changed
+
+    def buildGraph(self, folders, dryrun) -> dict:
+        """ same dependencies as buildDepend but only files whose inputs
+        changed since the last run are loaded, and only their resources
+        are linked again unless the rest of the graph has changed.  No
+        resources are returned so this is good for show and dotml """
+        cache = self.graphCache
+        cache.load()
+        files = self.listFiles(folders)
+        specsByFile = {}
+        inputHashes = {}
+        for file in files:
+            inputHashes[file] = cache.inputHash(file)
+            specs = cache.get(file, inputHashes[file])
+            if specs is not None:
+                specsByFile[file] = specs
+
+        changed = [file for file in files if file not in specsByFile]
+        for (file, loaded) in self.loadFiles(changed, dryrun):
+            specs = [rsrc.linkSpec() for rsrc in loaded]
+            if None in specs:
+                # some resource can only be linked with dependsOn
+                return self.buildDepend(folders, dryrun)[1]
+            cache.put(file, inputHashes[file], specs)
+            specsByFile[file] = specs
+        cache.retain(files)
+
+        specs = {}
+        for file in files:
+            for spec in specsByFile[file]:
+                specs[spec.key] = spec
+        graphHash = linkHash(specs.values())
+
+        index = None
+        resourceDependencies = {}
+        for file in files:
+            edges = cache.getEdges(file, graphHash)
+            if edges is None:
+                if not index:
+                    index = DependencyIndex(specs=specs.values())
+                edges = {spec.key: index.resolve(spec)
+                         for spec in specsByFile[file]}
+                cache.putEdges(file, graphHash, edges)
+            for spec in specsByFile[file]:
+                if specs[spec.key] is spec:
+                    resourceDependencies[spec.key] = edges[spec.key]
+        cache.save()
+
+        checkCycles(resourceDependencies)
+        return resourceDependencies
+
+
+def dependantsOf(dependencies: dict, keys) -> set:
+    """ keys and every key which depends on any of them, directly or
+    not """
+    dependants = defaultdict(set)
+    for (key, deps) in dependencies.items():
+        for dep in deps:
+            dependants[dep].add(key)
+    found = set()
+    todo = [key for key in keys if key in dependencies]
+    while todo:
+        key = todo.pop()
+        if key in found:
+            continue
+        found.add(key)
+        todo.extend(dependants[key])
+    return found
+
+
+# the units --refreshEvery accepts
+REFRESH_UNITS = ["hour", "day", "month"]
+
+
+@contextmanager
+def readOnly(resources):
+    """ resources only read their metadata, they don't write descriptions
+    or expirations into it, until the block is left """
+    saved = [(rsrc, rsrc.describesDefinition, rsrc.updatesExpiration)
+             for rsrc in resources]
+    for (rsrc, _, _) in saved:
+        rsrc.describesDefinition = False
+        rsrc.updatesExpiration = False
+    try:
+        yield
+    finally:
+        for (rsrc, describes, expires) in saved:
+            rsrc.describesDefinition = describes
+            rsrc.updatesExpiration = expires
+
+
+def nextRefresh(now: datetime, unit: str) -> datetime:
+    """ the start of the hour, day or month after now """
+    start = now.replace(minute=0, second=0, microsecond=0)
+    if unit == "hour":
+        return start + timedelta(hours=1)
+    start = start.replace(hour=0)
+    if unit == "day":
+        return start + timedelta(days=1)
+    return start.replace(day=1) + relativedelta(months=1)
+
+
+def watch(builder: DependencyBuilder, fileWatcher, resources: dict,
+          dependencies: dict, execute, dryrun=False, interval=60,
+          rounds=None, refreshEvery=None, allDateRelative=False,
+          clock=datetime.now, prefetch=None):
+    """ keeps resources and dependencies up to date with the files
+    fileWatcher reports changed, and executes the changed resources and
+    their dependants with execute(subgraph).
+
+    :param fileWatcher: None to only refresh
+    :param interval: seconds to wait for a change before looking again
+    :param rounds: stop after this many changes, forever if None
+    :param refreshEvery: hour, day or month.  At the start of each, the
+    date relative files are expanded again as if changed so resources
+    for the new dates are executed
+    :param allDateRelative: every file is date relative, i.e. as the
+    global vars mention date keys
+    :param prefetch: called with all resources to fill the table
+    metadata again before each execute
+    """
+    if not builder.fingerprints:
+        builder.fingerprints = {key: builder.fingerprint(rsrc)
+                                for (key, rsrc) in resources.items()}
+    refreshAt = refreshEvery and nextRefresh(clock(), refreshEvery)
+    while rounds is None or rounds > 0:
+        timeout = interval
+        if refreshAt:
+            # a little past the boundary so templates see the new date
+            untilRefresh = (refreshAt - clock()).total_seconds() + 1
+            timeout = max(0, min(interval, untilRefresh))
+        if fileWatcher:
+            paths = fileWatcher.changes(timeout)
+        else:
+            sleep(timeout)
+            paths = set()
+        files = builder.affectedFiles(paths)
+        if refreshAt and clock() >= refreshAt:
+            refreshAt = nextRefresh(clock(), refreshEvery)
+            files.update(allDateRelative and builder.keysByFile.keys()
+                         or builder.dateRelativeFiles())
+        if not files:
+            continue
+        if rounds is not None:
+            rounds -= 1
+        print("reloading", " ".join(sorted(files)))
+        try:
+            changed = builder.update(files, resources, dependencies, dryrun)
+            keys = dependantsOf(dependencies, changed)
+            if not keys:
+                continue
+            print("executing", len(keys), "changed or dependant resources")
+            # tables may have changed outside of bqm2 since the last round
+            tables.clear()
+            if prefetch:
+                prefetch(list(resources.values()))
+            execute({key: dependencies[key] & keys for key in keys})
+        except Exception as e:
+            # keep watching so the next save can fix it
+            print("could not reload or execute", " ".join(sorted(files)), e)
+
+
+def checkCycles(resourceDependencies: dict):
+    copy = {key: set([x for x in resourceDependencies[key]])
+            for key in resourceDependencies}
+    cycles = find_cycles(copy)
+    if cycles:
+        raise Exception("There are cycles in your templates.  Please make sure "
+                        "your recent changes have not introduced any cycles")
+
+
+# what DependencyExecutor.evaluate finds a resource needs
+RUNNING = "running"
+MISSING = "missing"
+CHANGED = "changed"
+STALE = "stale"
+UP_TO_DATE = "up to date"
+
+
+class RunSummary:
+    """ counts what an execution did, printed once it is done """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def __str__(self):
+        return "\n".join(["run summary:"] + [
+            f"  {name}: {round(value, 1) if isinstance(value, float) else value}"
+            for name, value in sorted(self.counts.items())])
+
 
 class DependencyExecutor:
     """ """
 
-    def __init__(self, resources, dependencies, maxRetry=2):
+    def __init__(self, resources, dependencies, maxRetry=2,
+                 stateStore=None, schedule=CRITICAL_PATH, runHistory=None,
+                 pools=None, jobTracker=None, pollInterval=None,
+                 retryPolicy=None):
+        """
+        :param stateStore: a loaded state_store.StateStore which records
+        the definition hash of each resource rather than its description
+        :param schedule: the order ready resources are started in, one
+        of scheduling.SCHEDULES
+        :param runHistory: a loaded scheduling.RunHistory, weighs the
+        critical path and is given how long each resource took
+        :param pools: concurrency pool name to the number of resources
+        which may run in it at once, see Resource.pools and
+        scheduling.parsePools.  Each is respected as well as maxConcurrent
+        :param jobTracker: a resource.JobTracker which finds when the jobs
+        of running resources are done, instead of reloading each
+        :param pollInterval: pollInterval(key, job, seconds running) the
+        seconds until a running job is checked again, i.e. a
+        job_watcher.AdaptiveInterval, rather than checkFrequency
+        :param retryPolicy: a retry_policy.RetryPolicy, how long resources
+        whose job or create failed wait before they are created again
+        """
         self.resources = resources
         self.dependencies = dependencies
+        # execute removes dependencies as they are done
+        self.upstream = {n: set(deps) for n, deps in dependencies.items()}
+        if stateStore:
+            # describe tables until the store has a record of them, so a
+            # run which fails before saving the store loses nothing
+            for n, rsrc in resources.items():
+                rsrc.describesDefinition = stateStore.get(n) is None
         self.maxRetry = maxRetry
+        self.stateStore = stateStore
+        self.schedule = schedule
+        self.runHistory = runHistory
+        self.created = set()
+        self.summary = RunSummary()
+        self.priorities = {}
+        self.readySeq = {}
+        self.startTimes = {}
+        self.pools = pools or {}
+        self.blocked = {}
+        self.jobTracker = jobTracker
+        self.pollInterval = pollInterval
+        self.runningSince = {}
+        self.retryPolicy = retryPolicy or RetryPolicy()
+        self.failures = defaultdict(int)
+        # ids of the jobs create started, whose errors backoff judges
+        self.submittedJobs = set()
+        self.failedJobs = set()
+        self.retryAt = {}
+
+    def intervalOf(self, n, job):
+        """ seconds until the job of n is checked again, None for
+        checkFrequency """
+        if not self.pollInterval:
+            return None
+        return self.pollInterval(n, job, time() - self.runningSince.get(n, time()))
+
+    def noticeDone(self, n, checkFrequency):
+        """ n is no longer running.  Counts how many checks of its job and
+        how long after it ended we took, against what checking every
+        checkFrequency seconds costs on average """
+        since = self.runningSince.pop(n, None)
+        if since is None:
+            return
+        now = time()
+        self.summary.count("job checks at --checkFrequency",
+                           math.ceil((now - since) / checkFrequency))
+        ended = getattr(self.resources[n].currentJob(), "ended", None)
+        if ended:
+            self.summary.count("seconds noticing jobs done",
+                               max(0.0, now - ended.timestamp()))
+            self.summary.count("seconds noticing jobs done at --checkFrequency",
+                               checkFrequency / 2)
+
+    def countJobStatusCalls(self, before):
+        if self.jobTracker:
+            self.summary.count("job status calls",
+                               self.jobTracker.calls - before)
+
+    def countDateKeyCache(self):
+        (hits, misses, _) = helpers.cacheInfo()
+        self.summary.count("date key cache hits", hits)
+        self.summary.count("date key cache misses", misses)
 
     def dump(self, folder):
         """ dump expanded templates to a folder """
@@ -150,6 +575,80 @@ class DependencyExecutor:
 
                     self.dependencies[n] = self.dependencies[n] - torm
 
+    def plan(self, maxConcurrent=10, maxBytes=None) -> Plan:
+        """ what execute would do, without starting any job.  Resources
+        are evaluated as execute does, in the order it may, and those
+        with a dependency to be executed would be too.  The queries of
+        those to execute are dry run, maxConcurrent at once.
+
+        :param maxBytes: raise, once the plan is printed, if its queries
+        would process more bytes
+        """
+        plan = Plan()
+        updateTimes = {}
+        running = set()
+        with readOnly(self.resources.values()):
+            for n in self.planOrder():
+                deps = [k for k in self.dependencies[n] if k in self.dependencies]
+                changed = sorted([k for k in deps if k in plan.reasons or k in running])
+                if changed:
+                    state = "its dependencies " + " ".join(changed) + " would be"
+                else:
+                    state = self.evaluate(n, max([updateTimes[k] for k in deps], default=0),
+                                          cancel=False)
+                if state == RUNNING:
+                    print(self.resources[n], "already running")
+                    running.add(n)
+                elif state == UP_TO_DATE:
+                    updateTimes[n] = self.resources[n].updateTime() or 0
+                else:
+                    plan.add(n, state, datasetOf(self.resources[n]))
+
+        def dryRun(n):
+            try:
+                return (n, self.resources[n].dryRun(), None)
+            except Exception as e:
+                return (n, None, str(e).splitlines()[0])
+
+        with ThreadPoolExecutor(max_workers=maxConcurrent) as pool:
+            for (n, processed, error) in pool.map(dryRun, list(plan.reasons)):
+                if error:
+                    plan.errors[n] = error
+                    self.summary.count("dry runs failed")
+                elif processed is not None:
+                    plan.bytes[n] = processed
+                    self.summary.count("dry runs")
+
+        duration = self.runHistory and self.runHistory.duration \
+            or (lambda key: 1.0)
+        plan.criticalPath = criticalPath(
+            {n: set(k for k in self.dependencies[n] if k in plan.reasons)
+             for n in plan.reasons}, duration)
+        if self.runHistory:
+            plan.criticalSeconds = sum([duration(n) for n in plan.criticalPath])
+        self.summary.count("bytes planned", plan.total())
+        print(plan)
+        if maxBytes is not None and plan.total() > maxBytes:
+            raise Exception("the plan would process more bytes than allowed",
+                            plan.total(), maxBytes)
+        return plan
+
+    def planOrder(self) -> list:
+        """ keys of the dependencies, each after those it depends on """
+        remaining = {n: set(k for k in deps if k in self.dependencies)
+                     for n, deps in self.dependencies.items()}
+        order = []
+        while remaining:
+            ready = sorted([n for n, deps in remaining.items() if not deps])
+            if not ready:
+                raise Exception("cycle among", sorted(remaining))
+            order.extend(ready)
+            for n in ready:
+                del remaining[n]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
     def dotml(self):
         print("digraph g {\n")
         for (k, s) in sorted(self.dependencies.items()):
@@ -167,6 +666,237 @@ class DependencyExecutor:
             raise Exception("Maximum retries hit for resource",
                             rsrcKey)
 
+    def backoff(self, n, error=None) -> float:
+        """ seconds n must wait before it is created again.  error, or
+        else that of the job this executor last started for n, is
+        classified by retry_policy.classifyError: permanent errors raise
+        at once and others delay the next create as retryPolicy says.
+        Failures only lengthen the delay, handleRetries limits how often
+        n is created.  Failed jobs of earlier runs, i.e. found by BqJobs,
+        aren't retries: n is just created again
+        """
+        job = self.resources[n].currentJob()
+        if error is None and job is not None and job.job_id in self.submittedJobs \
+                and job.job_id not in self.failedJobs:
+            error = getattr(job, "error_result", None)
+            if error:
+                self.failedJobs.add(job.job_id)
+        if error:
+            kind = classifyError(error)
+            self.summary.count(f"{kind} errors")
+            if kind == PERMANENT:
+                raise Exception("Permanent error for resource", n, error)
+            delay = self.retryPolicy.delay(kind, self.failures[n])
+            self.failures[n] += 1
+            self.retryAt[n] = time() + delay
+            self.summary.count("backoff seconds", delay)
+            print("backing off", n, "for", round(delay, 1), "seconds after",
+                  kind, "error", error)
+        return max(0.0, self.retryAt.get(n, 0) - time())
+
+    def nextRetry(self):
+        """ seconds until a resource backing off may be created again,
+        None if none are """
+        now = time()
+        due = [at - now for n, at in self.retryAt.items()
+               if n in self.dependencies and at > now]
+        return min(due) if due else None
+
+    def create(self, n):
+        if n in self.created:
+            self.summary.count("retries")
+        self.retryAt.pop(n, None)
+        self.started(n)
+        self.resources[n].create()
+        self.resources[n].invalidate()
+        self.created.add(n)
+        job = self.resources[n].currentJob()
+        if job is not None:
+            self.submittedJobs.add(job.job_id)
+        self.summary.count("jobs started")
+
+    def evaluate(self, n, depUpdateTime, cancel=True):
+        """ what execute should do with the resource keyed n whose
+        dependencies were last updated at depUpdateTime
+
+        :param cancel: cancel the running job of n if it is superseded,
+        else evaluate n as if it were cancelled
+        """
+        self.summary.count("resource checks")
+        rsrc = self.resources[n]
+        # check if it's already running
+        if rsrc.isRunning():
+            why = self.superseded(n)
+            if not why:
+                return RUNNING
+            if cancel:
+                self.cancel(n, why)
+            else:
+                print("would cancel the job of", n, "as", why)
+        # check if it doesn't exist in bq
+        if not rsrc.exists():
+            return MISSING
+        if self.definitionChanged(n):
+            return CHANGED
+        # check if dependencies were updated more recently than resource
+        # if so, we should regenerate resource since dependencies
+        #     may have changed.
+        record = self.stateStore and n not in self.created \
+            and self.stateStore.get(n)
+        if record and record["dep_update_time"] is not None:
+            # what they were when it was last built, even if the table
+            # was modified since, i.e. its description edited
+            if record["dep_update_time"] < depUpdateTime:
+                return STALE
+        elif rsrc.updateTime() < depUpdateTime:
+            return STALE
+        return UP_TO_DATE
+
+    def superseded(self, n):
+        """ why the running job of n, found when the run started, would
+        build it from a stale definition or stale dependencies, None if
+        it wouldn't """
+        rsrc = self.resources[n]
+        job = rsrc.currentJob()
+        if job is None or n in self.created:
+            return None
+        if not rsrc.jobIsCurrent(job):
+            return "its definition changed"
+        created = getattr(job, "created", None)
+        if not created:
+            return None
+        for k in sorted(self.upstream.get(n, ())):
+            modified = k in self.resources and self.resources[k].modifiedTime()
+            if modified and modified > created:
+                return "its dependencies were updated after it started"
+        return None
+
+    def cancelSuperseded(self):
+        """ cancel the running jobs, found when the run started, of
+        resources whose definition has changed since """
+        for n in sorted(self.dependencies):
+            rsrc = self.resources[n]
+            if n not in self.created and rsrc.currentJob() is not None \
+                    and not rsrc.jobIsCurrent(rsrc.currentJob()) \
+                    and rsrc.isRunning():
+                self.cancel(n, "its definition changed")
+
+    def cancel(self, n, why):
+        """ cancel the running job of n and count the slot time it would
+        have taken to finish: as much again as its query plan has left
+        or as --runHistory expects it to take """
+        rsrc = self.resources[n]
+        job = rsrc.currentJob()
+        print("cancelling", job.job_id, "of", n, "as", why)
+        job.cancel()
+        rsrc.attachJob(None)
+        rsrc.invalidate()
+        self.summary.count("superseded jobs cancelled")
+
+        used = (getattr(job, "slot_millis", None) or 0) / 1000
+        self.summary.count("slot seconds used by superseded jobs", used)
+        progress = queryProgress(job)
+        started = getattr(job, "started", None)
+        elapsed = started and time() - started.timestamp()
+        if progress:
+            left = used * (1 - progress) / progress
+        elif elapsed and self.runHistory and n in self.runHistory.durations:
+            left = used / elapsed * max(0.0, self.runHistory.durations[n] - elapsed)
+        else:
+            self.summary.count("superseded jobs of unknown slot time left")
+            return
+        self.summary.count("slot seconds saved cancelling superseded jobs", left)
+
+    def definitionChanged(self, n):
+        """ check if the query hash has changed by checking the state
+        store or else the description for it """
+        rsrc = self.resources[n]
+        definitionHash = self.stateStore and rsrc.definitionHash()
+        if not definitionHash:
+            return rsrc.shouldUpdate()
+        if n in self.created:
+            # built from definitionHash by this run
+            return False
+        record = self.stateStore.get(n)
+        if not record:
+            return rsrc.shouldUpdate()
+        return record["definition_hash"] != definitionHash
+
+    def prioritize(self):
+        """ ranks the resources to execute for self.schedule """
+        duration = self.runHistory and self.runHistory.duration \
+            or (lambda key: 1.0)
+        self.priorities = {}
+        if self.schedule == CRITICAL_PATH:
+            self.priorities = criticalPaths(self.dependencies, duration)
+        self.readySeq = {}
+
+    def markReady(self, keys):
+        for n in sorted(keys):
+            self.readySeq.setdefault(n, len(self.readySeq))
+
+    def rank(self, n) -> tuple:
+        """ of ready resources, those of lowest rank start first.  The
+        critical path schedule starts those with the longest chain of
+        work after them first """
+        if self.schedule == CRITICAL_PATH:
+            return (-self.priorities.get(n, 0), n)
+        if self.schedule == FIFO:
+            return (self.readySeq.get(n, len(self.readySeq)), n)
+        return (n,)
+
+    def started(self, n):
+        self.startTimes[n] = time()
+
+    def finished(self, n):
+        started = self.startTimes.pop(n, None)
+        if self.runHistory and started is not None:
+            self.runHistory.record(n, time() - started)
+
+    def poolsOf(self, n) -> list:
+        """ the limited pools n counts against, in the order they are
+        acquired """
+        return sorted([name for name in self.resources[n].pools()
+                       if name in self.pools])
+
+    def fullPools(self, n, running) -> list:
+        """ the pools of n which have as many resources running as they
+        may """
+        full = []
+        for name in self.poolsOf(n):
+            inPool = len([k for k in running
+                          if name in self.resources[k].pools()])
+            if inPool >= self.pools[name]:
+                full.append(name)
+        return full
+
+    def waitFor(self, n, pools):
+        """ n is ready but can't start until pools have room """
+        (since, blocking) = self.blocked.setdefault(n, (time(), set()))
+        blocking.update(pools)
+
+    def unblocked(self, n):
+        (since, blocking) = self.blocked.pop(n, (None, ()))
+        for name in blocking:
+            self.summary.count(f"pool {name} wait seconds", time() - since)
+
+    def saveState(self):
+        if self.stateStore:
+            self.stateStore.save()
+        if self.runHistory:
+            self.runHistory.save()
+
+    def remember(self, n, depUpdateTime):
+        """ record in the state store what the resource keyed n, which
+        is up to date, was built from """
+        rsrc = self.resources[n]
+        definitionHash = self.stateStore and rsrc.definitionHash()
+        if not definitionHash:
+            return
+        job = rsrc.currentJob()
+        self.stateStore.put(n, definitionHash, job and job.job_id,
+                            depUpdateTime)
+
     def execute(self, checkFrequency=10, maxConcurrent=10):
         retries = defaultdict(lambda: self.maxRetry)
         running = set([])
@@ -179,117 +909,286 @@ class DependencyExecutor:
            "table_that_table1_depends_on": {},
         }
 
-        We loop through this and execute keys with no dependencies.
-        When each finishes, we remove that from the values
-            of all other keys that contain it
+        We execute keys with no dependencies.  When each finishes, we
+        remove it from the dependencies of its dependants, which are
+        ready once they have none left.  Rather than sleeping between
+        rounds we wait for the jobs of running resources to signal
+        they are done, see JobWatcher.
         """
 
         depUpdateTimes = defaultdict(lambda: 0)
-        while len(self.dependencies):
-            todel = set([])
-            completed = set([])
-            for n in sorted(self.dependencies.keys()):
-                if not len(self.dependencies[n]):
-                    todel.add(n)
+        dependants = defaultdict(set)
+        for n, deps in self.dependencies.items():
+            for k in deps:
+                dependants[k].add(n)
+        ready = set([n for n, deps in self.dependencies.items() if not len(deps)])
+        self.prioritize()
+        self.cancelSuperseded()
+        self.markReady(ready)
+        watcher = JobWatcher(checkFrequency, tracker=self.jobTracker,
+                             interval=self.pollInterval)
+        getTableCalls = tables.getTableCalls
+        jobStatusCalls = self.jobTracker and self.jobTracker.calls
+
+        try:
+            while len(self.dependencies):
+                completed = set([])
+
+                """ Check running tasks first to clear them, then others """
+                for n in sorted(ready, key=lambda k: (int(k not in running),) + self.rank(k)):
+                    # whether handleRetries counted this attempt already
+                    attempted = False
+                    try:
+                        if n in running:
+                            # its job may have changed it since we looked
+                            self.resources[n].invalidate()
+                            self.summary.count("job checks")
+                        state = self.evaluate(n, depUpdateTimes[n])
+                        if state == RUNNING:
+                            print(self.resources[n], "already running")
+                            running.add(n)
+                            self.runningSince.setdefault(n, time())
+                            # wait for it rather than checking it every round
+                            ready.discard(n)
+                            watcher.watch(n, self.resources[n].currentJob())
+                            # continue so we can check other resource statuses
+                            continue
+                        else:
+                            self.noticeDone(n, checkFrequency)
+                            running.discard(n)
+
+                        # otherwise, nothing to do but cleanup
+                        if state == UP_TO_DATE:
+                            print(self.resources[n],
+                                  " resource exists and is up to date")
+                            self.remember(n, depUpdateTimes[n])
+                            self.finished(n)
+                            # delete from dependency dict
+                            self.dependencies.pop(n, None)
+                            ready.discard(n)
+                            completed.add(n)
+                            continue
 
-            """ flag to capture if anything was running.  If so,
-            we will pause before looping again.
-            Check running tasks first to clear them, then others"""
-            for n in sorted(todel, key=lambda k: (int(k not in running), k)):
-                try:
-                    # check if it's already running
-                    if (self.resources[n].isRunning()):
-                        print(self.resources[n], "already running")
-                        running.add(n)
-                        # continue so we can check other resource statuses
-                        continue
-                    else:
-                        running.discard(n)
-                    # check if it doesn't exist in bq
-                    if not self.resources[n].exists():
                         # break on max concurrency
                         if len(running) >= maxConcurrent:
                             print("max concurrent running already")
-                            # continue so we can check other resource statuses
                             break
+                        full = self.fullPools(n, running)
+                        if full:
+                            print("waiting for room in", " ".join(full), n)
+                            self.waitFor(n, full)
+                            continue
+                        self.unblocked(n)
+                        if self.backoff(n):
+                            continue
                         self.handleRetries(retries, n)
-                        # try to create resource
-                        print("executing: because it doesn't exist ", n)
-                        self.resources[n].create()
+                        attempted = True
+                        if state == MISSING:
+                            print("executing: because it doesn't exist ", n)
+                        elif state == CHANGED:
+                            print("executing: because our definition has changed",
+                                  n, self.resources[n])
+                        else:
+                            print("executing: because our dependencies have "
+                                  "changed since we last ran",
+                                  n, self.resources[n])
+                        # (re)create resource
+                        self.create(n)
                         # confirm resource is actually running
                         # this prints <job_id> <status> <response>
                         if (self.resources[n].isRunning()):
                             running.add(n)
+                            self.runningSince[n] = time()
+                            ready.discard(n)
+                            watcher.watch(n, self.resources[n].currentJob())
                         # continue so we can check other resource statuses
                         continue
-                    # check if the query hash has changed
-                    # by checking the description for it
-                    elif self.resources[n].shouldUpdate():
-                        # break on max concurrency
-                        if len(running) >= maxConcurrent:
-                            print("max concurrent running already")
-                            # continue so we can check other resource statuses
-                            break
-                        self.handleRetries(retries, n)
-                        print("executing: because our definition has changed",
-                              n, self.resources[n])
-                        # recreate resource again
-                        self.resources[n].create()
-                        # confirm resource is running
-                        if (self.resources[n].isRunning()):
-                            running.add(n)
-                        # continue so we can check other resource statuses
+                    except PreconditionFailed as e:
+                        print("trapping precondition fail error")
+                        print(e)
+                        if not attempted:
+                            self.handleRetries(retries, n)
+                        self.backoff(n, e)
                         continue
-                    # check if dependencies were updated more recently than resource
-                    # if so, we should regenerate resource since dependencies
-                    #     may have changed.
-                    elif self.resources[n].updateTime() < depUpdateTimes[n]:
-                        # break on max concurrency
-                        if len(running) >= maxConcurrent:
-                            print("max concurrent running already")
-                            # continue so we can check other resource statuses
-                            break
-                        self.handleRetries(retries, n)
-                        print("executing: because our dependencies have "
-                              "changed since we last ran",
-                              n, self.resources[n])
-                        # recreate resource again
-                        self.resources[n].create()
-                        # confirm resource is running
-                        if (self.resources[n].isRunning()):
-                            running.add(n)
-                        # continue so we can check other resource statuses
+                    except GoogleAPICallError as e:
+                        if not attempted:
+                            self.handleRetries(retries, n)
+                        self.backoff(n, e)
+                        continue
+
+                for n in sorted(completed):
+                    waiting = [k for k in dependants[n] if k in self.dependencies]
+                    if not waiting:
+                        continue
+                    updateTime = self.resources[n].updateTime()
+                    for k in waiting:
+                        depUpdateTimes[k] = max(depUpdateTimes[k], updateTime)
+                        self.dependencies[k].discard(n)
+                        if not len(self.dependencies[k]):
+                            ready.add(k)
+                            self.markReady([k])
+
+                # wait if there is still work, nothing new to start
+                # AND things are still running
+                if len(self.dependencies) and not completed and len(running):
+                    ready.update([n for n in watcher.wait(self.nextRetry())
+                                  if n in self.dependencies])
+                elif len(self.dependencies) and not completed \
+                        and self.nextRetry() is not None:
+                    sleep(self.nextRetry())
+        finally:
+            # keep what was built even if the run fails
+            self.saveState()
+
+        self.summary.count("job checks", watcher.refreshes)
+        self.summary.count("get_table calls", tables.getTableCalls - getTableCalls)
+        self.countDateKeyCache()
+        self.countJobStatusCalls(jobStatusCalls)
+        print(self.summary)
+
+    async def executeAsync(self, checkFrequency=10, maxConcurrent=10,
+                           probeConcurrency=50):
+        """ execute with asyncio.  Same decisions as execute but the
+        exists, updateTime and shouldUpdate probes and the create calls
+        of the google clients run in threads, up to probeConcurrency at
+        once.  At most maxConcurrent jobs run at once as in execute.
+        """
+        retries = defaultdict(lambda: self.maxRetry)
+        depUpdateTimes = defaultdict(lambda: 0)
+        dependants = defaultdict(set)
+        for n, deps in self.dependencies.items():
+            for k in deps:
+                dependants[k].add(n)
+
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=probeConcurrency))
+        probes = asyncio.Semaphore(probeConcurrency)
+        slots = PrioritySlots(maxConcurrent)
+        poolSlots = {name: PrioritySlots(limit)
+                     for (name, limit) in self.pools.items()}
+        self.prioritize()
+        await asyncio.to_thread(self.cancelSuperseded)
+        tasks = set()
+        getTableCalls = tables.getTableCalls
+        jobStatusCalls = self.jobTracker and self.jobTracker.calls
+
+        async def probe(fn, *args):
+            async with probes:
+                return await asyncio.to_thread(fn, *args)
+
+        @asynccontextmanager
+        async def slot(n):
+            """ a slot in each pool of n and then one of maxConcurrent """
+            async with AsyncExitStack() as stack:
+                for name in self.poolsOf(n):
+                    waitStart = time()
+                    await stack.enter_async_context(
+                        poolSlots[name].slot(self.rank(n)))
+                    self.summary.count(f"pool {name} wait seconds",
+                                       time() - waitStart)
+                await stack.enter_async_context(slots.slot(self.rank(n)))
+                yield
+
+        def start(keys):
+            self.markReady(keys)
+            for n in sorted(keys, key=self.rank):
+                tasks.add(asyncio.create_task(advance(n)))
+
+        async def advance(n):
+            rsrc = self.resources[n]
+            while True:
+                # whether handleRetries counted this attempt already
+                attempted = False
+                try:
+                    state = await probe(self.evaluate, n, depUpdateTimes[n])
+                    if state != RUNNING:
+                        self.noticeDone(n, checkFrequency)
+                    if state == UP_TO_DATE:
+                        break
+                    delay = state != RUNNING and self.backoff(n)
+                    if delay:
+                        await asyncio.sleep(delay)
                         continue
-                    # otherwise, nothing to do but cleanup
-                    else:
-                        print(self.resources[n],
-                              " resource exists and is up to date")
-                        # delete from dependency dict
-                        del self.dependencies[n]
-                        # remove from running set (if in there)
-                        running.discard(n)
-                        completed.add(n)
+                    async with slot(n):
+                        if state == RUNNING:
+                            print(rsrc, "already running")
+                            self.runningSince.setdefault(n, time())
+                        else:
+                            self.handleRetries(retries, n)
+                            attempted = True
+                            if state == MISSING:
+                                print("executing: because it doesn't exist ", n)
+                            elif state == CHANGED:
+                                print("executing: because our definition has changed",
+                                      n, rsrc)
+                            else:
+                                print("executing: because our dependencies have "
+                                      "changed since we last ran", n, rsrc)
+                            await probe(self.create, n)
+                            if not await probe(rsrc.isRunning):
+                                continue
+                            self.runningSince[n] = time()
+                        job = rsrc.currentJob()
+                        await waitForJob(job, checkFrequency,
+                                         tracker=self.jobTracker,
+                                         interval=self.intervalOf(n, job))
+                        rsrc.invalidate()
+                        self.summary.count("job checks")
                 except PreconditionFailed as e:
                     print("trapping precondition fail error")
                     print(e)
-                    self.handleRetries(retries, n)
-                    continue
+                    if not attempted:
+                        self.handleRetries(retries, n)
+                    self.backoff(n, e)
+                except GoogleAPICallError as e:
+                    if not attempted:
+                        self.handleRetries(retries, n)
+                    self.backoff(n, e)
+
+            print(rsrc, " resource exists and is up to date")
+            self.remember(n, depUpdateTimes[n])
+            self.finished(n)
+            del self.dependencies[n]
+            waiting = [k for k in dependants[n] if k in self.dependencies]
+            if not waiting:
+                return
+            updateTime = await probe(rsrc.updateTime)
+            ready = []
+            for k in waiting:
+                depUpdateTimes[k] = max(depUpdateTimes[k], updateTime)
+                self.dependencies[k].discard(n)
+                if not len(self.dependencies[k]):
+                    ready.append(k)
+            start(ready)
 
-            # less n-squared
-            if completed:
-                for n in sorted(self.dependencies.keys()):
-                    intersect = set.intersection(self.dependencies[n], completed)
-                    if intersect:
-                        newDepUpdateTime = max(
-                            depUpdateTimes[n],
-                            *[self.resources[k].updateTime() for k in intersect],
-                        )
-                        depUpdateTimes[n] = newDepUpdateTime
-                        self.dependencies[n] = self.dependencies[n] - intersect
+        def refreshInterval():
+            intervals = [self.intervalOf(n, self.resources[n].currentJob())
+                         for n in list(self.runningSince)]
+            return min([i for i in intervals if i] or [checkFrequency])
 
-            # sleep if there is still work AND things are still running
-            if len(self.dependencies) and len(running):
-                sleep(checkFrequency)
+        refresher = self.jobTracker and asyncio.create_task(
+            refreshTracker(self.jobTracker, refreshInterval))
+        start([n for n, deps in self.dependencies.items() if not len(deps)])
+        try:
+            while tasks:
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_EXCEPTION)
+                tasks.difference_update(done)
+                for task in done:
+                    if task.exception():
+                        for other in tasks:
+                            other.cancel()
+                        raise task.exception()
+        finally:
+            if refresher:
+                refresher.cancel()
+            # keep what was built even if the run fails
+            self.saveState()
+
+        self.summary.count("get_table calls", tables.getTableCalls - getTableCalls)
+        self.countDateKeyCache()
+        self.countJobStatusCalls(jobStatusCalls)
+        print(self.summary)
 
 
 if __name__ == "__main__":
@@ -311,6 +1210,18 @@ if __name__ == "__main__":
                       "Renders the templates found in those folders "
                       "and executes them in proper order "
                            "of their dependencies")
+    parser.add_option("--plan", dest="plan",
+                      action="store_true", default=False,
+                      help="Show what 'execute' mode would create or "
+                           "update and why, the bytes the queries would "
+                           "process according to dry runs, per resource "
+                           "and dataset, and the critical path, weighed "
+                           "by --runHistory if given.  No job is started")
+    parser.add_option("--maxBytesPlanned", dest="maxBytesPlanned",
+                      default=None,
+                      help="Plan before 'execute' mode as --plan does and "
+                           "stop before any job is started if the queries "
+                           "would process more bytes, i.e. 500GB or 2TB")
     parser.add_option("--dotml", dest="dotml",
                       action="store_true", default=False,
                       help="Generate dot ml graph of dag of execution.  "
@@ -343,6 +1254,95 @@ if __name__ == "__main__":
                       help="The loop interval between dependency tree"
                            " evaluation runs")
 
+    parser.add_option("--engine", dest="engine", type="choice",
+                      choices=["sync", "async"], default="sync",
+                      help="Relevant to 'execute' mode.  'async' checks "
+                           "resources and submits jobs concurrently, up "
+                           "to --probeConcurrency at once, rather than "
+                           "one after another")
+
+    parser.add_option("--probeConcurrency", dest="probeConcurrency",
+                      type=int, default=50,
+                      help="Relevant to --engine=async.  The maximum "
+                           "number of concurrent metadata checks and job "
+                           "submissions.  Unrelated to --maxConcurrent")
+
+    parser.add_option("--prefetchMetadata", dest="prefetchMetadata",
+                      action="store_true", default=False,
+                      help="Relevant to 'execute' mode.  Load the metadata "
+                           "of all tables of every dataset used with one "
+                           "query per dataset, rather than one get_table "
+                           "per table")
+
+    parser.add_option("--stateStore", dest="stateStore", type=str,
+                      help="Relevant to 'execute' mode.  Where to record "
+                           "the definition hash each resource was built "
+                           "from: sqlite:<path> or "
+                           "bq:<project.dataset.table>.  Hashes are then "
+                           "only written into the descriptions of tables "
+                           "the store has no record of")
+
+    parser.add_option("--jobWindow", dest="jobWindow", type=int,
+                      default=24,
+                      help="Relevant to 'execute' mode.  Running and pending "
+                           "jobs created within this many hours are looked "
+                           "for at startup so they are waited for rather "
+                           "than started again")
+
+    parser.add_option(KVOption(
+        "--pool",
+        dest="pools",
+        metavar="NAME=LIMIT",
+        help="Relevant to 'execute' mode.  At most LIMIT resources of the "
+             "concurrency pool NAME run at once, besides --maxConcurrent.  "
+             "Resources are in the pools type:<type>, i.e. type:bash, "
+             "type:query, type:gcsload or type:extract, "
+             "project:<project>, dataset:<project.dataset> and, if their "
+             "vars set pool, pool:<pool> which may be given as just <pool>.  "
+             "May be repeated"
+    ))
+
+    parser.add_option("--schedule", dest="schedule", type="choice",
+                      choices=SCHEDULES, default=CRITICAL_PATH,
+                      help="Relevant to 'execute' mode.  The order ready "
+                           "resources start in once --maxConcurrent are "
+                           "running.  'critical-path' starts those with "
+                           "the longest chain of work after them first, "
+                           "'fifo' those ready first and 'alpha' by key")
+
+    parser.add_option("--runHistory", dest="runHistory", type=str,
+                      help="Relevant to 'execute' mode.  A json file of "
+                           "how long each resource took to build in past "
+                           "runs, which weighs --schedule=critical-path.  "
+                           "Updated by each run")
+
+    parser.add_option("--adaptivePolling", dest="adaptivePolling",
+                      action="store_true", default=False,
+                      help="Relevant to 'execute' mode.  Check on each "
+                           "running job sooner the nearer it is estimated "
+                           "to end, from its query plan progress or "
+                           "--runHistory, and later the longer it runs.  "
+                           "Between 1 second and 6 times --checkFrequency")
+
+    parser.add_option("--retryBackoff", dest="retryBackoff",
+                      type="float", default=2.0,
+                      help="Relevant to 'execute' mode.  Seconds to wait "
+                           "before the first retry of a resource whose job "
+                           "failed with a transient error, doubling each "
+                           "retry, with jitter.  Permanent errors, i.e. "
+                           "invalid queries, are not retried")
+    parser.add_option("--quotaBackoff", dest="quotaBackoff",
+                      type="float", default=30.0,
+                      help="Relevant to 'execute' mode.  As --retryBackoff "
+                           "for rate limit and quota errors")
+
+    parser.add_option("--reloadEachJob", dest="reloadEachJob",
+                      action="store_true", default=False,
+                      help="Relevant to 'execute' mode.  Check on running "
+                           "jobs one by one, rather than with a few pages "
+                           "of list_jobs per --checkFrequency for all of "
+                           "them")
+
     parser.add_option("--maxRetry", dest="maxRetry", type=int,
                       default=2,
                       help="Relevant to 'execute' mode. The maximum "
@@ -361,6 +1361,35 @@ if __name__ == "__main__":
                            "created. i.e. us-east1, us-central1, etc",
                       default="US")
 
+    parser.add_option("--loadWorkers", dest="loadWorkers", type=int,
+                      default=1,
+                      help="The number of processes rendering templates "
+                           "while loading folders.  Output is the same "
+                           "as when rendering in a single process")
+
+    parser.add_option("--graphCache", dest="graphCache", type=str,
+                      help="A folder, i.e. .bqm2cache, where the rendered "
+                           "resources and dependencies of each file are "
+                           "cached by a hash of the file's inputs.  "
+                           "--show and --dotml then only re-render and "
+                           "re-link the files which have changed")
+
+    parser.add_option("--watch", dest="watch",
+                      action="store_true", default=False,
+                      help="Relevant to 'execute' mode.  Once executed, "
+                           "keep watching the folders.  Changed files are "
+                           "loaded again and only the resources they "
+                           "change, and their dependants, are executed")
+
+    parser.add_option("--refreshEvery", dest="refreshEvery",
+                      type="choice", choices=REFRESH_UNITS,
+                      help="Relevant to 'execute' mode.  Once executed, "
+                           "keep running and at the start of every hour, "
+                           "day or month expand the templates whose vars "
+                           "are relative to now again.  Only resources "
+                           "for the new dates, and their dependants, are "
+                           "executed.  May be combined with --watch")
+
     parser.add_option("--print-global-args",
                       help="Creates a json output of the parsed global "
                            "args consumed from the command line",
@@ -407,9 +1436,7 @@ if __name__ == "__main__":
         if not options.defaultProject and not globalVars.get("project", None):
             client = Client(**additional_args)
             globalVars["project"] = client.project
-        bqJobs = BqJobs(client)
-        if options.execute:
-            bqJobs.loadTableJobs()
+        bqJobs = BqJobs(client, window=timedelta(hours=options.jobWindow))
 
     builder = DependencyBuilder(
         DelegatingFileSuffixLoader(
@@ -445,18 +1472,101 @@ if __name__ == "__main__":
             externaltable=BqQueryTemplatingFileLoader(loadClient, gcsClient,
                                                       bqJobs,
                                                       TableType.EXTERNAL_TABLE,
-                                                      globalVars))
+                                                      globalVars)),
+        loadWorkers=options.loadWorkers
     )
-    (resources, dependencies) = builder.buildDepend(args, dryrun=dryrun)
+    if options.graphCache and not options.execute \
+            and (options.show or options.dotml):
+        builder.graphCache = GraphCache(
+            options.graphCache,
+            salt=json.dumps([globalVars, dryrun], sort_keys=True, default=str))
+        resources = {}
+        dependencies = builder.buildGraph(args, dryrun=dryrun)
+    else:
+        (resources, dependencies) = builder.buildDepend(args, dryrun=dryrun)
+    planned = options.plan or (options.execute and options.maxBytesPlanned)
+    if (options.execute or planned) and bqJobs:
+        # find running jobs once the tables they may be creating are known
+        prefixes = dict([(rsrc.jobPrefix(), rsrc) for rsrc in resources.values()
+                         if rsrc.jobPrefix()])
+        bqJobs.loadTableJobs(set(prefixes.keys()))
+        for prefix, rsrc in prefixes.items():
+            job = bqJobs.getJob(prefix)
+            if job and not rsrc.currentJob():
+                print(f"found running/pending job {job.job_id} for {prefix}")
+                rsrc.attachJob(job)
+
+    stateStore = None
+    if (options.execute or planned) and options.stateStore:
+        stateStore = openStateStore(options.stateStore, client)
+
+    runHistory = None
+    if (options.execute or planned) and options.runHistory:
+        runHistory = RunHistory(options.runHistory).load()
+
+    pollInterval = None
+    if options.adaptivePolling:
+        pollInterval = AdaptiveInterval(
+            maximum=options.checkFrequency * 6,
+            expected=runHistory and runHistory.durations.get)
+
+    jobTracker = None
+    if options.execute and client and not options.reloadEachJob:
+        jobTracker = JobTracker(client, since=datetime.now(timezone.utc))
+
+    def executeGraph(subgraph):
+        executor = DependencyExecutor(resources, subgraph,
+                                      maxRetry=options.maxRetry,
+                                      stateStore=stateStore,
+                                      schedule=options.schedule,
+                                      runHistory=runHistory,
+                                      pools=parsePools(options.pools),
+                                      jobTracker=jobTracker,
+                                      pollInterval=pollInterval,
+                                      retryPolicy=RetryPolicy(options.retryBackoff,
+                                                              options.quotaBackoff))
+        if options.engine == "async":
+            asyncio.run(executor.executeAsync(
+                checkFrequency=options.checkFrequency,
+                maxConcurrent=options.maxConcurrent,
+                probeConcurrency=options.probeConcurrency))
+        else:
+            executor.execute(checkFrequency=options.checkFrequency,
+                             maxConcurrent=options.maxConcurrent)
+
     executor = DependencyExecutor(resources, dependencies,
-                                  maxRetry=options.maxRetry)
+                                  maxRetry=options.maxRetry,
+                                  stateStore=stateStore,
+                                  runHistory=runHistory)
 
     if options.print_global_args:
         print(json.dumps(globalVars))
         exit(0)
 
-    if options.execute:
-        executor.execute(checkFrequency=options.checkFrequency, maxConcurrent=options.maxConcurrent)
+    def prefetch(rsrcs):
+        tables.prefetch(client, [rsrc.table for rsrc in rsrcs
+                                 if hasattr(rsrc, "table")])
+
+    if (options.execute or planned) and options.prefetchMetadata:
+        prefetch(resources.values())
+
+    if planned:
+        executor.plan(maxConcurrent=options.maxConcurrent,
+                      maxBytes=options.maxBytesPlanned
+                      and parseBytes(options.maxBytesPlanned))
+
+    if options.execute and (options.watch or options.refreshEvery):
+        # execute consumes the graph it is given
+        executeGraph({key: set(deps) for (key, deps) in dependencies.items()})
+        watch(builder, options.watch and openFileWatcher(args) or None,
+              resources, dependencies, executeGraph,
+              refreshEvery=options.refreshEvery,
+              allDateRelative="yyyy" in json.dumps(globalVars),
+              prefetch=options.prefetchMetadata and prefetch or None)
+    elif options.execute:
+        executeGraph(dependencies)
+    elif options.plan:
+        pass
     elif options.show:
         executor.show()
     elif options.dotml:
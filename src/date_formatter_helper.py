@@ -1,41 +1,98 @@
+import re
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 
 class DateFormatHelper:
-    def __init__(self, formats: list, formats_suffixes: list):
+    def __init__(self, formats: list, formats_suffixes: list,
+                 cacheSize: int = 4096):
         """
         :param formats: datetime formats
         :param formats_suffixes: template key suffixes or endings
+        :param cacheSize: how many k, v the derived keys are kept for
         """
         self.formats = formats
         self.formats_suffixes = formats_suffixes
-        self.cache = {}
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
 
         assert len(formats)
         assert len(formats) == len(formats_suffixes)
+        self.slices = componentSlices(formats)
+
+    def __getstate__(self):
+        """ the cache goes along when pickled i.e. to seed workers """
+        state = self.__dict__.copy()
+        del state["lock"]
+        with self.lock:
+            state["cache"] = self.cache.copy()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     def format_date_key(self, k: str, v: str, m: dict):
         if k.endswith(f"_{self.formats_suffixes[0]}") \
                 or k == self.formats_suffixes[0]:
             # given k, v, there's only one set of new k, v which should
             # go into m.  So we cache them
-            toset = {}
-            if f"{k}:{v}" in self.cache:
-                toset = self.cache[f"{k}:{v}"]
-            else:
+            toset = self.cached(k, v)
+            if toset is None:
+                toset = {}
+                newvals = self.components(v)
                 for i in range(1, len(self.formats_suffixes)):
                     newkey = k.replace(self.formats_suffixes[0],
                                        self.formats_suffixes[i])
+                    toset[newkey] = newvals[i - 1]
+                self.store(k, v, toset)
 
-                    newval = datetime.strptime(v, self.formats[0])\
-                        .strftime(self.formats[i])
-                    toset[newkey] = newval
-
-            for k, v in toset.items():
-                if k in m:
+            for newkey, newval in toset.items():
+                if newkey in m:
                     continue
-                m[k] = v
-            self.cache[f"{k}:{v}"] = toset
+                m[newkey] = newval
+
+    def cached(self, k: str, v: str) -> dict:
+        """ the new keys of k, v or None if they are not cached """
+        with self.lock:
+            toset = self.cache.get((k, v))
+            if toset is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.cache.move_to_end((k, v))
+            return toset
+
+    def store(self, k: str, v: str, toset: dict):
+        with self.lock:
+            self.cache[(k, v)] = toset
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+
+    def seed(self, other: "DateFormatHelper"):
+        """ cache what other has cached, i.e. in the parent process """
+        for ((k, v), toset) in other.cache.copy().items():
+            self.store(k, v, toset)
+
+    def components(self, v: str) -> list:
+        """ v, a date in formats[0], in each of formats[1:].  Dates of
+        fixed width are sliced once checked to be a date, others parsed.
+        """
+        if self.slices and isinstance(v, str) and v.isdigit() \
+                and len(v) == self.slices[0] and v[0] != "0":
+            (width, fields, derived) = self.slices
+            date = {"Y": 1, "m": 1, "d": 1, "H": 0}
+            for (field, (start, end)) in fields.items():
+                date[field] = int(v[start:end])
+            # raises ValueError as strptime would
+            datetime(date["Y"], date["m"], date["d"], date["H"])
+            return [v[start:end] for (start, end) in derived]
+        parsed = datetime.strptime(v, self.formats[0])
+        return [parsed.strftime(f) for f in self.formats[1:]]
 
     def show_new_keys(self, keys: list):
         m = set()
@@ -48,6 +105,39 @@ class DateFormatHelper:
         return m
 
 
+# width of the fixed width fields of datetime formats
+FIELD_WIDTHS = {"Y": 4, "m": 2, "d": 2, "H": 2}
+
+
+def componentSlices(formats: list):
+    """ How to slice dates in formats[0] into formats[1:] rather than
+    parse them.  None unless formats[0] is made only of fixed width
+    fields and each of formats[1:] is one of them, or %y.
+
+    :return: (width of formats[0], slice of each field in formats[0],
+    slice of each of formats[1:])
+    """
+    fields = {}
+    position = 0
+    tokens = re.findall("%.|.", formats[0])
+    for token in tokens:
+        if token[1:] not in FIELD_WIDTHS or token[1:] in fields:
+            return None
+        width = FIELD_WIDTHS[token[1:]]
+        fields[token[1:]] = (position, position + width)
+        position += width
+
+    derived = []
+    for f in formats[1:]:
+        if f == "%y" and "Y" in fields:
+            derived.append((fields["Y"][0] + 2, fields["Y"][1]))
+        elif f[1:] in fields and f[0] == "%":
+            derived.append(fields[f[1:]])
+        else:
+            return None
+    return (position, fields, derived)
+
+
 class DateFormatHelpers:
     def __init__(self, formatters):
         self.formatters = formatters
@@ -60,6 +150,16 @@ class DateFormatHelpers:
             ret.update(f.show_new_keys(keys))
         return ret
 
+    def seed(self, other: "DateFormatHelpers"):
+        for (f, o) in zip(self.formatters, other.formatters):
+            f.seed(o)
+
+    def cacheInfo(self) -> tuple:
+        """ :return: (hits, misses, size) of the caches of all formatters """
+        return (sum([f.hits for f in self.formatters]),
+                sum([f.misses for f in self.formatters]),
+                sum([len(f.cache) for f in self.formatters]))
+
     def format_date_keys(self, k: str, v: str, m: dict):
         for f in self.formatters:
             f.format_date_key(k, v, m)
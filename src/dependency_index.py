@@ -0,0 +1,128 @@
+import re
+
+from key_matcher import KeyMatcher
+
+# characters which survive resource.getFiltered.  Keys with any other
+# character can never be found in a filtered query
+FILTERED_ALPHABET = re.compile("^[0-9a-zA-Z._ ]*$")
+
+
+class LinkSpec:
+    """ Plain description of how a resource links to the other resources
+    of a graph.  Each field mirrors one of the dependsOn rules found in
+    resource.py so that DependencyIndex can resolve all edges of a graph
+    with lookups rather than comparing every pair of resources.
+    """
+
+    def __init__(self, key: str,
+                 filtered: str = None,
+                 textSkipsExtracts: bool = False,
+                 datasetScoped: bool = False,
+                 datasetId: str = None,
+                 source: str = None,
+                 uris: tuple = None,
+                 extractUris: tuple = None,
+                 isDataset: bool = False):
+        """
+        :param key: the key of the resource described
+        :param filtered: getFiltered text in which "<key> " of another
+        resource means a dependency on it
+        :param textSkipsExtracts: extract resources are not looked up
+        in filtered
+        :param datasetScoped: depend on any dataset whose key is a strict
+        substring of our key
+        :param datasetId: depend on the resource keyed by this dataset id
+        :param source: depend on the resource with this key
+        :param uris: depend on extracts writing to any of these uris
+        :param extractUris: uris this (extract) resource writes to
+        :param isDataset: this resource is a dataset
+        """
+        self.key = key
+        self.filtered = filtered
+        self.textSkipsExtracts = textSkipsExtracts
+        self.datasetScoped = datasetScoped
+        self.datasetId = datasetId
+        self.source = source
+        self.uris = uris
+        self.extractUris = extractUris
+        self.isDataset = isDataset
+
+
+class DependencyIndex:
+    """ Index over the keys of a set of resources built once so that the
+    dependencies of each resource can be found without comparing it
+    to every other resource.
+
+    The reference rule of resource.legacyBqQueryDependsOn is
+    strictSubstring(key + " ", filtered).  All "<key> " patterns go into
+    one KeyMatcher so each filtered query is scanned once, whatever the
+    number of resources.
+    """
+
+    def __init__(self, resources=(), specs=()):
+        """
+        :param resources: resources to index
+        :param specs: LinkSpecs of further resources, i.e. from a cache
+        """
+        self.resources = list(resources)
+        self.specs = {}
+        self.datasets = []
+        self.extracts = set()
+        self.extractsByUri = {}
+        for rsrc in self.resources:
+            spec = rsrc.linkSpec()
+            self.specs[spec and spec.key or rsrc.key()] = spec
+        for spec in specs:
+            self.specs[spec.key] = spec
+
+        for key, spec in self.specs.items():
+            if not spec:
+                continue
+            if spec.isDataset:
+                self.datasets.append(key)
+            if spec.extractUris is not None:
+                self.extracts.add(key)
+                for uri in spec.extractUris:
+                    self.extractsByUri.setdefault(uri, []).append(key)
+
+        self.matcher = KeyMatcher([key + " " for key in self.specs
+                                   if FILTERED_ALPHABET.match(key)])
+
+    def referencedKeys(self, filtered: str) -> set:
+        """ keys k of the index for which
+        strictSubstring(k + " ", filtered) holds """
+        return set([pattern[:-1]
+                    for pattern in self.matcher.findAll(filtered)
+                    if len(pattern) < len(filtered)])
+
+    def dependencies(self, rsrc) -> set:
+        """ keys of the indexed resources rsrc depends on """
+        spec = rsrc.linkSpec()
+        if not spec:
+            return set([other.key() for other in self.resources
+                        if rsrc.dependsOn(other)])
+        return self.resolve(spec)
+
+    def resolve(self, spec: LinkSpec) -> set:
+        deps = set()
+        if spec.filtered is not None:
+            for key in self.referencedKeys(spec.filtered):
+                if spec.textSkipsExtracts and key in self.extracts:
+                    continue
+                deps.add(key)
+
+        if spec.datasetScoped:
+            for key in self.datasets:
+                if key in spec.key and len(key) < len(spec.key):
+                    deps.add(key)
+
+        for key in [spec.datasetId, spec.source]:
+            if key is not None and key in self.specs:
+                deps.add(key)
+
+        if spec.uris:
+            for uri in spec.uris:
+                deps.update(self.extractsByUri.get(uri, []))
+
+        deps.discard(spec.key)
+        return deps
@@ -0,0 +1,135 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+from time import sleep, time
+
+# inotify_event flags, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE
+
+# wd, mask, cookie and len of struct inotify_event, the name follows
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _folder_(folder: str) -> str:
+    """ folders as DependencyBuilder.listFiles joins them to names """
+    return re.sub("/$", "", folder)
+
+
+class PollingFileWatcher:
+    """ Reports the files of folders which were added, changed or
+    removed by comparing the mtime and size of every file each interval.
+    For where inotify is not available.
+    """
+
+    def __init__(self, folders: list, interval: float = 1.0):
+        self.folders = [_folder_(folder) for folder in folders]
+        self.interval = interval
+        self.state = self.snapshot()
+
+    def snapshot(self) -> dict:
+        state = {}
+        for folder in self.folders:
+            for name in os.listdir(folder):
+                path = "/".join([folder, name])
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                state[path] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def changes(self, timeout: float) -> set:
+        """ paths changed since the last call, waiting up to timeout
+        seconds for any """
+        deadline = time() + timeout
+        while True:
+            current = self.snapshot()
+            changed = set([path for path in current.keys() | self.state.keys()
+                           if current.get(path) != self.state.get(path)])
+            self.state = current
+            if changed or time() >= deadline:
+                return changed
+            sleep(max(0, min(self.interval, deadline - time())))
+
+    def close(self):
+        pass
+
+
+class InotifyFileWatcher:
+    """ Reports the files of folders which were added, changed or removed
+    as the kernel tells us with inotify.  Events are gathered until the
+    folders are quiet for settle seconds so an editor saving a template
+    and its vars is one change.
+    """
+
+    def __init__(self, folders: list, settle: float = 0.2):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self.settle = settle
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for folder in folders:
+            folder = _folder_(folder)
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(folder),
+                                        WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, "inotify_add_watch failed", folder)
+            self.folders[wd] = folder
+
+    def read(self) -> set:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = \
+                INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name and wd in self.folders:
+                paths.add("/".join([self.folders[wd], os.fsdecode(name)]))
+        return paths
+
+    def changes(self, timeout: float) -> set:
+        """ paths changed since the last call, waiting up to timeout
+        seconds for any """
+        changed = set()
+        readable = select.select([self.fd], [], [], timeout)[0]
+        while readable:
+            changed.update(self.read())
+            readable = select.select([self.fd], [], [], self.settle)[0]
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def openFileWatcher(folders: list, interval: float = 1.0):
+    """ an InotifyFileWatcher of folders or, where inotify isn't
+    available, a PollingFileWatcher """
+    try:
+        return InotifyFileWatcher(folders)
+    except (OSError, AttributeError) as e:
+        print("inotify unavailable, polling for changes:", e)
+        return PollingFileWatcher(folders, interval)
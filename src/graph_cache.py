@@ -0,0 +1,120 @@
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from dependency_index import LinkSpec
+
+# bump when rendering or linking changes what a cached entry means
+CACHE_VERSION = "1"
+
+# the files, next to a template, whose content goes into its rendering
+INPUT_SUFFIXES = ["", ".vars", ".queryjobconfig", ".schema"]
+
+
+class GraphCache:
+    """ On disk cache of the dependency graph.  For each source file we
+    keep the LinkSpec of every resource it renders and the edges found
+    for them, keyed by a hash of every input of the rendering.  Files
+    whose inputs are unchanged need neither be re-rendered nor, if the
+    rest of the graph is unchanged, re-linked.
+    """
+
+    def __init__(self, folder: str, salt: str = ""):
+        """
+        :param folder: where graph.json.gz is kept
+        :param salt: anything else rendering depends on i.e. global vars
+        """
+        self.folder = folder
+        self.path = os.path.join(folder, "graph.json.gz")
+        self.salt = salt
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with gzip.open(self.path, "rt") as f:
+                obj = json.load(f)
+            if obj.get("version") == CACHE_VERSION:
+                self.entries = obj["files"]
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with gzip.open(tmp, "wt") as f:
+            json.dump({"version": CACHE_VERSION, "files": self.entries}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def inputHash(self, filePath: str) -> str:
+        """ hash of the template, its side files, the folder's local.vars
+        and the salt.  Templates whose vars mention date keys are
+        relative to now so the current hour is part of their hash """
+        m = hashlib.md5()
+        m.update(self.salt.encode("utf-8"))
+        paths = [filePath + suffix for suffix in INPUT_SUFFIXES] + \
+            [os.path.join(os.path.dirname(filePath), "local.vars")]
+        dateRelative = "yyyy" in self.salt
+        for path in paths:
+            m.update(path.encode("utf-8"))
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                content = b"\0missing"
+            if path != filePath and b"yyyy" in content:
+                dateRelative = True
+            m.update(hashlib.md5(content).digest())
+        if dateRelative:
+            m.update(datetime.now().strftime("%Y%m%d%H").encode("utf-8"))
+        return m.hexdigest()
+
+    def get(self, filePath: str, inputHash: str) -> list:
+        """ the LinkSpecs rendered from filePath or None if its inputs
+        have changed """
+        entry = self.entries.get(filePath)
+        if not entry or entry["hash"] != inputHash:
+            return None
+        return [LinkSpec(**spec) for spec in entry["specs"]]
+
+    def put(self, filePath: str, inputHash: str, specs: list):
+        self.entries[filePath] = {"hash": inputHash,
+                                  "specs": [vars(spec) for spec in specs],
+                                  "graph": None, "edges": {}}
+        self.dirty = True
+
+    def getEdges(self, filePath: str, graphHash: str) -> dict:
+        """ edges of the resources of filePath if they were linked
+        within the same graph, see linkHash """
+        entry = self.entries.get(filePath)
+        if not entry or entry["graph"] != graphHash:
+            return None
+        return {key: set(deps) for key, deps in entry["edges"].items()}
+
+    def putEdges(self, filePath: str, graphHash: str, edges: dict):
+        entry = self.entries[filePath]
+        entry["graph"] = graphHash
+        entry["edges"] = {key: sorted(deps) for key, deps in edges.items()}
+        self.dirty = True
+
+    def retain(self, filePaths: list):
+        """ forget files which are no longer loaded """
+        for filePath in set(self.entries.keys()) - set(filePaths):
+            del self.entries[filePath]
+            self.dirty = True
+
+
+def linkHash(specs) -> str:
+    """ hash of what the edges of any resource may depend on besides its
+    own LinkSpec: the keys of all resources, which are datasets and where
+    extracts write to """
+    m = hashlib.md5()
+    for spec in sorted(specs, key=lambda s: s.key):
+        m.update(json.dumps([spec.key, spec.isDataset,
+                             spec.extractUris]).encode("utf-8"))
+    return m.hexdigest()
@@ -0,0 +1,211 @@
+import asyncio
+import queue
+from time import time
+
+
+# how JobWatcher learns a job is done
+CALLBACK = "callback"
+TRACKED = "tracked"
+POLLED = "polled"
+
+
+class AdaptiveInterval:
+    """ Seconds to wait before checking on a job again.  Jobs near their
+    end are checked often and long ones rarely: the wait is half the time
+    the job is estimated to have left, from the progress of its query
+    plan or how long the resource took before, else a quarter of the time
+    it has run.  Waits double while the slot time of a query doesn't grow
+    i.e. it is queued.
+    """
+
+    def __init__(self, minimum: float = 1.0, maximum: float = 60.0,
+                 expected=None):
+        """
+        :param expected: expected(key) the seconds the resource keyed
+        key took before or None, i.e. RunHistory.durations.get
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.expected = expected
+        self.slotMillis = {}
+
+    def left(self, key: str, job, elapsed: float) -> float:
+        """ seconds job is estimated to have left, None if unknown """
+        progress = queryProgress(job)
+        if progress:
+            return elapsed * (1 - progress) / progress
+        expected = self.expected and self.expected(key)
+        if expected and expected > elapsed:
+            return expected - elapsed
+        return None
+
+    def __call__(self, key: str, job, elapsed: float) -> float:
+        left = self.left(key, job, elapsed)
+        interval = elapsed / 4 if left is None else left / 2
+        slotMillis = getattr(job, "slot_millis", None)
+        if slotMillis is not None:
+            if self.slotMillis.get(key) == slotMillis:
+                interval *= 2
+            self.slotMillis[key] = slotMillis
+        return min(self.maximum, max(self.minimum, interval))
+
+
+def queryProgress(job) -> float:
+    """ the share of the inputs of the stages of job's query plan which
+    are done, None without a plan """
+    stages = getattr(job, "query_plan", None) or []
+    total = sum([stage.parallel_inputs or 0 for stage in stages])
+    if not total:
+        return None
+    done = sum([stage.completed_parallel_inputs or 0 for stage in stages])
+    return min(1.0, done / total)
+
+
+class JobWatcher:
+    """ Tells DependencyExecutor when the job of a running resource is
+    done so that its dependants start at once instead of after a fixed
+    sleep.
+
+    Jobs are watched with add_done_callback or, given a tracker, with
+    one resource.JobTracker refresh of all jobs once any is due.  Those
+    which can not call back are checked when due and those which can are
+    checked every recheckFactor * checkFrequency seconds anyway in case
+    their polling thread gave up.  Jobs are due every checkFrequency
+    seconds or, given interval, every interval(key, job, seconds watched)
+    seconds, see AdaptiveInterval.
+    """
+
+    def __init__(self, checkFrequency: float, recheckFactor: int = 6,
+                 tracker=None, interval=None):
+        self.checkFrequency = checkFrequency
+        self.recheckAfter = checkFrequency * recheckFactor
+        self.tracker = tracker
+        self.interval = interval
+        self.events = queue.Queue()
+        self.watched = {}
+        # id of each job called back for to the job, how and when first
+        # watched.  Each job is only ever given one callback
+        self.hooked = {}
+        self.refreshes = 0
+
+    def intervalOf(self, key: str, job, first: float) -> float:
+        if not self.interval:
+            return self.checkFrequency
+        return self.interval(key, job, time() - first)
+
+    def watch(self, key: str, job):
+        """ key is running job.  key will be returned by wait once job
+        is done or it is time to check on it """
+        hooked = self.hooked.get(id(job))
+        if not hooked or hooked[0] is not job:
+            if self.tracker and self.tracker.canTrack(job):
+                self.tracker.track(job, lambda job: self.events.put(key))
+                how = TRACKED
+            elif hasattr(job, "add_done_callback"):
+                job.add_done_callback(lambda future: self.events.put(key))
+                how = CALLBACK
+            else:
+                how = POLLED
+            hooked = self.hooked[id(job)] = (job, how, time())
+        (_, how, first) = hooked
+
+        if how == CALLBACK:
+            due = time() + self.recheckAfter
+        else:
+            due = time() + self.intervalOf(key, job, first)
+        self.watched[key] = [job, how, due, first]
+
+    def nextCheck(self) -> float:
+        """ seconds until a watched job is due to be checked """
+        due = [due for (job, how, due, first) in self.watched.values()]
+        if not due:
+            return self.checkFrequency
+        return max(0, min(due) - time())
+
+    def wait(self, timeout: float = None) -> set:
+        """ blocks until at least one watched job is done or due to be
+        checked, or for at most timeout seconds if given.
+
+        :return: watched keys to evaluate again.  They are no longer
+        watched.  Call backs for keys which aren't watched, i.e. of jobs
+        which were found done already, are dropped
+        """
+        keys = set()
+        try:
+            wait = self.nextCheck()
+            if timeout is not None:
+                wait = min(wait, timeout)
+            keys.add(self.events.get(timeout=wait))
+        except queue.Empty:
+            pass
+
+        now = time()
+        tracked = [key for (key, (job, how, due, first)) in self.watched.items()
+                   if how == TRACKED]
+        if [key for key in tracked if self.watched[key][2] <= now]:
+            self.tracker.refresh()
+            self.refreshes += 1
+            for key in tracked:
+                (job, how, due, first) = self.watched[key]
+                self.watched[key][2] = time() + self.intervalOf(key, job, first)
+        try:
+            while True:
+                keys.add(self.events.get_nowait())
+        except queue.Empty:
+            pass
+
+        for key, (job, how, due, first) in self.watched.items():
+            if how != TRACKED and now >= due:
+                keys.add(key)
+
+        keys = set([key for key in keys if key in self.watched])
+        for key in keys:
+            self.watched.pop(key, None)
+        return keys
+
+
+async def waitForJob(job, checkFrequency: float, recheckFactor: int = 6,
+                     tracker=None, interval: float = None):
+    """ asyncio counterpart of JobWatcher.  Returns once job is done or
+    it is time to check on it, the same intervals as JobWatcher.  Jobs
+    given to tracker are done once refreshTracker finds them done.
+
+    :param interval: seconds before jobs which can't call back are
+    checked, checkFrequency if None
+    """
+    tracked = tracker and tracker.canTrack(job)
+    if not tracked and not hasattr(job, "add_done_callback"):
+        await asyncio.sleep(interval or checkFrequency)
+        return
+
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def setDone():
+        if not done.done():
+            done.set_result(None)
+
+    def wake(*args):
+        try:
+            loop.call_soon_threadsafe(setDone)
+        except RuntimeError:
+            # the run ended, i.e. on an error, before the job did
+            pass
+
+    if tracked:
+        tracker.track(job, wake)
+    else:
+        job.add_done_callback(wake)
+    try:
+        await asyncio.wait_for(done, checkFrequency * recheckFactor)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def refreshTracker(tracker, interval):
+    """ refreshes the jobs of tracker every interval() seconds until
+    cancelled """
+    while True:
+        await asyncio.sleep(interval())
+        if tracker.jobs:
+            await asyncio.to_thread(tracker.refresh)
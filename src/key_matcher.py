@@ -0,0 +1,61 @@
+from collections import deque
+
+
+class KeyMatcher:
+    """ Aho-Corasick automaton over a set of patterns.  Built once, it
+    reports every pattern found in a text with a single pass over that
+    text i.e. O(len(text) + matches) no matter how many patterns there
+    are.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str):
+        state = 0
+        for ch in pattern:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+                self.goto[state][ch] = nxt
+            state = nxt
+        if pattern not in self.out[state]:
+            self.out[state] = self.out[state] + (pattern,)
+
+    def _link(self):
+        """ breadth first so the fail state of a parent is final before
+        its children are linked """
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(ch, 0)
+                self.fail[nxt] = fail
+                self.out[nxt] = self.out[nxt] + self.out[fail]
+
+    def findAll(self, text: str) -> set:
+        """ the set of patterns which occur in text """
+        found = set()
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
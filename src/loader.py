@@ -1,13 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor
 from json.decoder import JSONDecodeError
 
+import functools
 import json
-import yaml
 from yaml import YAMLError
 from google.cloud.bigquery import WriteDisposition, QueryJobConfig, Dataset
 from google.cloud.bigquery.client import Client
 from google.cloud.bigquery.schema import SchemaField
 from google.cloud.bigquery.table import Table
 from os.path import getmtime
+from datetime import datetime
 import os
 from enum import Enum
 from google.cloud import storage, bigquery
@@ -19,8 +21,9 @@ from resource import Resource, _buildDataSetKey_, BqDatasetBackedResource, \
     BqJobs, BqQueryBackedTableResource, _buildDataSetTableKey_, \
     BqViewBackedTableResource, BqDataLoadTableResource, \
     BqExtractTableResource, BqGcsTableLoadResource, BqProcessTableResource
-from tmplhelper import evalTmplRecurse, explodeTemplate
+from tmplhelper import evalTmplRecurse, iterExplodeTemplate
 from date_formatter_helper import helpers
+from parse_cache import files, parseYaml
 
 
 class FileLoader:
@@ -32,6 +35,12 @@ class FileLoader:
         which it handles from the file arg """
         pass
 
+    def render(self, file):
+        """ Optionally, the part of load which needs no client and
+        is worth doing in another process.  Whatever is returned here
+        must be picklable and is handed back to load as rendered """
+        return None
+
     def handles(self, file) -> bool:
         """ Given a file, the resource should answer true or false
         whether or not this loader can handle loading that file
@@ -50,7 +59,16 @@ class DelegatingFileSuffixLoader(FileLoader):
                 raise ValueError("args must be subclass of FileLoader")
             self.loaders = kwargs
 
-    def load(self, file, dryrun):
+    def load(self, file, dryrun, rendered=None):
+        loader = self.loaderFor(file)
+        if rendered is None:
+            return loader.load(file, dryrun)
+        return loader.load(file, dryrun, rendered)
+
+    def render(self, file):
+        return self.loaderFor(file).render(file)
+
+    def loaderFor(self, file) -> FileLoader:
         suffixParts = file.split("/")[-1].split(".")
         if len(suffixParts) == 1:
             raise ValueError(file +
@@ -58,7 +76,7 @@ class DelegatingFileSuffixLoader(FileLoader):
                              str(self.loaders.keys()) + " to be processed"
                              )
         try:
-            return self.loaders[suffixParts[-1]].load(file, dryrun)
+            return self.loaders[suffixParts[-1]]
         except KeyError:
             raise ValueError("No loader associated with suffix: " +
                              suffixParts[-1])
@@ -137,7 +155,7 @@ def load_query_job_config(table, jobconfigpath, templatevars):
     with open(jobconfigpath, 'r') as f:
         try:
             # first as yaml
-            obj = yaml.safe_load(f.read().format(**templatevars))
+            obj = parseYaml(f.read().format(**templatevars))
             job_config = QueryJobConfig.from_api_repr(obj)
             if templatevars.get(IS_SCRIPT_KEY, False) is False:
                 job_config.destination = table
@@ -197,7 +215,6 @@ class BqQueryTemplatingFileLoader(FileLoader):
         self.bqJobs = bqJobs
         self.datasets = {}
         self.tableType = tableType
-        self.cachedFileLoads = {}
         if not self.tableType or self.tableType not in TableType:
             raise Exception("TableType must be set")
 
@@ -206,7 +223,16 @@ class BqQueryTemplatingFileLoader(FileLoader):
                                  filename: str,
                                  localVars: dict,
                                  defaultVars: dict):
-        ret = []
+        return list(BqQueryTemplatingFileLoader.iterTemplateVarsArray(
+            rawTemplates, folder, filename, localVars, defaultVars))
+
+    def iterTemplateVarsArray(rawTemplates: list,
+                              folder: str,
+                              filename: str,
+                              localVars: dict,
+                              defaultVars: dict):
+        """ explodeTemplateVarsArray one expansion at a time """
+        now = datetime.now()
         for t in rawTemplates:
             copy = t.copy()
             copy['folder'] = folder
@@ -216,21 +242,12 @@ class BqQueryTemplatingFileLoader(FileLoader):
 
             copy = {**defaultVars, **localVars, **copy}
 
-            ret += [evalTmplRecurse(t) for t in explodeTemplate(copy)]
-
-        return ret
-
-    def cached_file_read(self, file):
-        if file in self.cachedFileLoads:
-            return self.cachedFileLoads[file]
-        else:
-            with open(file) as filestr:
-                filestr = filestr.read()
-            self.cachedFileLoads[file] = filestr
-            return filestr
+            for exploded in iterExplodeTemplate(copy, now):
+                yield evalTmplRecurse(exploded)
 
     def processTemplateVar(self, templateVars: dict, template: str,
-                           filePath: str, mtime: int, out: dict, dryrun=False):
+                           filePath: str, mtime: int, out: dict, dryrun=False,
+                           query: str = None):
         """
 
         :param templateVars: These are the variables which will be used
@@ -243,6 +260,7 @@ class BqQueryTemplatingFileLoader(FileLoader):
         during method execution will be stored.  Duplicate tables
         generated is considered an error and will raise Exception.
         Datasets are ok.
+        :param query: template already formatted with templateVars
         :return: void
         """
         templateVarsCopy = templateVars.copy()
@@ -258,7 +276,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
             raise Exception("Please define values for " +
                             missing + " in a file: ",
                             filePath + ".vars")
-        query = template.format(**templateVars)
+        if query is None:
+            query = tmplhelper.compileTemplate(template).format(templateVars)
         legacySql = "#legacysql" in query.lower()
 
         table = templateVars['table']
@@ -322,6 +341,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
                                              templateVars['extract'],
                                              templateVars)
                 out[extractRsrc.key()] = extractRsrc
+                if templateVars.get("pool"):
+                    extractRsrc.pool = str(templateVars["pool"])
         elif self.tableType == TableType.VIEW:
             arsrc = BqViewBackedTableResource([query], bqTable,
                                               self.bqClient)
@@ -337,8 +358,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 raise Exception("source_format not found in template vars")
 
             if templateVars["source_format"] not in set(["PARQUET", "ORC"]):
-                schemaFileStr = self.cached_file_read(filePath + ".schema")
-                schema = loadSchemaFromString(schemaFileStr.strip())
+                schema = files.loadSchema(filePath + ".schema",
+                                          loadSchemaFromString)
                 templateVars["schema"] = schema
 
             rsrc = BqGcsTableLoadResource(bqTable,
@@ -387,10 +408,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
             jT = None
             if not dryrun:
                 jT = self.bqJobs.getJobForTable(bqTable, "create")
-            stripped = self.cached_file_read(filePath + ".schema").strip()
-            schema = loadSchemaFromString(stripped)
-            # with open(filePath + ".schema") as schemaFile:
-            #     schema = loadSchemaFromString(schemaFile.read().strip())
+            schema = files.loadSchema(filePath + ".schema",
+                                      loadSchemaFromString)
             arsrc = BqProcessTableResource(query, bqTable, schema, self.bqClient, job=jT)
             out[key] = arsrc
         elif self.tableType == TableType.EXTERNAL_TABLE:
@@ -403,9 +422,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
             schema = None
             if not autodetect:
                 try:
-                    stripped = \
-                        self.cached_file_read(filePath + ".schema").strip()
-                    schema = loadSchemaFromString(stripped)
+                    schema = files.loadSchema(filePath + ".schema",
+                                              loadSchemaFromString)
                 except Exception:
                     raise Exception("Please provide a .schema "
                                     "file for your external table. " +
@@ -418,6 +436,9 @@ class BqQueryTemplatingFileLoader(FileLoader):
                                                  ext_config)
             out[key] = arsrc
 
+        if templateVars.get("pool") and key in out:
+            out[key].pool = str(templateVars["pool"])
+
         dsetKey = _buildDataSetKey_(bqTable)
         if dsetKey not in out:
             out[dsetKey] = bqDataset
@@ -428,57 +449,85 @@ class BqQueryTemplatingFileLoader(FileLoader):
             raise Exception("Templating generated duplicate "
                             "tables outputs for " + filePath)
 
-    def load(self, filePath, dryrun):
-        mtime = getmtime(filePath)
-        ret = {}
+    def render(self, filePath):
+        """ reads the template and explodes its vars.
+
+        :return: the template and a list of (templateVars, query) where
+        query is the template formatted with templateVars or None when
+        formatting is better left to processTemplateVar, i.e. to raise
+        its errors
+        """
         with open(filePath) as f:
             template = f.read()
-            try:
-                filename = filePath.split("/")[-1].split(".")[-2]
-                localVarsPath = os.path.join(os.path.dirname(filePath), "local.vars")
-                folder = filePath.split("/")[-2]
-                templateVars = \
-                    BqQueryTemplatingFileLoader.explodeTemplateVarsArray(
-                        self.loadTemplateVars(filePath + ".vars"),
-                        folder,
-                        filename,
-                        self.loadLocalVars(localVarsPath),
-                        self.defaultVars
-                    )
-
-            except FileNotFoundError:
-                raise Exception("Please define template vars in a file "
-                                "called " + filePath + ".vars")
-            for v in templateVars:
-                self.processTemplateVar(v, template, filePath, mtime, ret, dryrun)
+        return (template, list(self.iterRender(template, filePath)))
+
+    def iterRender(self, template: str, filePath: str):
+        """ the (templateVars, query) pairs of render one at a time """
+        try:
+            filename = filePath.split("/")[-1].split(".")[-2]
+            localVarsPath = os.path.join(os.path.dirname(filePath), "local.vars")
+            folder = filePath.split("/")[-2]
+            rawTemplates = self.loadTemplateVars(filePath + ".vars")
+            localVars = self.loadLocalVars(localVarsPath)
+        except FileNotFoundError:
+            raise Exception("Please define template vars in a file "
+                            "called " + filePath + ".vars")
+
+        needed = tmplhelper.keysOfTemplate(template)
+        for v in BqQueryTemplatingFileLoader.iterTemplateVarsArray(
+                rawTemplates, folder, filename, localVars, self.defaultVars):
+            query = None
+            if 'dataset' in v and needed.issubset(v.keys()):
+                try:
+                    query = tmplhelper.compileTemplate(template).format(v)
+                except Exception:
+                    pass
+            yield (v, query)
+
+    def load(self, filePath, dryrun, rendered=None):
+        mtime = getmtime(filePath)
+        ret = {}
+        if rendered:
+            (template, templateVars) = rendered
+        else:
+            with open(filePath) as f:
+                template = f.read()
+            templateVars = self.iterRender(template, filePath)
+        for (v, query) in templateVars:
+            self.processTemplateVar(v, template, filePath, mtime, ret, dryrun,
+                                    query=query)
         return ret.values()
 
+    def __getstate__(self):
+        """ clients stay behind when pickled for render workers """
+        state = self.__dict__.copy()
+        state.update(bqClient=None, gcsClient=None, bqJobs=None, datasets={})
+        return state
+
     def loadLocalVars(self, filePath):
         local_vars = dict()
         if filePath \
             and os.path.exists(filePath) \
                 and os.path.isfile(filePath):
-            with open(filePath) as f:
-                local_vars = yaml.safe_load(f)
-                if not isinstance(local_vars, dict):
-                    raise Exception(
-                        "Must be single json or yaml object in "
-                        + filePath)
+            local_vars = files.loadYaml(filePath)
+            if not isinstance(local_vars, dict):
+                raise Exception(
+                    "Must be single json or yaml object in "
+                    + filePath)
         return local_vars
 
     def loadTemplateVars(self, filePath) -> list:
         try:
-            with open(filePath) as f:
-                template_vars_list = yaml.safe_load(f)
-                if not isinstance(template_vars_list, list):
+            template_vars_list = files.loadYaml(filePath)
+            if not isinstance(template_vars_list, list):
+                raise Exception(
+                    "Must be json or yaml list of objects in " + filePath)
+            for definition in template_vars_list:
+                if not isinstance(definition, dict):
                     raise Exception(
-                        "Must be json or yaml list of objects in " + filePath)
-                for definition in template_vars_list:
-                    if not isinstance(definition, dict):
-                        raise Exception(
-                            "Must be json list of objects in " + filePath)
+                        "Must be json list of objects in " + filePath)
 
-                return template_vars_list
+            return template_vars_list
         except FileNotFoundError:
             return [{}]
         except (JSONDecodeError, YAMLError) as e:
@@ -495,14 +544,18 @@ class BqDataFileLoader(FileLoader):
         self.datasets = {}
         self.bqJobs = bqJobs
 
-    def load(self, filePath, dryrun=False):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(bqClient=None, bqJobs=None, datasets={})
+        return state
+
+    def load(self, filePath, dryrun=False, rendered=None):
         mtime = getmtime(filePath)
         schemaFilePath = filePath + ".schema"
         mtime_schema = getmtime(schemaFilePath)
         mtime = max([mtime, mtime_schema])
 
-        with open(schemaFilePath) as schemaFile:
-            schema = loadSchemaFromString(schemaFile.read().strip())
+        schema = files.loadSchema(schemaFilePath, loadSchemaFromString)
 
         jT = None
         if dryrun:
@@ -530,6 +583,33 @@ class BqDataFileLoader(FileLoader):
         return ret
 
 
+_renderLoader = None
+
+
+def _initRenderWorker(fileLoader: FileLoader, dateHelpers=None):
+    global _renderLoader
+    _renderLoader = fileLoader
+    if dateHelpers:
+        helpers.seed(dateHelpers)
+
+
+def _renderFile(filePath: str):
+    return _renderLoader.render(filePath)
+
+
+def renderFiles(fileLoader: FileLoader, files: list, workers: int) -> list:
+    """ fileLoader.render of each of files, fanned out to a pool of
+    worker processes.  Results are in the order of files so that loading
+    them in order is the same as loading without render workers """
+    if workers <= 1 or len(files) <= 1:
+        return [fileLoader.render(file) for file in files]
+    chunksize = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_initRenderWorker,
+                             initargs=(fileLoader, helpers)) as pool:
+        return list(pool.map(_renderFile, files, chunksize=chunksize))
+
+
 def get_dryrun_bq_dataset_table(project_dryrun, dataset_dryrun, table_dryrun):
     bqTable_dryrun = type('Table', (), {})()
     bqTable_dryrun.table_id = table_dryrun
@@ -545,12 +625,17 @@ def get_dryrun_bq_dataset_table(project_dryrun, dataset_dryrun, table_dryrun):
 def loadSchemaFromString(schema: str):
     """ only support simple schema for i.e. not json just cmd line
     like format """
+    return list(_parseSchema(schema))
 
+
+@functools.lru_cache(maxsize=256)
+def _parseSchema(schema: str) -> tuple:
+    """ loadSchemaFromString, shared by identical schemas """
     # first we try to load as json
     try:
         fields = [loadSchemaField(jsonField)
                   for jsonField in json.loads(schema)]
-        return fields
+        return tuple(fields)
     except JSONDecodeError:
         pass
 
@@ -559,7 +644,7 @@ def loadSchemaFromString(schema: str):
         for s in schema.split(","):
             (col, type) = s.split(":", maxsplit=2)
             ret.append(SchemaField(col, type))
-        return ret
+        return tuple(ret)
     except ValueError:
         raise Exception("Schema file should contain either bq "
                         "json schema definition or a string "
@@ -0,0 +1,69 @@
+import copy
+import os
+import threading
+
+import yaml
+
+# libyaml is much faster than the pure python loader when it is built in
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def parseYaml(text: str):
+    """ yaml.safe_load, with libyaml when available """
+    return yaml.load(text, Loader=YamlLoader)
+
+
+class ParseCache:
+    """ Process wide cache of files read by the loaders and of what was
+    parsed from them.  Entries are kept while the mtime and size of their
+    file are unchanged so that the many templates of a folder share one
+    parse of its local.vars and every loader shares the parse of a schema.
+
+    Parsed values are handed out as deep copies, callers may modify them.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str, parse, kind: str):
+        """
+        :param parse: parses the text of path, only called on a miss
+        :param kind: what parse makes of the text, parses of different
+        kinds are kept apart
+        :return: parse(text of path), shared with previous calls
+        """
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get((path, kind))
+            if entry and entry[0] == stamp:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        with open(path) as f:
+            value = parse(f.read())
+        with self.lock:
+            self.entries[(path, kind)] = (stamp, value)
+        return value
+
+    def read(self, path: str) -> str:
+        return self.get(path, lambda text: text, "text")
+
+    def loadYaml(self, path: str):
+        """ the yaml or json in path """
+        return copy.deepcopy(self.get(path, parseYaml, "yaml"))
+
+    def loadSchema(self, path: str, parse) -> list:
+        """ the schema fields parse makes of the stripped text of path """
+        return list(self.get(path, lambda text: parse(text.strip()), "schema"))
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+files = ParseCache()
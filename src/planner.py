@@ -0,0 +1,90 @@
+import re
+from collections import defaultdict
+
+# suffixes of --maxBytesPlanned, powers of 1024 as BigQuery bills
+BYTE_UNITS = ["B", "KB", "MB", "GB", "TB", "PB"]
+
+
+def parseBytes(text: str) -> int:
+    """ bytes of i.e. 5000, 1.5TB or 200 GiB """
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGTP]?)I?B?\s*", str(text).upper())
+    if not match:
+        raise Exception("bytes must be a number with an optional unit "
+                        "of " + ", ".join(BYTE_UNITS), text)
+    (number, unit) = match.groups()
+    try:
+        return int(float(number) * 1024 ** BYTE_UNITS.index(unit + "B"))
+    except ValueError:
+        raise Exception("bytes must be a number", text)
+
+
+def formatBytes(n: int) -> str:
+    size = float(n)
+    for unit in BYTE_UNITS:
+        if size < 1024 or unit == BYTE_UNITS[-1]:
+            break
+        size /= 1024
+    return f"{int(size)} {unit}" if unit == "B" else f"{size:.2f} {unit}"
+
+
+def datasetOf(rsrc) -> str:
+    """ the dataset:<project.dataset> pool of rsrc or else the first part
+    of its key """
+    for name in rsrc.pools():
+        if name.startswith("dataset:"):
+            return name[len("dataset:"):]
+    return rsrc.key().split(".")[0]
+
+
+class Plan:
+    """ What DependencyExecutor.execute would do: the resources it would
+    create or update, in order, and the bytes their queries would process
+    according to dry runs """
+
+    def __init__(self):
+        # key to why it would be executed, in the order execute may
+        self.reasons = {}
+        # key to the bytes its query would process
+        self.bytes = {}
+        # key to why its dry run failed
+        self.errors = {}
+        self.datasets = {}
+        self.criticalPath = []
+        self.criticalSeconds = None
+
+    def add(self, key: str, reason: str, dataset: str):
+        self.reasons[key] = reason
+        self.datasets[key] = dataset
+
+    def total(self) -> int:
+        return sum(self.bytes.values())
+
+    def perDataset(self) -> dict:
+        totals = defaultdict(int)
+        for key, n in self.bytes.items():
+            totals[self.datasets[key]] += n
+        return dict(totals)
+
+    def __str__(self):
+        lines = ["plan:"]
+        for key, reason in self.reasons.items():
+            if key in self.bytes:
+                size = formatBytes(self.bytes[key])
+            elif key in self.errors:
+                size = "unknown bytes, dry run failed: " + self.errors[key]
+            else:
+                size = "not a query"
+            lines.append(f"  would execute {key} because {reason}, {size}")
+        lines.append("bytes processed per dataset:")
+        for dataset, n in sorted(self.perDataset().items()):
+            lines.append(f"  {dataset}: {formatBytes(n)}")
+        lines.append(f"total bytes processed: {formatBytes(self.total())} "
+                     f"({self.total()}) by {len(self.bytes)} queries"
+                     + (f", {len(self.errors)} dry runs failed"
+                        if self.errors else ""))
+        if self.criticalPath:
+            estimate = "" if self.criticalSeconds is None \
+                else f", ~{round(self.criticalSeconds)} seconds"
+            lines.append(f"critical path ({len(self.criticalPath)} resources"
+                         f"{estimate}): " + " -> ".join(self.criticalPath))
+        return "\n".join(lines)
@@ -3,10 +3,13 @@ import json
 import logging
 import re
 import subprocess
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from json.decoder import JSONDecodeError
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from google.cloud import bigquery
 from google.cloud import storage
@@ -18,6 +21,9 @@ from google.cloud.bigquery.job import WriteDisposition, \
     Compression, DestinationFormat, _AsyncJob, LoadJob, ExtractJob
 from google.cloud.bigquery.table import Table, TableReference
 from google.cloud.exceptions import NotFound
+from google.api_core.exceptions import GoogleAPICallError
+
+from dependency_index import LinkSpec
 
 # max length of description allowed by biquery
 # https://cloud.google.com/bigquery/quotas - found this by updating
@@ -25,14 +31,33 @@ from google.cloud.exceptions import NotFound
 # We take 150 off the max
 MAX_DESCRIPTION_LEN = 16384
 
+# label of the jobs creating query tables, the md5 of their final query
+DEFINITION_LABEL = "bqm2-definition-hash"
+
 
 class Resource:
+    # the kind of resource, for its type: concurrency pool
+    poolType = "resource"
+    # the pool var of the template of the resource, see pools
+    pool = None
+
+    # write definition hashes into table descriptions for shouldUpdate.
+    # Off when a state_store.StateStore keeps them instead
+    describesDefinition = True
+    # set the expiration of tables found without one, see exists
+    updatesExpiration = True
+
     def exists(self):
         raise Exception("Please implement")
 
     def updateTime(self):
         raise Exception("Please implement")
 
+    def modifiedTime(self):
+        """ the datetime this resource was last modified, None if not
+        known """
+        return None
+
     def create(self):
         raise Exception("Please implement")
 
@@ -45,6 +70,51 @@ class Resource:
     def dependsOn(self, resource):
         raise Exception("Please implement")
 
+    def linkSpec(self) -> LinkSpec:
+        """ describes dependsOn for DependencyIndex.  None means
+        dependsOn is asked of every other resource """
+        return None
+
+    def currentJob(self):
+        """ the job last started to create this resource, if any """
+        return None
+
+    def invalidate(self):
+        """ forget cached metadata once this resource may have changed """
+        pass
+
+    def jobPrefix(self):
+        """ the job id prefix of the jobs creating this resource, see
+        BqJobs, if any """
+        return None
+
+    def attachJob(self, job):
+        """ adopt job, found running by BqJobs, as currentJob """
+        pass
+
+    def definitionHash(self):
+        """ hash of what this resource is built from, if shouldUpdate
+        compares one """
+        return None
+
+    def jobIsCurrent(self, job) -> bool:
+        """ False if job, found running, builds this resource from a
+        definition other than the current one """
+        return True
+
+    def dryRun(self):
+        """ bytes the job creating this resource would process, from a
+        dry run.  None if it isn't a query """
+        return None
+
+    def pools(self) -> list:
+        """ the concurrency pools the jobs of this resource count against,
+        type:<poolType> and pool:<the pool var of its template> if set """
+        names = ["type:" + self.poolType]
+        if self.pool:
+            names.append("pool:" + self.pool)
+        return names
+
     def dump(self):
         return ""
 
@@ -53,67 +123,192 @@ class Resource:
 
 
 class BqJobs:
+    """ The running and pending jobs of the project keyed by the job id
+    prefix bqm2 gives its jobs, i.e. create-<dataset>-<table>, and by the
+    table their configuration writes to or, for extracts, reads from.
+    """
     def __init__(self, bqClient: Client,
-                 tableToJobMap: dict = {},
-                 pageSize: int = 1000, page_limit: int = 1):
+                 tableToJobMap: dict = None,
+                 pageSize: int = 1000, page_limit: int = None,
+                 window: timedelta = timedelta(hours=24)):
+        """
+        :param page_limit: pages of jobs to scan per state, None for all
+        :param window: only jobs created this recently are scanned
+        """
         self.bqClient = bqClient
-        self.tableToJobMap = tableToJobMap
+        self.tableToJobMap = tableToJobMap if tableToJobMap is not None \
+            else {}
         self.page_limit = page_limit
         self.pageSize = pageSize
+        self.window = window
+        self.lock = threading.Lock()
 
     def jobs(self, state_filter=None):
         return self.bqClient.list_jobs(state_filter=state_filter)
 
-    def __loadTableJobs__(self, state):
-        logging.info("starting jobs load for ", state)
-        """ scans through 5k previous jobs and puts into
-        a map keyed by project/dataset/table/ the first job
-        encountered for that any table.
+    def __loadTableJobs__(self, state, wanted: set = None):
+        """ scans through the jobs of the window, newest first, and puts
+        into tableToJobMap the first job encountered for any table, a
+        running one over a pending one.  Stops at the first job created
+        before the window or once this scan found a job for every prefix
+        in wanted.
         """
-        jiter = self.bqClient.list_jobs(max_results=self.pageSize,
-                                        state_filter=state)
-        while True:
-            for t in jiter:
-                print("looking at: ", t.job_id)
-                jobid_prefix = build_jobid_prefix_key_from_jobid(t.job_id)
-                if not jobid_prefix:
-                    continue
-
-                if jobid_prefix in self.tableToJobMap:
-                    continue
-                print("adding key to map: ", jobid_prefix)
-                self.tableToJobMap[jobid_prefix] = t
-
-            if not jiter.next_page_token:
-                break
-            if iter.page_number > self.page_limit:
+        if wanted is not None and not wanted:
+            return
+        since = datetime.now(timezone.utc) - self.window
+        jiter = self.bqClient.list_jobs(
+            page_size=self.pageSize, state_filter=state,
+            min_creation_time=since)
+        scanned = 0
+        found = set()
+        done = False
+        for (pageNumber, page) in enumerate(jiter.pages, 1):
+            for t in page:
+                if t.created is not None and t.created < since:
+                    done = True
+                    break
+                scanned += 1
+                with self.lock:
+                    for jobid_prefix in jobid_prefixes_of_job(t):
+                        found.add(jobid_prefix)
+                        current = self.tableToJobMap.get(jobid_prefix)
+                        if current is None or (t.state == "RUNNING"
+                                               and current.state != "RUNNING"):
+                            self.tableToJobMap[jobid_prefix] = t
+                done = wanted is not None and wanted.issubset(found)
+                if done:
+                    break
+            if done or (self.page_limit and pageNumber >= self.page_limit):
                 break
-            jiter = self.bqClient.list_jobs(max_results=self.pageSize,
-                                            page_token=jiter.next_page_token,
-                                            state_filter=state)
-        print("finished jobs load for ", state)
+        print(f"scanned {scanned} {state} jobs")
 
-    def loadTableJobs(self):
-        [self.__loadTableJobs__(state) for state in ['running', 'pending']]
+    def loadTableJobs(self, wanted: set = None):
+        """
+        :param wanted: prefixes of the managed tables, see jobPrefix.
+        None scans every job of the window
+        """
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(lambda state: self.__loadTableJobs__(state, wanted),
+                          ['running', 'pending']))
+
+    def getJob(self, jobid_prefix: str):
+        return self.tableToJobMap.get(jobid_prefix)
 
     def getJobForTable(self, table: Table, type: str):
-        key = build_jobid_prefix_from_type_and_table(type, table)
-        if key in self.tableToJobMap:
-            return self.tableToJobMap[key]
-        return None
+        return self.getJob(build_jobid_prefix_from_type_and_table(type, table))
+
+
+# ids of the jobs a JobTracker refreshed since isJobRunning last looked
+refreshedJobs = set()
+
+
+class JobTracker:
+    """ Refreshes the state of every job being waited for with a few
+    pages of list_jobs per tick rather than a reload of each job.  Jobs
+    still running or pending are updated in place from the listing.  Jobs
+    no longer listed are done and reloaded once, for their errors, before
+    their callbacks are called.
+    """
+
+    def __init__(self, bqClient: Client, since: datetime,
+                 pageSize: int = 1000):
+        """
+        :param since: jobs are listed from then on unless a tracked job
+        was created earlier, i.e. the start of the run
+        """
+        self.bqClient = bqClient
+        self.since = since
+        self.pageSize = pageSize
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.lastRefresh = 0
+        self.calls = 0
+
+    def canTrack(self, job) -> bool:
+        return hasattr(job, "job_id") and hasattr(job, "_set_properties")
+
+    def track(self, job, callback):
+        """ callback(job) is called by refresh once job is done """
+        with self.lock:
+            (_, callbacks) = self.jobs.setdefault(job.job_id, (job, []))
+            callbacks.append(callback)
+
+    def refresh(self):
+        with self.lock:
+            tracked = dict(self.jobs)
+        if not tracked:
+            return
+        created = [job.created for (job, _) in tracked.values()
+                   if job.created]
+        since = min(created + [self.since])
+        listed = {}
+        for state in ["running", "pending"]:
+            jiter = self.bqClient.list_jobs(page_size=self.pageSize,
+                                            state_filter=state,
+                                            min_creation_time=since)
+            for page in jiter.pages:
+                self.calls += 1
+                for job in page:
+                    listed[job.job_id] = job
+
+        done = []
+        for (jobId, (job, callbacks)) in tracked.items():
+            if jobId in listed:
+                job._set_properties(listed[jobId]._properties)
+            else:
+                job.reload()
+                self.calls += 1
+            refreshedJobs.add(jobId)
+            if job.done(reload=False):
+                done.append((job, callbacks))
+        with self.lock:
+            for (job, _) in done:
+                self.jobs.pop(job.job_id, None)
+        self.lastRefresh = time.time()
+        for (job, callbacks) in done:
+            for callback in callbacks:
+                callback(job)
 
 
 def build_jobid_prefix_from_type_and_table(type: str, table: Table):
     return "-".join([type, table.dataset_id, table.table_id])
 
 
+# the uuid4 makeJobName ends job ids with
+JOBID_UUID = re.compile("-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
 def build_jobid_prefix_key_from_jobid(jobid: str):
+    """ <type>-<dataset>-<table> of a job id made by makeJobName.  Table
+    names may have dashes so we strip the uuid rather than keep the first
+    three parts, unless there is no uuid """
+    uuidMatch = JOBID_UUID.search(jobid)
+    if uuidMatch and len(jobid[:uuidMatch.start()].split("-")) >= 3:
+        return jobid[:uuidMatch.start()]
     parts = jobid.split("-")
     if len(parts) >= 3:
         return "-".join(parts[:3])
     return None
 
 
+def jobid_prefixes_of_job(job) -> list:
+    """ prefixes under which BqJobs finds job: its job id's and that
+    of the table its configuration writes to or extracts from """
+    prefixes = []
+    jobid_prefix = build_jobid_prefix_key_from_jobid(job.job_id)
+    if jobid_prefix:
+        prefixes.append(jobid_prefix)
+    if isinstance(job, ExtractJob):
+        table = job.source
+        jobType = "extract"
+    else:
+        table = getattr(job, "destination", None)
+        jobType = "create"
+    if table is not None and hasattr(table, "table_id"):
+        prefixes.append(build_jobid_prefix_from_type_and_table(jobType, table))
+    return prefixes
+
+
 def _buildFullyQualifiedTableName_(table: Table) -> str:
     return "{}.{}.{}".format(table.project, table.dataset_id, table.table_id)
 
@@ -138,39 +333,153 @@ class BqTables:
     """ Basically a helper class whose purpose is
     to speed up the answer to questions such as
     does table x or view x exist and when was it updated.
-    We lazily load the tables by waiting for a request for a table.
-    Then we load that dataset of tables """
-    def __init__(self, bqClient: Client):
+
+    Keeps a snapshot of the metadata of each table asked about so that
+    exists, shouldUpdate and updateTime of a resource cost at most one
+    get_table between invalidations.  Resources invalidate their table
+    once they have changed it, i.e. when their job is done.
+
+    prefetch fills the snapshot for whole datasets with one query each.
+    Tables of a prefetched dataset which the query did not return do not
+    exist, unless they were invalidated since.
+    """
+    def __init__(self, bqClient: Client = None):
         self.bqClient = bqClient
-        self.datasetTableMap = {}  # a map to of tables
+        self.datasetTableMap = {}  # prefetched "project.dataset" to table ids
+        self.snapshot = {}  # fully qualified table name to Table or None
+        self.stale = set()  # invalidated since their dataset was prefetched
+        self.lock = threading.Lock()
+        self.getTableCalls = 0
+        self.prefetchQueries = 0
+
+    def get(self, bqClient: Client, table: Table) -> Table:
+        """ get_table from the snapshot.  Raises NotFound, also from the
+        snapshot, as get_table would """
+        key = _buildFullyQualifiedTableName_(table)
+        dsetKey = _dsetkey_(table)
+        with self.lock:
+            found = key in self.snapshot
+            current = self.snapshot.get(key)
+            if not found and dsetKey in self.datasetTableMap \
+                    and key not in self.stale:
+                found = True
+                self.snapshot[key] = None
+        if not found:
+            try:
+                current = bqClient.get_table(table)
+            except NotFound:
+                current = None
+            with self.lock:
+                self.getTableCalls += 1
+                self.snapshot[key] = current
+        if current is None:
+            raise NotFound(f"Not found: Table {key}")
+        return current
+
+    def tableExists(self, bqClient: Client, table: Table) -> bool:
+        try:
+            self.get(bqClient, table)
+            return True
+        except NotFound:
+            return False
 
-    def exists(self, bqTable: Table):
-        return bqTable.exists()
+    def invalidate(self, table: Table):
+        key = _buildFullyQualifiedTableName_(table)
+        with self.lock:
+            self.snapshot.pop(key, None)
+            self.stale.add(key)
+
+    def clear(self):
+        with self.lock:
+            self.snapshot.clear()
+            self.datasetTableMap.clear()
+            self.stale.clear()
+
+    def prefetch(self, bqClient: Client, tables, workers: int = 8):
+        """ load the metadata of every table in the datasets of tables.
+        Datasets which can't be queried, i.e. they don't exist yet, are
+        left to get_table """
+        datasets = sorted(set([(t.project, t.dataset_id) for t in tables]))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            listed = list(pool.map(
+                lambda dataset: self._listDataset_(bqClient, *dataset),
+                datasets))
+        for (project, dataset), found in zip(datasets, listed):
+            if found is None:
+                continue
+            with self.lock:
+                self.datasetTableMap[f"{project}.{dataset}"] = \
+                    set([t.table_id for t in found])
+                for t in found:
+                    key = _buildFullyQualifiedTableName_(t)
+                    self.snapshot[key] = t
+                    self.stale.discard(key)
+        print(f"prefetched metadata of {sum([len(f) for f in listed if f])} "
+              f"tables in {len([f for f in listed if f is not None])} "
+              f"of {len(datasets)} datasets")
+
+    def _listDataset_(self, bqClient: Client, project: str, dataset: str):
+        """ Tables of a dataset with the metadata resources read, from
+        __TABLES__ and INFORMATION_SCHEMA.TABLE_OPTIONS.  Tables whose
+        options can't be decoded are left out and marked stale so they
+        are left to get_table """
+        query = PREFETCH_QUERY.format(dataset=f"{project}.{dataset}")
+        with self.lock:
+            self.prefetchQueries += 1
+        try:
+            rows = list(bqClient.query(query).result())
+        except GoogleAPICallError as e:
+            print(f"not prefetching {project}.{dataset}: {e}")
+            return None
 
-    def _dsetkey_(self, table: Table) -> str:
-        return _buildDataSetKey_(table)
+        found = []
+        for row in rows:
+            resource = {
+                "tableReference": {"projectId": project,
+                                   "datasetId": dataset,
+                                   "tableId": row["table_id"]},
+                "type": TABLE_TYPES.get(row["type"], "TABLE"),
+                "creationTime": str(row["creation_time"]),
+                "lastModifiedTime": str(row["last_modified_time"]),
+            }
+            try:
+                if row["description"] is not None:
+                    resource["description"] = json.loads(row["description"])
+                if row["expiration"] is not None:
+                    expires = re.match('^TIMESTAMP "(.*)"$', row["expiration"])
+                    expires = datetime.fromisoformat(
+                        expires.group(1).replace("Z", "+00:00"))
+                    resource["expirationTime"] = \
+                        str(int(expires.timestamp() * 1000))
+            except (ValueError, AttributeError):
+                with self.lock:
+                    self.stale.add(f"{project}.{dataset}.{row['table_id']}")
+                continue
+            found.append(Table.from_api_repr(resource))
+        return found
+
+
+def _dsetkey_(table: Table) -> str:
+    return f"{table.project}.{table.dataset_id}"
+
+
+# table types of __TABLES__ as in the table resource of the api
+TABLE_TYPES = {1: "TABLE", 2: "VIEW", 3: "EXTERNAL"}
+
+# metadata of all tables of a dataset which resources read
+PREFETCH_QUERY = """
+select t.table_id, t.type, t.creation_time, t.last_modified_time,
+  d.option_value as description, e.option_value as expiration
+from `{dataset}.__TABLES__` t
+left join `{dataset}.INFORMATION_SCHEMA.TABLE_OPTIONS` d
+  on d.table_name = t.table_id and d.option_name = 'description'
+left join `{dataset}.INFORMATION_SCHEMA.TABLE_OPTIONS` e
+  on e.table_name = t.table_id and e.option_name = 'expiration_timestamp'
+"""
 
-    def _get_table_(self, table: Table):
-        key = self.__dsetkey_(table)
-        if key in self.datasetTableMap:
-            dsetMap = self.datasetTableMap[key]
-            if table.table_id in dsetMap:
-                return dsetMap[table.table_id]
-            else:
-                return None
-        else:  # load dataset
-            iter = self.bqClient.dataset(table.dataset_id).list_tables()
-            dsetMap = {}
-            self.datasetTableMap[key] = dsetMap
-            while True:
-                for t in iter:
-                    dsetMap[t.name] = t
-                if not iter.next_page_token:
-                    break
-            if table.friendly_name in dsetMap:
-                return table
-            else:
-                return None
+
+# the table metadata snapshot every resource consults
+tables = BqTables()
 
 
 class BqDatasetBackedResource(Resource):
@@ -178,6 +487,8 @@ class BqDatasetBackedResource(Resource):
      todo: maybe helpful to allow users to specify attributes
      of the dataset such as ttl of tables exist
     """
+    poolType = "dataset"
+
     def __init__(self, dataset: Dataset,
                  bqClient: Client):
         self.bqClient = bqClient
@@ -195,6 +506,9 @@ class BqDatasetBackedResource(Resource):
     def exists(self):
         return self.existFlag
 
+    def modifiedTime(self):
+        return self.dataset.modified
+
     def updateTime(self):
         """ time in milliseconds.  None if not created """
         createdTime = self.dataset.modified
@@ -216,12 +530,18 @@ class BqDatasetBackedResource(Resource):
     def dependsOn(self, resource):
         return False
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), isDataset=True)
+
     def isRunning(self):
         return False
 
     def shouldUpdate(self):
         return False
 
+    def pools(self):
+        return super().pools() + ["project:" + str(self.dataset.project)]
+
     def __str__(self):
         return ":".join([self.dataset.project, self.dataset.dataset_id])
 
@@ -234,6 +554,12 @@ class BqDatasetBackedResource(Resource):
             return False
 
 
+def tablePools(table: Table) -> list:
+    """ the project: and dataset: concurrency pools of jobs on table """
+    return ["project:" + str(table.project),
+            "dataset:" + ".".join([str(table.project), table.dataset_id])]
+
+
 def makeJobName(parts: list):
     return "-".join(parts + [str(uuid.uuid4())])
 
@@ -246,21 +572,21 @@ class BqTableBasedResource(Resource):
         self.bqClient = bqClient
 
     def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return tables.tableExists(self.bqClient, self.table)
 
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
+        self.table = tables.get(self.bqClient, self.table)
         createdTime = self.table.modified
 
         if createdTime:
             return int(createdTime.strftime("%s")) * 1000
         return None
 
+    def modifiedTime(self):
+        self.table = tables.get(self.bqClient, self.table)
+        return self.table.modified
+
     def create(self):
         raise Exception("implement")
 
@@ -269,6 +595,12 @@ class BqTableBasedResource(Resource):
             self._key = f"{self.table.dataset_id}.{self.table.table_id}"
         return self._key
 
+    def invalidate(self):
+        tables.invalidate(self.table)
+
+    def pools(self):
+        return super().pools() + tablePools(self.table)
+
     def dependsOn(self, other: Resource):
         raise Exception("implement this function")
 
@@ -296,6 +628,8 @@ class BqProcessTableResource(BqTableBasedResource):
     table but we should probably treat this just like any table
     create and put it in the background
     """
+    poolType = "bash"
+
     def __init__(self, query: str, table: Table,
                  schema: tuple, bqClient: Client,
                  job: _AsyncJob):
@@ -310,22 +644,26 @@ class BqProcessTableResource(BqTableBasedResource):
             print(f"found existing job: {self.job.job_id}")
 
     def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return tables.tableExists(self.bqClient, self.table)
 
     def dependsOn(self, other: Resource):
         return self.legacyBqQueryDependsOn(other)
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), filtered=self.filteredQuery(),
+                        datasetScoped=True)
+
+    def filteredQuery(self):
+        if not hasattr(self, "filtered"):
+            self.filtered = getFiltered(self.query)
+        return self.filtered
+
     def legacyBqQueryDependsOn(self, other: Resource):
         if self == other:
             return False
 
-        if not hasattr(self, "filtered"):
-            self.filtered = getFiltered(self.query)
-        if strictSubstring("".join(["", other.key(), " "]), self.filtered):
+        if strictSubstring("".join(["", other.key(), " "]),
+                           self.filteredQuery()):
             return True
 
             # we need a better way!
@@ -342,12 +680,13 @@ class BqProcessTableResource(BqTableBasedResource):
         m.update(self.query.encode("utf-8"))
         return m.hexdigest()
 
-        return "filehash:" + generate_file_md5(self.file) + ":" + schemahash
+    def definitionHash(self):
+        return self.makeHashTag()
 
     def updateTime(self):
         """ time in milliseconds.  None if not created """
         # self.table.reload() # reload was pre-sdk update
-        self.table = self.bqClient.get_table(self.table)
+        self.table = tables.get(self.bqClient, self.table)
 
         print("created time is ", str(self.table.modified))
         createdTime = self.table.modified
@@ -357,9 +696,10 @@ class BqProcessTableResource(BqTableBasedResource):
 
             print("description is ", self.table.description)
             # hijack this step to update description - ugh - debt supreme
-            if not self.table.description:
+            if not self.table.description and self.describesDefinition:
                 self.table.description = "\n".join(["Do not edit", hashtag])
                 self.bqClient.update_table(self.table, ["description"])
+                tables.invalidate(self.table)
             return int(createdTime.strftime("%s")) * 1000
         return None
 
@@ -427,6 +767,15 @@ class BqProcessTableResource(BqTableBasedResource):
     def isRunning(self):
         return isJobRunning(self.job)
 
+    def currentJob(self):
+        return self.job
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def attachJob(self, job):
+        self.job = job
+
     def __str__(self):
         return "localdata:" + ".".join([self.table.dataset_id,
                                         self.table.table_id])
@@ -446,7 +795,7 @@ class BqProcessTableResource(BqTableBasedResource):
 
     def shouldUpdate(self):
         self.updateTime()
-        if not self.makeHashTag() in self.table.description:
+        if not self.makeHashTag() in (self.table.description or ""):
             return True
         return False
 
@@ -458,6 +807,8 @@ class BqDataLoadTableResource(BqTableBasedResource):
     """
         script for loading local data
     """
+    poolType = "localdata"
+
     def __init__(self, file: str, table: Table,
                  schema: tuple, bqClient: Client,
                  job: _AsyncJob):
@@ -472,28 +823,28 @@ class BqDataLoadTableResource(BqTableBasedResource):
             print(f"found existing job: {self.job.job_id}")
 
     def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return tables.tableExists(self.bqClient, self.table)
 
     def makeHashTag(self):
         schemahash = generate_file_md5(self.file + ".schema")
         return "filehash:" + generate_file_md5(self.file) + ":" + schemahash
 
+    def definitionHash(self):
+        return self.makeHashTag()
+
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
+        self.table = tables.get(self.bqClient, self.table)
         createdTime = self.table.modified
 
         hashtag = self.makeHashTag()
 
         if createdTime:
             # hijack this step to update description - ugh - debt supreme
-            if not self.table.description:
+            if not self.table.description and self.describesDefinition:
                 self.table.description = "\n".join(["Do not edit", hashtag])
                 self.bqClient.update_table(self.table, ["description"])
+                tables.invalidate(self.table)
             return int(createdTime.strftime("%s")) * 1000
         return None
 
@@ -535,9 +886,21 @@ class BqDataLoadTableResource(BqTableBasedResource):
     def dependsOn(self, resource: Resource):
         return self.table.dataset_id == resource.key()
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), datasetId=self.table.dataset_id)
+
     def isRunning(self):
         return isJobRunning(self.job)
 
+    def currentJob(self):
+        return self.job
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def attachJob(self, job):
+        self.job = job
+
     def __str__(self):
         return "localdata:" + ".".join([self.table.dataset_id,
                                         self.table.table_id])
@@ -557,7 +920,7 @@ class BqDataLoadTableResource(BqTableBasedResource):
 
     def shouldUpdate(self):
         self.updateTime()
-        if not self.makeHashTag() in self.table.description:
+        if not self.makeHashTag() in (self.table.description or ""):
             return True
         return False
 
@@ -641,6 +1004,8 @@ def processLoadTableOptions(options: dict):
 
 
 class BqGcsTableLoadResource(BqTableBasedResource):
+    poolType = "gcsload"
+
     # LoadTableFromStorageJob
     def __init__(self, table: Table,
                  bqClient: Client,
@@ -673,6 +1038,15 @@ class BqGcsTableLoadResource(BqTableBasedResource):
     def isRunning(self):
         return isJobRunning(self.job)
 
+    def currentJob(self):
+        return self.job
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def attachJob(self, job):
+        self.job = job
+
     def dump(self):
         return str(self.uris)
 
@@ -703,12 +1077,14 @@ class BqGcsTableLoadResource(BqTableBasedResource):
 
     def exists(self):
         try:
-            self.table = self.bqClient.get_table(self.table)
+            self.table = tables.get(self.bqClient, self.table)
             # update expiration if not set
-            if self.expiration is not None and self.table.expires is None:
+            if self.expiration is not None and self.table.expires is None \
+                    and self.updatesExpiration:
                 self.table.expires = datetime.now() + timedelta(
                     days=self.expiration)
                 self.bqClient.update_table(self.table, ['expires'])
+                tables.invalidate(self.table)
 
             return True
         except NotFound:
@@ -735,6 +1111,11 @@ class BqGcsTableLoadResource(BqTableBasedResource):
 
         return False
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), filtered=self.filteredQuery(),
+                        textSkipsExtracts=True, datasetScoped=True,
+                        uris=self.uris)
+
     def shouldUpdate(self):
         return False
 
@@ -744,14 +1125,18 @@ class BqGcsTableLoadResource(BqTableBasedResource):
         except Exception:
             return False
 
+    def filteredQuery(self):
+        if not hasattr(self, "filtered"):
+            gcsremoved = re.sub('^gs:.*$', "\n", self.query)
+            self.filtered = getFiltered(gcsremoved)
+        return self.filtered
+
     def legacyBqQueryDependsOn(self, other: Resource):
         if self == other:
             return False
 
-        if not hasattr(self, "filtered"):
-            gcsremoved = re.sub('^gs:.*$', "\n", self.query)
-            self.filtered = getFiltered(gcsremoved)
-        if strictSubstring("".join(["", other.key(), " "]), self.filtered):
+        if strictSubstring("".join(["", other.key(), " "]),
+                           self.filteredQuery()):
             return True
 
         return False
@@ -781,9 +1166,12 @@ class BqQueryBasedResource(BqTableBasedResource):
             finalQuery.encode("utf-8")).hexdigest()
         return md5hash
 
+    def definitionHash(self):
+        return self.makeQueryHashTag()
+
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
+        self.table = tables.get(self.bqClient, self.table)
 
         createdTime = self.table.modified
 
@@ -791,7 +1179,7 @@ class BqQueryBasedResource(BqTableBasedResource):
             # getting even more debt ridden
             final_query = self.makeFinalQuery()
             # hijack this step to update description
-            if not self.table.description:
+            if not self.table.description and self.describesDefinition:
                 # we use a create time + a missing description
                 # as a queue to update description with the state
                 # necessary to know if we should update / re-run next
@@ -813,6 +1201,7 @@ class BqQueryBasedResource(BqTableBasedResource):
                         self.table,
                         ["description"]
                         )
+                tables.invalidate(self.table)
             return int(createdTime.strftime("%s")) * 1000
         return None
 
@@ -822,16 +1211,24 @@ class BqQueryBasedResource(BqTableBasedResource):
     def dependsOn(self, other: Resource):
         return self.legacyBqQueryDependsOn(other)
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), filtered=self.filteredQuery(),
+                        datasetScoped=True)
+
     def isRunning(self):
         raise Exception("implement this function")
 
+    def filteredQuery(self):
+        if not hasattr(self, "filtered"):
+            self.filtered = getFiltered(self.makeFinalQuery())
+        return self.filtered
+
     def legacyBqQueryDependsOn(self, other: Resource):
         if self == other:
             return False
 
-        if not hasattr(self, "filtered"):
-            self.filtered = getFiltered(self.makeFinalQuery())
-        if strictSubstring("".join(["", other.key(), " "]), self.filtered):
+        if strictSubstring("".join(["", other.key(), " "]),
+                           self.filteredQuery()):
             return True
 
             # we need a better way!
@@ -853,7 +1250,7 @@ class BqQueryBasedResource(BqTableBasedResource):
     def shouldUpdate(self):
         self.updateTime()
 
-        if not self.makeQueryHashTag() in self.table.description:
+        if not self.makeQueryHashTag() in (self.table.description or ""):
             print("updating because query hash is not in the description")
             return True
 
@@ -861,13 +1258,10 @@ class BqQueryBasedResource(BqTableBasedResource):
 
 
 class BqViewBackedTableResource(BqQueryBasedResource):
+    poolType = "view"
 
     def tableExists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return tables.tableExists(self.bqClient, self.table)
 
     def create(self):
         try:
@@ -905,6 +1299,8 @@ def strictSubstring(contained, container):
 
 
 class BqQueryBackedTableResource(BqQueryBasedResource):
+    poolType = "query"
+
     def __init__(self, query: str, table: Table,
                  bqClient: Client, queryJob: QueryJob,
                  queryJobConfig: QueryJobConfig,
@@ -919,11 +1315,7 @@ class BqQueryBackedTableResource(BqQueryBasedResource):
         self.location = location
 
     def tableExists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return tables.tableExists(self.bqClient, self.table)
 
     def create(self):
         if self.tableExists():
@@ -934,7 +1326,7 @@ class BqQueryBackedTableResource(BqQueryBasedResource):
 
         self.queryJob = self.bqClient.query(
             self.makeFinalQuery(),
-            job_config=self.queryJobConfig,
+            job_config=self.jobConfig(),
             job_id=jobid,
             location=self.location
         )
@@ -958,6 +1350,46 @@ class BqQueryBackedTableResource(BqQueryBasedResource):
     def isRunning(self):
         return isJobRunning(self.queryJob)
 
+    def currentJob(self):
+        return self.queryJob
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def attachJob(self, job):
+        self.queryJob = job
+
+    def definitionLabel(self):
+        return self.makeQueryHashTag().split(":")[-1]
+
+    def jobConfig(self) -> QueryJobConfig:
+        """ a copy of queryJobConfig whose jobs are labelled with the
+        hash of the query, see jobIsCurrent """
+        jobConfig = QueryJobConfig.from_api_repr(
+            self.queryJobConfig.to_api_repr()) \
+            if self.queryJobConfig else QueryJobConfig()
+        jobConfig.labels = {**(jobConfig.labels or {}),
+                            DEFINITION_LABEL: self.definitionLabel()}
+        return jobConfig
+
+    def jobIsCurrent(self, job) -> bool:
+        """ compares the label of job or, for jobs started before they
+        were labelled, its query """
+        labels = getattr(job, "labels", None) or {}
+        if DEFINITION_LABEL in labels:
+            return labels[DEFINITION_LABEL] == self.definitionLabel()
+        query = getattr(job, "query", None)
+        return query is None or query == self.makeFinalQuery()
+
+    def dryRun(self):
+        jobConfig = self.jobConfig()
+        jobConfig.dry_run = True
+        jobConfig.use_query_cache = False
+        job = self.bqClient.query(self.makeFinalQuery(),
+                                  job_config=jobConfig,
+                                  location=self.location)
+        return job.total_bytes_processed or 0
+
     def dump(self):
         return self.makeFinalQuery()
 
@@ -1004,6 +1436,8 @@ def processExtractTableOptions(options: dict):
 
 
 class BqExtractTableResource(Resource):
+    poolType = "extract"
+
     def __init__(self,
                  table: Table,
                  bqClient: Client,
@@ -1041,6 +1475,18 @@ class BqExtractTableResource(Resource):
     def isRunning(self):
         return isJobRunning(self.extractJob)
 
+    def pools(self):
+        return super().pools() + tablePools(self.table)
+
+    def currentJob(self):
+        return self.extractJob
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("extract", self.table)
+
+    def attachJob(self, job):
+        self.extractJob = job
+
     def __str__(self):
         return "extract:" + ".".join([self.table.dataset_id,
                                      self.table.table_id])
@@ -1051,6 +1497,10 @@ class BqExtractTableResource(Resource):
     def dependsOn(self, other: Resource):
         return "extract." + other.key() == self.key()
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), source=self.key()[len("extract."):],
+                        extractUris=tuple(self.uris.split(",")))
+
     def dump(self):
         return ",".join(self.uris)
 
@@ -1070,7 +1520,7 @@ class BqExtractTableResource(Resource):
         return max(objs)
 
     def shouldUpdate(self):
-        self.table = self.bqClient.get_table(self.table)
+        self.table = tables.get(self.bqClient, self.table)
         createdTime = self.table.modified
         if not createdTime:
             return False
@@ -1097,13 +1547,20 @@ def isJobRunning(job):
     if not job:
         return False
 
-    job.reload()
+    refreshed = job.job_id in refreshedJobs
+    if refreshed:
+        # a JobTracker has just refreshed it
+        refreshedJobs.discard(job.job_id)
+    else:
+        job.reload()
     log_stream = sys.stdout
     job_error = job.error_result or job.errors
     if job_error is not None:
         log_stream = sys.stderr
     print(job.job_id, job.state, job_error, file=log_stream)
 
+    if refreshed:
+        return not job.done(reload=False)
     return job.running()
 
 
@@ -1170,12 +1627,17 @@ def legacyBqQueryDependsOn(self, other: Resource):
 # base resource class for all table back resources
 class BqExternalTableBasedResource(BqTableBasedResource):
     """ Base class of query based big query actions """
+    poolType = "external"
+
     def __init__(self, bqclient: Client, table: Table,
                  external_config: ExternalConfig):
         self.table = table
         self.bqClient = bqclient
         self.external_config = external_config
         self.table.external_data_configuration = external_config
+        # self.table becomes the metadata read since, which has no schema
+        # or external config if it was prefetched
+        self.definedTable = table
 
         # assert if autodetect that there's no schema
         obj = external_config.to_api_repr()
@@ -1187,15 +1649,11 @@ class BqExternalTableBasedResource(BqTableBasedResource):
             raise Exception("you must not specify a schema in a .schema file")
 
     def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return tables.tableExists(self.bqClient, self.table)
 
     def create(self):
         self.bqClient.delete_table(self.table, not_found_ok=True)
-        self.table = self.bqClient.create_table(self.table)
+        self.table = self.bqClient.create_table(self.definedTable)
         self.table.description = self.make_description()
         # update description - for some reason this can't be done
         # on create???
@@ -1206,12 +1664,16 @@ class BqExternalTableBasedResource(BqTableBasedResource):
             return True
         return legacyBqQueryDependsOn(self, resource)
 
+    def linkSpec(self):
+        return LinkSpec(self.key(), datasetId=self.table.dataset_id,
+                        datasetScoped=True)
+
     def isRunning(self):
         # this is not an async operation
         return False
 
     def shouldUpdate(self):
-        current_description = self.bqClient.get_table(self.table).description
+        current_description = tables.get(self.bqClient, self.table).description
         if not current_description:
             return True
         if not self.makeHashTag() in current_description:
@@ -1225,6 +1687,9 @@ class BqExternalTableBasedResource(BqTableBasedResource):
         m.update(s)
         return m.hexdigest()
 
+    def definitionHash(self):
+        return self.makeHashTag()
+
     def __eq__(self, other):
         return self.key() == other.key()
 
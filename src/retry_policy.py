@@ -0,0 +1,63 @@
+import random
+
+# how a failed job or call is retried, see classifyError
+TRANSIENT = "transient"
+QUOTA = "quota"
+PERMANENT = "permanent"
+
+# reasons of BigQuery errors, see
+# https://cloud.google.com/bigquery/docs/error-messages
+QUOTA_REASONS = set(["rateLimitExceeded", "quotaExceeded", "jobRateLimitExceeded"])
+PERMANENT_REASONS = set(["invalid", "invalidQuery", "invalidUser", "accessDenied",
+                         "billingNotEnabled", "billingTierLimitExceeded", "blocked",
+                         "duplicate", "notImplemented", "resourcesExceeded",
+                         "responseTooLarge"])
+# http codes of errors without a reason we know
+QUOTA_CODES = set([429])
+PERMANENT_CODES = set([400, 401, 403, 405, 409, 411])
+
+
+def errorReasons(error) -> list:
+    """ the reasons of error, the error_result of a job or a
+    GoogleAPICallError """
+    if isinstance(error, dict):
+        return [error.get("reason")]
+    return [e.get("reason") for e in getattr(error, "errors", None) or []
+            if isinstance(e, dict)]
+
+
+def classifyError(error) -> str:
+    """ QUOTA errors go away if we wait long enough, PERMANENT ones won't
+    go away by retrying and anything else, including errors we don't
+    know, is TRANSIENT """
+    reasons = set(errorReasons(error))
+    code = getattr(error, "code", None)
+    if reasons & QUOTA_REASONS or code in QUOTA_CODES:
+        return QUOTA
+    if reasons & PERMANENT_REASONS:
+        return PERMANENT
+    if not reasons - set([None]) and code in PERMANENT_CODES:
+        return PERMANENT
+    return TRANSIENT
+
+
+class RetryPolicy:
+    """ Exponential backoff with jitter.  The nth retry of a resource
+    waits between half and all of base * 2 ** n seconds, at most cap, so
+    resources which failed together don't retry together.  Quota errors
+    back off from the longer quotaBase.
+    """
+
+    def __init__(self, base: float = 2.0, quotaBase: float = 30.0,
+                 cap: float = 600.0, random=random.random):
+        self.base = base
+        self.quotaBase = quotaBase
+        self.cap = cap
+        self.random = random
+
+    def delay(self, kind: str, attempt: int) -> float:
+        """ seconds to wait before retrying after the attempt'th failure,
+        counted from 0, of kind """
+        base = self.quotaBase if kind == QUOTA else self.base
+        ceiling = min(self.cap, base * 2 ** attempt)
+        return ceiling / 2 + self.random() * ceiling / 2
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+# the orders --schedule may start ready resources in
+CRITICAL_PATH = "critical-path"
+FIFO = "fifo"
+ALPHA = "alpha"
+SCHEDULES = [CRITICAL_PATH, FIFO, ALPHA]
+
+
+class RunHistory:
+    """ Seconds each resource took to build in past runs, kept in a json
+    file as a moving average so one slow run doesn't dominate """
+
+    def __init__(self, path: str, weight: float = 0.5):
+        """
+        :param weight: of the latest run in the average
+        """
+        self.path = path
+        self.weight = weight
+        self.durations = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.durations = dict(json.load(f))
+        except (OSError, ValueError, TypeError):
+            self.durations = {}
+        return self
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.durations, f, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def record(self, key: str, seconds: float):
+        prev = self.durations.get(key)
+        if prev is not None:
+            seconds = prev * (1 - self.weight) + seconds * self.weight
+        self.durations[key] = seconds
+        self.dirty = True
+
+    def duration(self, key: str) -> float:
+        """ seconds key is expected to take, the average of all keys
+        when it has never been built """
+        if key in self.durations:
+            return self.durations[key]
+        if self.durations:
+            return sum(self.durations.values()) / len(self.durations)
+        return 1.0
+
+
+def parsePools(limits: dict) -> dict:
+    """ concurrency pool limits as given to --pool.  Names without a
+    kind, i.e. type: or project:, are the pool var of templates
+
+    :return: pool name to the number of jobs which may run in it at once
+    """
+    pools = {}
+    for name, limit in (limits or {}).items():
+        if ":" not in name:
+            name = "pool:" + name
+        try:
+            pools[name] = int(limit)
+        except ValueError:
+            raise Exception("pool limit must be an int", name, limit)
+        if pools[name] < 1:
+            raise Exception("pool limit must be at least 1", name, limit)
+    return pools
+
+
+def criticalPaths(dependencies: dict, duration) -> dict:
+    """ for each key of dependencies the longest sum of duration(key)
+    along a path from it to a key nothing depends on, itself included.
+    Keys with the longest paths hold up the end of a run the most.
+    """
+    dependants = defaultdict(set)
+    remaining = {}
+    for key, deps in dependencies.items():
+        deps = [dep for dep in deps if dep in dependencies]
+        remaining[key] = len(deps)
+        for dep in deps:
+            dependants[dep].add(key)
+
+    order = [key for key, count in remaining.items() if not count]
+    for key in order:
+        for dependant in dependants[key]:
+            remaining[dependant] -= 1
+            if not remaining[dependant]:
+                order.append(dependant)
+
+    paths = {}
+    for key in reversed(order):
+        paths[key] = duration(key) + max(
+            [paths[dependant] for dependant in dependants[key]], default=0)
+    return paths
+
+
+def criticalPath(dependencies: dict, duration) -> list:
+    """ the keys along the longest path of criticalPaths, from the first
+    to start to the last to finish """
+    paths = criticalPaths(dependencies, duration)
+    dependants = defaultdict(set)
+    for key, deps in dependencies.items():
+        for dep in deps:
+            dependants[dep].add(key)
+    path = []
+    candidates = list(paths)
+    while candidates:
+        key = max(sorted(candidates), key=lambda k: paths[k])
+        path.append(key)
+        candidates = [k for k in dependants[key] if k in paths]
+    return path
+
+
+class PrioritySlots:
+    """ asyncio.Semaphore which, once all slots are taken, hands the next
+    free one to the waiter with the lowest priority rather than the first
+    to wait """
+
+    def __init__(self, limit: int):
+        self.free = limit
+        self.waiters = []
+        self.seq = itertools.count()
+
+    async def acquire(self, priority=()):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # handed a slot as we were cancelled
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            (_, _, future) = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+    @asynccontextmanager
+    async def slot(self, priority=()):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
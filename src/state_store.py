@@ -0,0 +1,132 @@
+import sqlite3
+
+from google.cloud.bigquery import LoadJobConfig, SchemaField, \
+    WriteDisposition
+from google.cloud.bigquery.client import Client
+from google.cloud.exceptions import NotFound
+
+# columns of a state record, see StateStore.put
+FIELDS = ["key", "definition_hash", "job_id", "dep_update_time"]
+
+STATE_SCHEMA = [SchemaField("key", "STRING", mode="REQUIRED"),
+                SchemaField("definition_hash", "STRING"),
+                SchemaField("job_id", "STRING"),
+                SchemaField("dep_update_time", "INTEGER")]
+
+
+class StateStore:
+    """ Remembers, per resource key, the definition hash a resource was
+    last built from, the job which built it and the update time of its
+    dependencies then.  Read once per run so the executor doesn't need
+    the hash kept in the description of each table.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.dirty = set()
+
+    def load(self):
+        """ read all records """
+        pass
+
+    def save(self):
+        """ write the records put since load """
+        pass
+
+    def get(self, key: str) -> dict:
+        return self.records.get(key)
+
+    def put(self, key: str, definitionHash: str, jobId: str = None,
+            depUpdateTime: int = None):
+        record = {"key": key, "definition_hash": definitionHash,
+                  "job_id": jobId, "dep_update_time": depUpdateTime}
+        if self.records.get(key) != record:
+            self.records[key] = record
+            self.dirty.add(key)
+
+
+class SqliteStateStore(StateStore):
+    """ State kept in a local sqlite file.  Records are written as they
+    are put so an interrupted run keeps what it finished """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        if not self.conn:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("create table if not exists state ("
+                              "key text primary key, definition_hash text, "
+                              "job_id text, dep_update_time integer)")
+        return self.conn
+
+    def load(self):
+        rows = self.connect().execute(
+            "select " + ", ".join(FIELDS) + " from state").fetchall()
+        self.records = {row[0]: dict(zip(FIELDS, row)) for row in rows}
+        self.dirty = set()
+
+    def put(self, key: str, definitionHash: str, jobId: str = None,
+            depUpdateTime: int = None):
+        super().put(key, definitionHash, jobId, depUpdateTime)
+        self.save()
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.connect() as conn:
+            conn.executemany(
+                "insert or replace into state values (?, ?, ?, ?)",
+                [[self.records[key][f] for f in FIELDS]
+                 for key in sorted(self.dirty)])
+        self.dirty = set()
+
+
+class BqStateStore(StateStore):
+    """ State kept in a BigQuery table, read with one list_rows and
+    rewritten with one load job """
+
+    def __init__(self, bqClient: Client, tableId: str):
+        super().__init__()
+        self.bqClient = bqClient
+        self.tableId = tableId
+
+    def load(self):
+        try:
+            rows = self.bqClient.list_rows(self.tableId,
+                                           selected_fields=STATE_SCHEMA)
+            self.records = {row["key"]: {f: row[f] for f in FIELDS}
+                            for row in rows}
+        except NotFound:
+            self.records = {}
+        self.dirty = set()
+
+    def save(self):
+        if not self.dirty:
+            return
+        jobConfig = LoadJobConfig(
+            schema=STATE_SCHEMA,
+            write_disposition=WriteDisposition.WRITE_TRUNCATE)
+        self.bqClient.load_table_from_json(
+            [self.records[key] for key in sorted(self.records)],
+            self.tableId, job_config=jobConfig).result()
+        self.dirty = set()
+
+
+def openStateStore(spec: str, bqClient: Client) -> StateStore:
+    """
+    :param spec: sqlite:<path> or bq:<project.dataset.table>
+    :return: the loaded store
+    """
+    kind, _, where = spec.partition(":")
+    if kind == "sqlite" and where:
+        store = SqliteStateStore(where)
+    elif kind == "bq" and where:
+        store = BqStateStore(bqClient, where)
+    else:
+        raise Exception("state store must be sqlite:<path> or "
+                        "bq:<project.dataset.table>", spec)
+    store.load()
+    return store
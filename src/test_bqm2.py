@@ -1,10 +1,26 @@
+import asyncio
 import optparse
+import os
+import tempfile
+import threading
+import time
 import unittest
 from collections import defaultdict
-from unittest.mock import patch, mock_open
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import Mock, patch, mock_open
 
-from bqm2 import DependencyExecutor, find_cycles
+from bqm2 import DependencyExecutor, DependencyBuilder, find_cycles, dependantsOf, watch, \
+    nextRefresh
 from bqm2 import KVOption
+from job_watcher import AdaptiveInterval
+from retry_policy import RetryPolicy
+from loader import DelegatingFileSuffixLoader, BqQueryTemplatingFileLoader, \
+    BqDataFileLoader, TableType
+from google.cloud.bigquery.table import Table
+from resource import Resource, BqGcsTableLoadResource, BqViewBackedTableResource, tables
+from scheduling import RunHistory, parsePools
+from state_store import StateStore, openStateStore
 
 
 class Test(unittest.TestCase):
@@ -35,4 +51,927 @@ def test_find_cycles_cycle_distance_two():
         'b': set('c'),
         'c': set('a'),
         'd': set()}
-    )
\ No newline at end of file
+    )
+
+def buildFolder(folder, loadWorkers):
+    return folderBuilder(loadWorkers).buildDepend([folder], dryrun=True)
+
+
+def folderBuilder(loadWorkers=1):
+    defaultVars = {"dataset": "ds", "project": "p"}
+    loader = DelegatingFileSuffixLoader(
+        querytemplate=BqQueryTemplatingFileLoader(None, None, None,
+                                                  TableType.TABLE,
+                                                  defaultVars),
+        uniontable=BqQueryTemplatingFileLoader(None, None, None,
+                                               TableType.UNION_TABLE,
+                                               defaultVars),
+        localdata=BqDataFileLoader(None, "ds", "p", None))
+    return DependencyBuilder(loader, loadWorkers=loadWorkers)
+
+
+def test_load_workers_same_as_serial():
+    files = {
+        "events.uniontable": "select '{yyyymmdd}' d, '{region}' r",
+        "events.uniontable.vars":
+            '[{"yyyymmdd": [-30, 0], "region": ["eu", "us"]}]',
+        "daily.querytemplate": "select * from ds.events where d = '{yyyymmdd}'",
+        "daily.querytemplate.vars": '[{"table": "daily_{yyyymmdd}", '
+                                    '"yyyymmdd": [-3, 0]}]',
+        "local.localdata": "a\tb",
+        "local.localdata.schema": "a:string,b:string",
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        for name, content in files.items():
+            with open(os.path.join(folder, name), "w") as f:
+                f.write(content)
+        (serial, serialDeps) = buildFolder(folder, 1)
+        (pooled, pooledDeps) = buildFolder(folder, 2)
+
+    assert serialDeps == pooledDeps
+    assert list(serial.keys()) == list(pooled.keys())
+    for key in serial:
+        assert serial[key].dump() == pooled[key].dump()
+    assert len(serial["ds.events"].queries) == 31 * 2
+
+
+class FakeJob:
+    """ finishes after seconds and calls back like a google PollingFuture
+    """
+
+    def __init__(self, seconds, callsBack=True):
+        self.job_id = f"create-fake-{id(self)}"
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.timer = threading.Timer(seconds, self.finish)
+        self.timer.start()
+        if callsBack:
+            self.add_done_callback = self.callbacks.append
+
+    def finish(self):
+        self.ended = datetime.now(timezone.utc)
+        self.finished.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def cancel(self):
+        self.timer.cancel()
+        self.cancelled = True
+        self.finish()
+
+
+class FakeResource(Resource):
+    def __init__(self, key, seconds, started, callsBack=True):
+        self._key = key
+        self.seconds = seconds
+        self.started = started
+        self.callsBack = callsBack
+        self.job = None
+        self.updated = 0
+
+    def key(self):
+        return self._key
+
+    def isRunning(self):
+        return self.job is not None and not self.job.finished.is_set()
+
+    def currentJob(self):
+        return self.job
+
+    def exists(self):
+        return self.job is not None
+
+    def shouldUpdate(self):
+        return False
+
+    def updateTime(self):
+        return self.updated
+
+    def modifiedTime(self):
+        return self.updated and datetime.fromtimestamp(self.updated, timezone.utc)
+
+    def create(self):
+        self.started.append(self._key)
+        self.updated = time.time()
+        self.job = FakeJob(self.seconds, self.callsBack)
+
+
+def runFakes(dependencies, checkFrequency, maxConcurrent=10, callsBack=True,
+             **kwargs):
+    started = []
+    resources = {key: FakeResource(key, 0.1, started, callsBack)
+                 for key in dependencies}
+    executor = DependencyExecutor(resources, dependencies, **kwargs)
+    start = time.time()
+    executor.execute(checkFrequency=checkFrequency,
+                     maxConcurrent=maxConcurrent)
+    return started, time.time() - start
+
+
+def test_execute_starts_dependants_when_jobs_finish():
+    dependencies = {"a": set(), "b": set(["a"]), "c": set(["b"]),
+                    "d": set()}
+    started, elapsed = runFakes(dependencies, checkFrequency=30)
+    assert started == ["a", "d", "b", "c"]
+    assert elapsed < 5
+
+
+def test_execute_respects_max_concurrent():
+    dependencies = {"a": set(), "b": set(), "c": set(), "d": set(["a"])}
+    started, elapsed = runFakes(dependencies, checkFrequency=30,
+                                maxConcurrent=1)
+    assert started == ["a", "b", "c", "d"]
+    assert elapsed < 5
+
+
+def test_execute_checks_jobs_without_callbacks():
+    dependencies = {"a": set(), "b": set(["a"])}
+    started, elapsed = runFakes(dependencies, checkFrequency=0.05,
+                                callsBack=False)
+    assert started == ["a", "b"]
+
+
+class SlowProbeResource(FakeResource):
+    """ each exists check is a 200ms round trip """
+
+    def exists(self):
+        time.sleep(0.2)
+        return super().exists()
+
+
+def test_execute_async_probes_concurrently():
+    started = []
+    dependencies = {f"t{i}": set() for i in range(40)}
+    resources = {key: SlowProbeResource(key, 0, started)
+                 for key in dependencies}
+    for rsrc in resources.values():
+        rsrc.create()
+        rsrc.job.finished.wait()
+    executor = DependencyExecutor(resources, dependencies)
+    start = time.time()
+    asyncio.run(executor.executeAsync(checkFrequency=30, probeConcurrency=40))
+    assert time.time() - start < 2
+    assert executor.dependencies == {}
+
+
+def test_execute_async_follows_dependencies():
+    started = []
+    dependencies = {"a": set(), "b": set(["a"]), "c": set(["a", "b"]),
+                    "d": set(), "e": set()}
+    resources = {key: FakeResource(key, 0.1, started)
+                 for key in dependencies}
+    executor = DependencyExecutor(resources, dependencies)
+    asyncio.run(executor.executeAsync(checkFrequency=30, maxConcurrent=2))
+    assert started.index("a") < started.index("b") < started.index("c")
+    assert sorted(started) == ["a", "b", "c", "d", "e"]
+
+
+def test_execute_async_raises_on_max_retries():
+    class NeverExists(FakeResource):
+        def exists(self):
+            return False
+
+    started = []
+    executor = DependencyExecutor({"a": NeverExists("a", 0, started)},
+                                  {"a": set()}, maxRetry=1)
+    try:
+        asyncio.run(executor.executeAsync(checkFrequency=0.01))
+        assert False, "should have hit maximum retries"
+    except Exception as e:
+        assert "Maximum retries" in str(e.args[0])
+    assert started == ["a"]
+
+
+class HashedResource(FakeResource):
+    """ exists already, built from definition """
+
+    def __init__(self, key, definition, started):
+        super().__init__(key, 0, started)
+        self.definition = definition
+        self.updated = 1
+
+    def exists(self):
+        return True
+
+    def shouldUpdate(self):
+        raise Exception("the state store should have been asked")
+
+    def definitionHash(self):
+        return self.definition
+
+
+def test_execute_decides_changes_from_state_store():
+    with tempfile.TemporaryDirectory() as folder:
+        store = openStateStore("sqlite:" + os.path.join(folder, "s.db"), None)
+        store.put("a", "hash:a")
+        store.put("b", "hash:b")
+
+        started = []
+        resources = {"a": HashedResource("a", "hash:a", started),
+                     "b": HashedResource("b", "hash:b2", started)}
+        executor = DependencyExecutor(resources, {"a": set(), "b": set()},
+                                      stateStore=store)
+        executor.execute(checkFrequency=30)
+
+        assert started == ["b"]
+        assert store.get("b")["definition_hash"] == "hash:b2"
+        assert store.get("b")["job_id"] == resources["b"].job.job_id
+
+
+class SavedStore(StateStore):
+    """ keeps what save wrote """
+
+    def __init__(self):
+        super().__init__()
+        self.saved = {}
+
+    def save(self):
+        self.saved = dict(self.records)
+
+
+def test_execute_saves_state_when_a_run_fails():
+    started = []
+    resources = {"a": FakeResource("a", 0.05, started),
+                 "b": FailingResource("b", started, [{"reason": "invalidQuery"}])}
+    resources["a"].definitionHash = lambda: "hash:a"
+    resources["b"].definitionHash = lambda: "hash:b"
+    resources["b"].seconds = 0.5
+    store = SavedStore()
+    executor = DependencyExecutor(resources, {"a": set(), "b": set()},
+                                  stateStore=store)
+    try:
+        executor.execute(checkFrequency=0.1)
+        assert False, "should have raised"
+    except Exception as e:
+        assert e.args[0] == "Permanent error for resource"
+    assert list(store.saved) == ["a"]
+
+
+def test_execute_describes_tables_without_state():
+    store = SavedStore()
+    store.put("a", "hash:a")
+    resources = {"a": HashedResource("a", "hash:a", []),
+                 "b": HashedResource("b", "hash:b", [])}
+    DependencyExecutor(resources, {"a": set(), "b": set()}, stateStore=store)
+    assert not resources["a"].describesDefinition
+    assert resources["b"].describesDefinition
+
+
+def test_execute_stale_from_recorded_dependency_time():
+    store = SavedStore()
+    store.put("a", "hash:a")
+    # b was built when a was last updated at 5, a was updated at 10 since
+    # and b's table was modified after that
+    store.put("b", "hash:b", depUpdateTime=5)
+    store.put("c", "hash:c", depUpdateTime=10)
+    started = []
+    resources = {"a": HashedResource("a", "hash:a", started),
+                 "b": HashedResource("b", "hash:b", started),
+                 "c": HashedResource("c", "hash:c", started)}
+    resources["a"].updated = 10
+    resources["b"].updated = 100
+    resources["c"].updated = 1
+    executor = DependencyExecutor(resources, {"a": set(), "b": set(["a"]),
+                                              "c": set(["a"])},
+                                  stateStore=store)
+    executor.execute(checkFrequency=0.1)
+    assert started == ["b"]
+
+
+def writeFiles(folder, files):
+    for name, content in files.items():
+        with open(os.path.join(folder, name), "w") as f:
+            f.write(content)
+
+
+def test_update_reloads_and_relinks_changed_files():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"a.querytemplate": "select 1",
+                            "b.querytemplate": "select * from ds.a",
+                            "c.querytemplate": "select * from ds.b join ds.d",
+                            "local.vars": "x: 1"})
+        builder = folderBuilder()
+        (resources, dependencies) = builder.buildDepend([folder], dryrun=True)
+        builder.fingerprints = {k: builder.fingerprint(r) for k, r in resources.items()}
+
+        writeFiles(folder, {"b.querytemplate": "select 2 from ds.a"})
+        changed = builder.update(builder.affectedFiles([folder + "/b.querytemplate"]),
+                                 resources, dependencies, True)
+        assert changed == set(["ds.b"])
+        assert dependantsOf(dependencies, changed) == set(["ds.b", "ds.c"])
+        assert "select 2" in resources["ds.b"].dump()
+
+        # a new key is linked from unchanged files
+        writeFiles(folder, {"d.querytemplate": "select 3"})
+        changed = builder.update(builder.affectedFiles([folder + "/d.querytemplate"]),
+                                 resources, dependencies, True)
+        assert changed == set(["ds.d"])
+        assert dependencies["ds.c"] == set(["ds", "ds.b", "ds.d"])
+        assert dependencies == buildFolder(folder, 1)[1]
+
+        # local.vars reloads the folder but nothing is defined differently
+        writeFiles(folder, {"local.vars": "x: 2"})
+        files = builder.affectedFiles([folder + "/local.vars"])
+        assert len(files) == 4
+        assert builder.update(files, resources, dependencies, True) == set()
+
+        os.remove(os.path.join(folder, "c.querytemplate"))
+        builder.update(builder.affectedFiles([folder + "/c.querytemplate"]),
+                       resources, dependencies, True)
+        assert "ds.c" not in resources
+        assert dependencies == buildFolder(folder, 1)[1]
+
+
+def test_update_keeps_graph_when_loading_fails():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"a.querytemplate": "select 1",
+                            "b.querytemplate": "select * from ds.a"})
+        builder = folderBuilder()
+        (resources, dependencies) = builder.buildDepend([folder], dryrun=True)
+        before = dict(dependencies)
+
+        writeFiles(folder, {"a.querytemplate": "select * from ds.b"})
+        try:
+            builder.update(builder.affectedFiles([folder + "/a.querytemplate"]),
+                           resources, dependencies, True)
+            assert False, "should have found the cycle"
+        except Exception as e:
+            assert "cycles" in str(e)
+        assert dependencies == before
+        assert "select 1" in resources["ds.a"].dump()
+
+
+class ScriptedFileWatcher:
+    def __init__(self, changes):
+        self.changes = lambda timeout: changes.pop(0)
+
+
+def test_watch_executes_changed_subgraph():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"a.querytemplate": "select 1",
+                            "b.querytemplate": "select * from ds.a",
+                            "c.querytemplate": "select 2"})
+        builder = folderBuilder()
+        (resources, dependencies) = builder.buildDepend([folder], dryrun=True)
+        executed = []
+        writeFiles(folder, {"a.querytemplate": "select 11"})
+        fileWatcher = ScriptedFileWatcher([set(), set([folder + "/unrelated.txt"]),
+                                           set([folder + "/a.querytemplate"])])
+        watch(builder, fileWatcher, resources, dependencies, executed.append,
+              dryrun=True, rounds=1)
+
+        assert executed == [{"ds.a": set(), "ds.b": set(["ds.a"])}]
+
+
+def test_watch_reads_table_metadata_again_each_round():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"a.querytemplate": "select 1"})
+        builder = folderBuilder()
+        (resources, dependencies) = builder.buildDepend([folder], dryrun=True)
+        tables.datasetTableMap["p.ds"] = set(["a"])
+        tables.snapshot["p.ds.gone"] = None
+        prefetched = []
+        snapshots = []
+        writeFiles(folder, {"a.querytemplate": "select 2"})
+        fileWatcher = ScriptedFileWatcher([set([folder + "/a.querytemplate"])])
+        watch(builder, fileWatcher, resources, dependencies,
+              lambda subgraph: snapshots.append(
+                  (dict(tables.snapshot), dict(tables.datasetTableMap))),
+              dryrun=True, rounds=1,
+              prefetch=lambda rsrcs: prefetched.append(
+                  sorted([rsrc.key() for rsrc in rsrcs])))
+
+        assert snapshots == [({}, {})]
+        assert prefetched == [sorted(resources.keys())]
+
+
+class ListedJob:
+    def __init__(self, jobId, state, error=None):
+        self.job_id = jobId
+        self.state = state
+        self.error_result = error
+        self.errors = error and [error]
+
+    def reload(self):
+        pass
+
+    def running(self):
+        return self.state == "RUNNING"
+
+
+def test_watch_forgets_ended_jobs_of_fixed_files():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"a.querytemplate": "select from",
+                            "b.querytemplate": "select 2"})
+        builder = folderBuilder()
+        (resources, dependencies) = builder.buildDepend([folder], dryrun=True)
+        failed = ListedJob("a-1", "DONE", {"reason": "invalidQuery"})
+        running = ListedJob("b-1", "RUNNING")
+        resources["ds.a"].attachJob(failed)
+        resources["ds.b"].attachJob(running)
+        jobs = []
+        writeFiles(folder, {"a.querytemplate": "select 1",
+                            "b.querytemplate": "select 22"})
+        fileWatcher = ScriptedFileWatcher([set([folder + "/a.querytemplate",
+                                                folder + "/b.querytemplate"])])
+        watch(builder, fileWatcher, resources, dependencies,
+              lambda subgraph: jobs.append({key: resources[key].currentJob()
+                                            for key in subgraph}),
+              dryrun=True, rounds=1)
+
+        # the fixed query runs again instead of failing with the old job
+        assert jobs == [{"ds.a": None, "ds.b": running}]
+
+        # a job the loader attached at startup which has since failed
+        writeFiles(folder, {"a.querytemplate": "select 3"})
+        loaded = builder.loadFiles
+        builder.loadFiles = lambda files, dryrun: [
+            (file, [attached(rsrc) for rsrc in rsrcs])
+            for (file, rsrcs) in loaded(files, dryrun)]
+
+        def attached(rsrc):
+            rsrc.attachJob(failed)
+            return rsrc
+        builder.update(builder.affectedFiles([folder + "/a.querytemplate"]),
+                       resources, dependencies, True)
+        assert resources["ds.a"].currentJob() is None
+
+
+def test_next_refresh():
+    now = datetime(2024, 1, 31, 23, 59, 59, 5)
+    assert nextRefresh(now, "hour") == datetime(2024, 2, 1, 0)
+    assert nextRefresh(now, "day") == datetime(2024, 2, 1)
+    assert nextRefresh(now, "month") == datetime(2024, 2, 1)
+    assert nextRefresh(datetime(2024, 12, 15, 1), "month") == datetime(2025, 1, 1)
+
+
+def frozenDatetime(now):
+    class Frozen(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+    return Frozen
+
+
+def test_refresh_executes_new_dates_only():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"events.querytemplate": "select '{yyyymmddhh}' h",
+                            "events.querytemplate.vars":
+                                '[{"table": "events_{yyyymmddhh}", "yyyymmddhh": [-1, 0]}]',
+                            "other.querytemplate": "select 1"})
+        builder = folderBuilder()
+        with patch("loader.datetime", frozenDatetime(datetime(2024, 1, 1, 10, 30))):
+            (resources, dependencies) = builder.buildDepend([folder], dryrun=True)
+        assert builder.dateRelativeFiles() == set([folder + "/events.querytemplate"])
+
+        clock = [datetime(2024, 1, 1, 10, 30)]
+
+        def nextHour(timeout):
+            assert timeout == 60
+            clock[0] = datetime(2024, 1, 1, 11, 0, 1)
+            return set()
+
+        fileWatcher = ScriptedFileWatcher([])
+        fileWatcher.changes = nextHour
+        executed = []
+        with patch("loader.datetime", frozenDatetime(datetime(2024, 1, 1, 11, 0, 1))):
+            watch(builder, fileWatcher, resources, dependencies, executed.append,
+                  dryrun=True, rounds=1, refreshEvery="hour", clock=lambda: clock[0])
+
+        assert executed == [{"ds.events_2024010111": set()}]
+        assert "ds.events_2024010109" not in resources
+        assert "ds.events_2024010110" in resources
+
+
+def chainAndLeaves():
+    return {"a": set(), "b": set(), "z1": set(), "z2": set(["z1"]), "z3": set(["z2"])}
+
+
+def test_execute_starts_critical_path_first():
+    started, _ = runFakes(chainAndLeaves(), checkFrequency=30, maxConcurrent=1)
+    assert started == ["z1", "a", "z2", "b", "z3"]
+    started, _ = runFakes(chainAndLeaves(), checkFrequency=30, maxConcurrent=1,
+                          schedule="alpha")
+    assert started == ["a", "b", "z1", "z2", "z3"]
+    started, _ = runFakes(chainAndLeaves(), checkFrequency=30, maxConcurrent=1,
+                          schedule="fifo")
+    assert started == ["a", "b", "z1", "z2", "z3"]
+
+
+def test_execute_weighs_critical_path_by_run_history():
+    with tempfile.TemporaryDirectory() as folder:
+        history = RunHistory(os.path.join(folder, "history.json"))
+        history.durations = {"a": 1, "b": 20, "z1": 1, "z2": 1, "z3": 1}
+        started, _ = runFakes(chainAndLeaves(), checkFrequency=30, maxConcurrent=1,
+                              runHistory=history)
+        assert started[0] == "b"
+
+        saved = RunHistory(os.path.join(folder, "history.json")).load()
+        assert set(saved.durations.keys()) == set(chainAndLeaves().keys())
+        assert saved.durations["b"] < 20
+
+
+def test_execute_async_starts_critical_path_first():
+    started = []
+    resources = {key: FakeResource(key, 0.1, started) for key in chainAndLeaves()}
+    executor = DependencyExecutor(resources, chainAndLeaves())
+    asyncio.run(executor.executeAsync(checkFrequency=30, maxConcurrent=1))
+    assert started == ["z1", "a", "z2", "b", "z3"]
+
+
+def pooledFakes(started):
+    resources = {key: FakeResource(key, 0.2, started) for key in ["a", "b", "c"]}
+    resources["a"].pool = "heavy"
+    resources["b"].pool = "heavy"
+    return resources
+
+
+def test_execute_respects_pools():
+    started = []
+    executor = DependencyExecutor(pooledFakes(started), {"a": set(), "b": set(), "c": set()},
+                                  pools=parsePools({"heavy": "1"}))
+    executor.execute(checkFrequency=30)
+    assert started == ["a", "c", "b"]
+    assert executor.summary.counts["pool pool:heavy wait seconds"] >= 0.1
+
+
+def test_execute_async_respects_pools():
+    started = []
+    executor = DependencyExecutor(pooledFakes(started), {"a": set(), "b": set(), "c": set()},
+                                  pools=parsePools({"heavy": "1", "type:resource": "5"}))
+    asyncio.run(executor.executeAsync(checkFrequency=30))
+    assert started == ["a", "c", "b"]
+    assert executor.summary.counts["pool pool:heavy wait seconds"] >= 0.1
+    assert "pool type:resource wait seconds" in executor.summary.counts
+
+
+def test_parse_pools():
+    assert parsePools({"heavy": "2", "type:bash": "1"}) == {"pool:heavy": 2, "type:bash": 1}
+    assert parsePools(None) == {}
+    for bad in ["0", "x"]:
+        try:
+            parsePools({"heavy": bad})
+            assert False, "should have raised"
+        except Exception as e:
+            assert "pool limit" in str(e)
+
+
+def test_loaded_resources_pools():
+    with tempfile.TemporaryDirectory() as folder:
+        writeFiles(folder, {"a.querytemplate": "select 1",
+                            "a.querytemplate.vars":
+                                '[{"pool": "heavy", "extract": "gs://bucket/a/*.csv"}]',
+                            "b.querytemplate": "select 2"})
+        (resources, _) = buildFolder(folder, 1)
+    assert resources["ds.a"].pools() == ["type:query", "pool:heavy", "project:p",
+                                         "dataset:p.ds"]
+    assert "pool:heavy" in resources["extract.ds.a"].pools()
+    assert resources["ds.b"].pools() == ["type:query", "project:p", "dataset:p.ds"]
+    assert resources["ds"].pools() == ["type:dataset", "project:p"]
+
+
+class FakeTracker:
+    """ resource.JobTracker over FakeJobs, one call per refresh """
+
+    def __init__(self):
+        self.jobs = {}
+        self.lastRefresh = 0
+        self.calls = 0
+
+    def canTrack(self, job):
+        return True
+
+    def track(self, job, callback):
+        self.jobs.setdefault(job.job_id, (job, []))[1].append(callback)
+
+    def refresh(self):
+        self.calls += 1
+        self.lastRefresh = time.time()
+        for jobId, (job, callbacks) in list(self.jobs.items()):
+            if job.finished.is_set():
+                del self.jobs[jobId]
+                for callback in callbacks:
+                    callback(job)
+
+
+def test_execute_waits_on_job_tracker():
+    dependencies = {"a": set(), "b": set(["a"]), "c": set(), "d": set()}
+    tracker = FakeTracker()
+    started, elapsed = runFakes(dependencies, checkFrequency=0.3, jobTracker=tracker)
+    assert started == ["a", "c", "d", "b"]
+    assert 2 <= tracker.calls <= 6
+    assert elapsed < 5
+
+
+def test_execute_async_waits_on_job_tracker():
+    started = []
+    dependencies = {"a": set(), "b": set(["a"]), "c": set(), "d": set()}
+    resources = {key: FakeResource(key, 0.1, started) for key in dependencies}
+    tracker = FakeTracker()
+    executor = DependencyExecutor(resources, dependencies, jobTracker=tracker)
+    asyncio.run(executor.executeAsync(checkFrequency=0.3))
+    assert started[-1] == "b"
+    assert tracker.calls >= 1
+    assert executor.summary.counts["job status calls"] == tracker.calls
+
+
+def test_execute_polls_adaptively():
+    dependencies = {"a": set(), "b": set(["a"]), "c": set(["b"])}
+    pollInterval = AdaptiveInterval(minimum=0.05, maximum=30,
+                                    expected={"a": 0.1, "b": 0.1, "c": 0.1}.get)
+    started = []
+    resources = {key: FakeResource(key, 0.1, started, callsBack=False)
+                 for key in dependencies}
+    executor = DependencyExecutor(resources, dependencies, pollInterval=pollInterval)
+    start = time.time()
+    executor.execute(checkFrequency=30)
+    assert started == ["a", "b", "c"]
+    assert time.time() - start < 5
+    counts = executor.summary.counts
+    assert counts["job checks at --checkFrequency"] == 3
+    assert counts["seconds noticing jobs done"] < \
+        counts["seconds noticing jobs done at --checkFrequency"]
+
+
+def test_execute_async_polls_adaptively():
+    started = []
+    dependencies = {"a": set(), "b": set(["a"])}
+    resources = {key: FakeResource(key, 0.1, started, callsBack=False)
+                 for key in dependencies}
+    executor = DependencyExecutor(resources, dependencies,
+                                  pollInterval=AdaptiveInterval(minimum=0.05))
+    start = time.time()
+    asyncio.run(executor.executeAsync(checkFrequency=30))
+    assert started == ["a", "b"]
+    assert time.time() - start < 5
+    assert executor.summary.counts["job checks"] >= 2
+
+
+class PlannedResource(Resource):
+    """ a query resource as far as DependencyExecutor.plan asks """
+
+    def __init__(self, key, updated=None, processes=0, running=False):
+        self._key = key
+        self.updated = updated
+        self.processes = processes
+        self.running = running
+
+    def key(self):
+        return self._key
+
+    def pools(self):
+        return ["type:query", "dataset:p." + self._key.split(".")[0]]
+
+    def isRunning(self):
+        return self.running
+
+    def exists(self):
+        return self.updated is not None
+
+    def updateTime(self):
+        return self.updated
+
+    def shouldUpdate(self):
+        return False
+
+    def create(self):
+        raise Exception("plan must not create", self._key)
+
+    def dryRun(self):
+        if isinstance(self.processes, Exception):
+            raise self.processes
+        return self.processes
+
+
+def test_plan_dry_runs_what_would_execute():
+    resources = {"a.up": PlannedResource("a.up", updated=10),
+                 "a.old": PlannedResource("a.old", updated=5, processes=100),
+                 "a.new": PlannedResource("a.new", processes=1000),
+                 "b.down": PlannedResource("b.down", updated=20, processes=10),
+                 "b.fine": PlannedResource("b.fine", updated=20),
+                 "b.broken": PlannedResource("b.broken", processes=Exception("no\nway")),
+                 "b.busy": PlannedResource("b.busy", updated=1, running=True),
+                 "b.after": PlannedResource("b.after", updated=30, processes=1)}
+    dependencies = {"a.up": set(), "a.old": set(["a.up"]), "a.new": set(),
+                    "b.down": set(["a.new"]), "b.fine": set(["a.up"]),
+                    "b.broken": set(), "b.busy": set(), "b.after": set(["b.busy"])}
+    executor = DependencyExecutor(resources, dependencies)
+    plan = executor.plan(maxConcurrent=3)
+    assert list(plan.reasons) == ["a.new", "b.broken", "a.old", "b.after", "b.down"]
+    assert plan.reasons["a.old"] == "stale"
+    assert plan.reasons["b.down"] == "its dependencies a.new would be"
+    assert plan.bytes == {"a.new": 1000, "a.old": 100, "b.after": 1, "b.down": 10}
+    assert plan.errors == {"b.broken": "no"}
+    assert plan.perDataset() == {"p.a": 1100, "p.b": 11}
+    assert plan.total() == 1111
+    assert plan.criticalPath == ["a.new", "b.down"]
+    assert "total bytes processed: 1.08 KB (1111) by 4 queries, 1 dry runs failed" \
+        in str(plan)
+    # the graph is left for execute
+    assert dependencies["b.down"] == set(["a.new"])
+
+
+def test_plan_stops_over_max_bytes():
+    resources = {"a.new": PlannedResource("a.new", processes=1000)}
+    executor = DependencyExecutor(resources, {"a.new": set()})
+    assert executor.plan(maxBytes=1000).total() == 1000
+    try:
+        executor.plan(maxBytes=999)
+        assert False, "should have raised"
+    except Exception as e:
+        assert e.args[1:] == (1000, 999)
+
+
+def test_plan_writes_no_table_metadata():
+    tables.clear()
+    client = Mock()
+    client.get_table.side_effect = lambda table: Table.from_api_repr({
+        "tableReference": {"projectId": "p", "datasetId": "ds",
+                           "tableId": table.table_id},
+        "lastModifiedTime": "1700000000000"})
+    client.update_table.side_effect = lambda table, fields: table
+    view = BqViewBackedTableResource(["select 1"], Table("p.ds.v"), client)
+    load = BqGcsTableLoadResource(Table("p.ds.l"), client, Mock(), None,
+                                  "gs://bucket/l/*", None, {"expiration": "3"})
+    executor = DependencyExecutor({"ds.v": view, "ds.l": load},
+                                  {"ds.v": set(), "ds.l": set()})
+    executor.plan()
+    assert client.update_table.call_count == 0
+    # execute describes and expires them again
+    assert view.describesDefinition and load.updatesExpiration
+
+
+class RedefinedResource(FakeResource):
+    """ found running a job which takes long """
+
+    def __init__(self, key, started, definition="new", created=None, seconds=30):
+        super().__init__(key, 0.1, started)
+        self.job = FakeJob(seconds)
+        self.job.definition = definition
+        self.job.created = created
+        self.job.slot_millis = 4000
+        self.job.query_plan = [SimpleNamespace(parallel_inputs=4,
+                                               completed_parallel_inputs=1)]
+
+    def jobIsCurrent(self, job):
+        return getattr(job, "definition", "new") == "new"
+
+    def attachJob(self, job):
+        self.job = job
+
+
+def test_execute_cancels_jobs_of_old_definitions():
+    started = []
+    resources = {"a": RedefinedResource("a", started, definition="old"),
+                 "b": RedefinedResource("b", started, seconds=0.3)}
+    oldA = resources["a"].job
+    executor = DependencyExecutor(resources, {"a": set(), "b": set()})
+    executor.execute(checkFrequency=0.1)
+    # b's job was waited on
+    assert oldA.cancelled and started == ["a"]
+    counts = executor.summary.counts
+    assert counts["superseded jobs cancelled"] == 1
+    assert counts["slot seconds used by superseded jobs"] == 4
+    assert counts["slot seconds saved cancelling superseded jobs"] == 12
+
+
+def test_execute_async_cancels_jobs_older_than_dependencies():
+    started = []
+    resources = {"a": FakeResource("a", 0.1, started),
+                 "b": RedefinedResource("b", started,
+                                        created=datetime.fromtimestamp(1, timezone.utc))}
+    oldB = resources["b"].job
+    executor = DependencyExecutor(resources, {"a": set(), "b": set(["a"])})
+    asyncio.run(executor.executeAsync(checkFrequency=0.1))
+    assert oldB.cancelled and started == ["a", "b"]
+    assert executor.summary.counts["superseded jobs cancelled"] == 1
+
+
+class FailingResource(FakeResource):
+    """ whose jobs fail with errors, one per create, then succeed """
+
+    def __init__(self, key, started, errors):
+        super().__init__(key, 0.05, started)
+        self.errors = list(errors)
+
+    def exists(self):
+        return self.job is not None and not self.job.error_result
+
+    def create(self):
+        super().create()
+        self.job.error_result = self.errors.pop(0) if self.errors else None
+
+
+def failingRun(errors, engine="sync", maxRetry=2):
+    started = []
+    resources = {"a": FailingResource("a", started, errors),
+                 "b": FakeResource("b", 0.2, started)}
+    executor = DependencyExecutor(resources, {"a": set(), "b": set()},
+                                  maxRetry=maxRetry,
+                                  retryPolicy=RetryPolicy(base=0.4, quotaBase=0.8,
+                                                          random=lambda: 1))
+    start = time.time()
+    if engine == "async":
+        asyncio.run(executor.executeAsync(checkFrequency=0.1))
+    else:
+        executor.execute(checkFrequency=0.1)
+    return started, executor.summary.counts, time.time() - start
+
+
+def test_execute_backs_off_transient_errors():
+    for engine in ["sync", "async"]:
+        started, counts, elapsed = failingRun([{"reason": "backendError"}], engine)
+        # b went ahead while a waited
+        assert started == ["a", "b", "a"], engine
+        assert counts["retries"] == 1 and counts["transient errors"] == 1
+        assert counts["backoff seconds"] == 0.4
+        assert 0.4 <= elapsed < 5
+
+
+def test_execute_backs_off_quota_errors_longer():
+    started, counts, elapsed = failingRun([{"reason": "rateLimitExceeded"}] * 2,
+                                          maxRetry=3)
+    assert started == ["a", "b", "a", "a"]
+    assert counts["quota errors"] == 2
+    assert counts["backoff seconds"] == 0.8 + 1.6
+    assert 2.4 <= elapsed < 10
+
+
+def test_execute_fails_fast_on_permanent_errors():
+    for engine in ["sync", "async"]:
+        try:
+            failingRun([{"reason": "invalidQuery"}], engine, maxRetry=5)
+            assert False, "should have raised"
+        except Exception as e:
+            assert e.args[:2] == ("Permanent error for resource", "a"), engine
+
+
+class SkewedResource(FakeResource):
+    """ whose updateTime reads modified as local time hours ahead of UTC
+    and whose jobs know when they were created """
+
+    def updateTime(self):
+        return self.updated and (self.updated + 4 * 3600) * 1000
+
+    def create(self):
+        super().create()
+        self.job.created = datetime.now(timezone.utc)
+
+
+def test_execute_keeps_jobs_it_started_despite_skew():
+    started = []
+    resources = {"a": SkewedResource("a", 0.1, started),
+                 "b": SkewedResource("b", 0.3, started)}
+    executor = DependencyExecutor(resources, {"a": set(), "b": set(["a"])})
+    executor.execute(checkFrequency=0.1)
+    assert started == ["a", "b"]
+    assert "superseded jobs cancelled" not in executor.summary.counts
+
+
+def test_plan_cancels_no_jobs():
+    started = []
+    resources = {"a": RedefinedResource("a", started, definition="old", seconds=0.1)}
+    resources["a"].dryRun = lambda: 5
+    resources["a"].shouldUpdate = lambda: True
+    executor = DependencyExecutor(resources, {"a": set()})
+    plan = executor.plan()
+    assert not hasattr(resources["a"].job, "cancelled")
+    assert "superseded jobs cancelled" not in executor.summary.counts
+    assert plan.bytes == {"a": 5}
+
+
+def test_execute_stops_waiting_on_retries_once_they_start():
+    from job_watcher import JobWatcher
+    started = []
+    resources = {"a": FailingResource("a", started, [{"reason": "backendError"}]),
+                 "b": FakeResource("b", 1.5, started)}
+    executor = DependencyExecutor(resources, {"a": set(), "b": set()},
+                                  retryPolicy=RetryPolicy(base=0.2, random=lambda: 1))
+    waits = []
+    wait = JobWatcher.wait
+
+    def countedWait(watcher, timeout=None):
+        waits.append(timeout)
+        return wait(watcher, timeout)
+
+    with patch.object(JobWatcher, "wait", countedWait):
+        executor.execute(checkFrequency=30)
+    assert started == ["a", "b", "a"]
+    assert executor.retryAt == {} and executor.nextRetry() is None
+    assert len(waits) < 10
+
+
+def test_execute_creates_resources_whose_earlier_job_failed():
+    for engine in ["sync", "async"]:
+        started = []
+        resources = {"a": FailingResource("a", started, [])}
+        # i.e. attached from BqJobs, failed before this run
+        resources["a"].job = FakeJob(0)
+        resources["a"].job.error_result = {"reason": "invalidQuery"}
+        executor = DependencyExecutor(resources, {"a": set()})
+        if engine == "async":
+            asyncio.run(executor.executeAsync(checkFrequency=0.1))
+        else:
+            executor.execute(checkFrequency=0.1)
+        assert started == ["a"], engine
+        assert "permanent errors" not in executor.summary.counts
@@ -1,6 +1,8 @@
 import json
 import unittest
 import logging
+import pickle
+from datetime import datetime, timedelta
 
 import date_formatter_helper
 import iter_util
@@ -73,6 +75,55 @@ class Test(unittest.TestCase):
         date_formatter_helper.helpers.format_all_date_keys(inp)
         self.assertEqual(inp, expected)
 
+    def test_formatters_slice_as_strptime_would(self):
+        for formatter in date_formatter_helper.helpers.formatters:
+            d = datetime(2020, 1, 1)
+            while d < datetime(2021, 1, 1):
+                v = d.strftime(formatter.formats[0])
+                parsed = datetime.strptime(v, formatter.formats[0])
+                self.assertEqual(formatter.components(v),
+                                 [parsed.strftime(f) for f in formatter.formats[1:]])
+                d += timedelta(hours=7)
+
+    def test_formatters_slice_bad_date_throw_exception(self):
+        for bad in ["20220230", "20221301", "2022x231"]:
+            with self.assertRaises(ValueError):
+                date_formatter_helper.helpers.format_all_date_keys({"yyyymmdd": bad})
+
+    def test_formatter_cache_hits(self):
+        f = date_formatter_helper.DateFormatHelper(["%Y%m", "%Y", "%m"],
+                                                   ["yyyymm", "yyyymm_yyyy", "yyyymm_mm"])
+        for _ in range(3):
+            m = {"foo_yyyymm": "202212"}
+            f.format_date_key("foo_yyyymm", "202212", m)
+            self.assertEqual(m, {"foo_yyyymm": "202212", "foo_yyyymm_yyyy": "2022",
+                                 "foo_yyyymm_mm": "12"})
+        self.assertEqual((f.hits, f.misses, len(f.cache)), (2, 1, 1))
+
+    def test_formatter_cache_is_bounded(self):
+        f = date_formatter_helper.DateFormatHelper(["%Y%m", "%Y", "%m"],
+                                                   ["yyyymm", "yyyymm_yyyy", "yyyymm_mm"],
+                                                   cacheSize=2)
+        for v in ["202201", "202202", "202201", "202203"]:
+            f.format_date_key("yyyymm", v, {})
+        self.assertEqual(list(f.cache.keys()), [("yyyymm", "202201"), ("yyyymm", "202203")])
+        self.assertEqual((f.hits, f.misses), (1, 3))
+
+    def test_formatters_pickle_and_seed(self):
+        h = date_formatter_helper.DateFormatHelpers(
+            [date_formatter_helper.DateFormatHelper(["%Y%m", "%Y", "%m"],
+                                                    ["yyyymm", "yyyymm_yyyy", "yyyymm_mm"])])
+        h.format_all_date_keys({"yyyymm": "202212"})
+        copy = pickle.loads(pickle.dumps(h))
+        self.assertEqual(copy.formatters[0].cache, h.formatters[0].cache)
+
+        seeded = date_formatter_helper.DateFormatHelpers(
+            [date_formatter_helper.DateFormatHelper(["%Y%m", "%Y", "%m"],
+                                                    ["yyyymm", "yyyymm_yyyy", "yyyymm_mm"])])
+        seeded.seed(copy)
+        seeded.format_all_date_keys({"yyyymm": "202212"})
+        self.assertEqual(seeded.cacheInfo(), (1, 0, 1))
+
 #if __name__ == '__main__':
 #    import sys
 #    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
@@ -0,0 +1,137 @@
+import random
+import unittest
+
+from google.cloud.bigquery import ExternalConfig
+from google.cloud.bigquery.schema import SchemaField
+from google.cloud.bigquery.table import Table
+
+from dependency_index import DependencyIndex
+from loader import get_dryrun_bq_dataset_table
+from resource import BqDatasetBackedResource, BqQueryBackedTableResource, \
+    BqViewBackedTableResource, BqProcessTableResource, \
+    BqDataLoadTableResource, BqGcsTableLoadResource, \
+    BqExtractTableResource, BqExternalTableBasedResource
+
+DATASETS = ["ds", "ds2", "a", "events", "ev", "xds"]
+TABLES = ["t", "at", "t_1", "ds", "events_daily", "dash-named", "a"]
+URIS = ["gs://b/x/*.json", "gs://b/y/*.csv", "gs://c/z/part*"]
+NOISE = ["select", "*", "from", "join", "`", "[", "]", ":", "(", ")",
+         "union all", "\n", "p", "p:", "x", "1"]
+
+
+def pairwiseDependencies(resources: dict) -> dict:
+    """ the dependency resolution DependencyBuilder used before the index
+    """
+    return {rsrc.key(): set([osrc.key() for osrc in resources.values()
+                            if rsrc.dependsOn(osrc)])
+            for rsrc in resources.values()}
+
+
+def indexedDependencies(resources: dict) -> dict:
+    index = DependencyIndex(resources.values())
+    return {rsrc.key(): index.dependencies(rsrc)
+            for rsrc in resources.values()}
+
+
+def randomReference(rnd: random.Random) -> str:
+    ref = rnd.choice([
+        lambda: rnd.choice(DATASETS) + "." + rnd.choice(TABLES),
+        lambda: "p." + rnd.choice(DATASETS) + "." + rnd.choice(TABLES),
+        lambda: "p:" + rnd.choice(DATASETS) + "." + rnd.choice(TABLES),
+        lambda: "extract." + rnd.choice(DATASETS) + "." + rnd.choice(TABLES),
+        lambda: rnd.choice(DATASETS),
+        lambda: rnd.choice(TABLES),
+    ])()
+    return rnd.choice(["", "`", "[", "x", "_"]) + ref
+
+
+def randomQuery(rnd: random.Random) -> str:
+    parts = []
+    for i in range(rnd.randint(0, 12)):
+        parts.append(rnd.choice([randomReference(rnd), rnd.choice(NOISE)]))
+    return rnd.choice([" ", "", "\n"]).join(parts)
+
+
+def randomGraph(seed: int) -> dict:
+    rnd = random.Random(seed)
+    resources = {}
+
+    def add(rsrc):
+        resources[rsrc.key()] = rsrc
+
+    for i in range(rnd.randint(5, 40)):
+        dataset = rnd.choice(DATASETS)
+        table = rnd.choice(TABLES) + rnd.choice(["", "_" + str(i)])
+        dset, tbl = get_dryrun_bq_dataset_table("p", dataset, table)
+        add(BqDatasetBackedResource(dset, None))
+        kind = rnd.randint(0, 7)
+        query = randomQuery(rnd)
+        if kind == 0:
+            add(BqQueryBackedTableResource([query], tbl, None, None, None,
+                                           None, None))
+        elif kind == 1:
+            rsrc = BqViewBackedTableResource([query], tbl, None)
+            rsrc.addQuery(randomQuery(rnd))
+            add(rsrc)
+        elif kind == 2:
+            add(BqProcessTableResource(query, tbl, None, None, None))
+        elif kind == 3:
+            add(BqDataLoadTableResource("afile", tbl, None, None, None))
+        elif kind == 4:
+            uris = rnd.sample(URIS, rnd.randint(1, 2))
+            add(BqGcsTableLoadResource(tbl, None, None, None,
+                                       "\n".join(uris + [query]), None, {}))
+        elif kind == 5:
+            uris = ",".join(rnd.sample(URIS, rnd.randint(1, 2)))
+            add(BqExtractTableResource(tbl, None, None, None, uris, {}))
+        elif kind == 6:
+            table = Table(".".join(["p", dataset, table]),
+                          [SchemaField("a", "STRING")])
+            add(BqExternalTableBasedResource(None, table,
+                                             ExternalConfig("CSV")))
+        else:
+            # the whole query is the key of another resource
+            add(BqQueryBackedTableResource([randomReference(rnd)], tbl,
+                                           None, None, None, None, None))
+    return resources
+
+
+class Test(unittest.TestCase):
+
+    def testIndexMatchesPairwiseOnGeneratedGraphs(self):
+        for seed in range(300):
+            resources = randomGraph(seed)
+            self.assertEqual(pairwiseDependencies(resources),
+                             indexedDependencies(resources),
+                             f"graph seed {seed}")
+
+    def testReferencedKeysAreTokenTails(self):
+        resources = []
+        for dataset, table in [("ds", "t"), ("t", "x")]:
+            dset, tbl = get_dryrun_bq_dataset_table("p", dataset, table)
+            resources.append(BqDatasetBackedResource(dset, None))
+            resources.append(BqViewBackedTableResource(["1"], tbl, None))
+        index = DependencyIndex(resources)
+        self.assertEqual(set(["ds.t", "t"]),
+                         index.referencedKeys("from xds.t "))
+        # key + " " must be strictly shorter than the filtered query
+        self.assertEqual(set(["t"]), index.referencedKeys("ds.t "))
+        self.assertEqual(set(["ds"]), index.referencedKeys(" ds "))
+        self.assertEqual(set(), index.referencedKeys("ds.tx t.x_ "))
+
+    def testResourcesWithoutSpecFallBackToDependsOn(self):
+        class Other:
+            def key(self):
+                return "other"
+
+            def linkSpec(self):
+                return None
+
+            def dependsOn(self, rsrc):
+                return rsrc.key() == "ds.t"
+
+        dset, tbl = get_dryrun_bq_dataset_table("p", "ds", "t")
+        view = BqViewBackedTableResource(["select * from other"], tbl, None)
+        index = DependencyIndex([view, Other()])
+        self.assertEqual(set(["ds.t"]), index.dependencies(Other()))
+        self.assertEqual(set(["other"]), index.dependencies(view))
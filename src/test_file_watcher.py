@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from file_watcher import InotifyFileWatcher, PollingFileWatcher, openFileWatcher
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name + "/"
+        self.write("a.querytemplate", "select 1")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.folder, name), "w") as f:
+            f.write(content)
+
+    def path(self, name):
+        return "/".join([self.tmp.name, name])
+
+    def assertReportsChanges(self, watcher):
+        self.assertEqual(set(), watcher.changes(0))
+        self.write("a.querytemplate", "select 22")
+        self.write("a.querytemplate.vars", "[]")
+        self.assertEqual(set([self.path("a.querytemplate"), self.path("a.querytemplate.vars")]),
+                         watcher.changes(2))
+        os.remove(os.path.join(self.folder, "a.querytemplate.vars"))
+        self.assertEqual(set([self.path("a.querytemplate.vars")]), watcher.changes(2))
+        watcher.close()
+
+    def testPolling(self):
+        self.assertReportsChanges(PollingFileWatcher([self.folder], interval=0.05))
+
+    def testInotify(self):
+        try:
+            watcher = InotifyFileWatcher([self.folder], settle=0.05)
+        except (OSError, AttributeError):
+            self.skipTest("no inotify here")
+        self.assertReportsChanges(watcher)
+
+    def testWaitsForAChange(self):
+        watcher = openFileWatcher([self.folder], interval=0.05)
+        timer = threading.Timer(0.2, self.write, ["b.querytemplate", "select 2"])
+        timer.start()
+        start = time.time()
+        self.assertEqual(set([self.path("b.querytemplate")]), watcher.changes(5))
+        self.assertLess(time.time() - start, 4)
+        watcher.close()
+
+    def testMissingFolderFallsBackOrRaises(self):
+        with self.assertRaises(OSError):
+            openFileWatcher([os.path.join(self.folder, "nope")])
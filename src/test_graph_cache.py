@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+from bqm2 import DependencyBuilder
+from graph_cache import GraphCache
+from loader import DelegatingFileSuffixLoader, BqQueryTemplatingFileLoader, \
+    TableType
+
+
+class CountingLoader(DelegatingFileSuffixLoader):
+    def __init__(self, **kwargs):
+        super(CountingLoader, self).__init__(**kwargs)
+        self.loaded = []
+
+    def load(self, file, dryrun, rendered=None):
+        self.loaded.append(os.path.basename(file))
+        return super(CountingLoader, self).load(file, dryrun, rendered)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.tmp.name, "queries")
+        os.makedirs(self.folder)
+        self.write("a.querytemplate", "select 1")
+        self.write("b.querytemplate", "select * from ds.a")
+        self.write("c.querytemplate", "select * from ds.b join ds.d")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.folder, name), "w") as f:
+            f.write(content)
+
+    def builder(self):
+        loader = CountingLoader(querytemplate=BqQueryTemplatingFileLoader(
+            None, None, None, TableType.TABLE, {"dataset": "ds"}))
+        cache = GraphCache(os.path.join(self.tmp.name, ".bqm2cache"),
+                           salt="{}")
+        return DependencyBuilder(loader, cache)
+
+    def assertSameAsUncached(self, dependencies):
+        builder = self.builder()
+        expected = builder.buildDepend([self.folder], dryrun=True)[1]
+        self.assertEqual(expected, dependencies)
+
+    def testWarmRunLoadsNothing(self):
+        builder = self.builder()
+        cold = builder.buildGraph([self.folder], dryrun=True)
+        self.assertEqual(3, len(builder.loader.loaded))
+        self.assertSameAsUncached(cold)
+
+        builder = self.builder()
+        warm = builder.buildGraph([self.folder], dryrun=True)
+        self.assertEqual([], builder.loader.loaded)
+        self.assertEqual(cold, warm)
+
+    def testOnlyChangedFilesAreLoaded(self):
+        self.builder().buildGraph([self.folder], dryrun=True)
+        self.write("b.querytemplate", "select 2")
+        builder = self.builder()
+        dependencies = builder.buildGraph([self.folder], dryrun=True)
+        self.assertEqual(["b.querytemplate"], builder.loader.loaded)
+        self.assertEqual(set(["ds"]), dependencies["ds.b"])
+        self.assertSameAsUncached(dependencies)
+
+    def testVarsChangeReloadsTemplate(self):
+        self.builder().buildGraph([self.folder], dryrun=True)
+        self.write("a.querytemplate.vars", '[{"table": "a2"}]')
+        builder = self.builder()
+        dependencies = builder.buildGraph([self.folder], dryrun=True)
+        self.assertEqual(["a.querytemplate"], builder.loader.loaded)
+        self.assertTrue("ds.a2" in dependencies)
+        self.assertSameAsUncached(dependencies)
+
+    def testNewKeysRelinkUnchangedFiles(self):
+        self.builder().buildGraph([self.folder], dryrun=True)
+        self.write("d.querytemplate", "select 3")
+        builder = self.builder()
+        dependencies = builder.buildGraph([self.folder], dryrun=True)
+        self.assertEqual(["d.querytemplate"], builder.loader.loaded)
+        self.assertEqual(set(["ds", "ds.b", "ds.d"]), dependencies["ds.c"])
+        self.assertSameAsUncached(dependencies)
+
+    def testRemovedFilesAreForgotten(self):
+        self.builder().buildGraph([self.folder], dryrun=True)
+        os.remove(os.path.join(self.folder, "a.querytemplate"))
+        dependencies = self.builder().buildGraph([self.folder], dryrun=True)
+        self.assertFalse("ds.a" in dependencies)
+        self.assertEqual(set(["ds"]), dependencies["ds.b"])
+        self.assertSameAsUncached(dependencies)
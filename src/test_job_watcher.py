@@ -0,0 +1,75 @@
+import time
+import unittest
+from types import SimpleNamespace
+
+from job_watcher import AdaptiveInterval, JobWatcher, queryProgress
+
+
+def stage(inputs, completed):
+    return SimpleNamespace(parallel_inputs=inputs, completed_parallel_inputs=completed)
+
+
+class Test(unittest.TestCase):
+
+    def testQueryProgress(self):
+        self.assertIsNone(queryProgress(SimpleNamespace()))
+        self.assertIsNone(queryProgress(SimpleNamespace(query_plan=[stage(None, None)])))
+        job = SimpleNamespace(query_plan=[stage(10, 10), stage(30, 10)])
+        self.assertEqual(queryProgress(job), 0.5)
+
+    def testIntervalFromQueryPlan(self):
+        interval = AdaptiveInterval(minimum=1, maximum=60)
+        job = SimpleNamespace(query_plan=[stage(4, 3)])
+        # 3/4 done in 30 seconds, 10 left
+        self.assertEqual(interval("k", job, 30), 5)
+        job = SimpleNamespace(query_plan=[stage(100, 1)])
+        self.assertEqual(interval("k", job, 30), 60)
+        job = SimpleNamespace(query_plan=[stage(100, 100)])
+        self.assertEqual(interval("k", job, 30), 1)
+
+    def testIntervalFromExpectedDuration(self):
+        interval = AdaptiveInterval(minimum=1, maximum=60, expected={"k": 100}.get)
+        self.assertEqual(interval("k", None, 20), 40)
+        # overran what we expected, back off with how long it ran
+        self.assertEqual(interval("k", None, 120), 30)
+        self.assertEqual(interval("other", None, 20), 5)
+
+    def testIntervalDoublesWhileQueued(self):
+        interval = AdaptiveInterval(minimum=1, maximum=60)
+        job = SimpleNamespace(slot_millis=0)
+        self.assertEqual(interval("k", job, 8), 2)
+        self.assertEqual(interval("k", job, 8), 4)
+        job.slot_millis = 500
+        self.assertEqual(interval("k", job, 8), 2)
+
+    def testWatcherChecksPolledJobsAtTheirInterval(self):
+        watcher = JobWatcher(30, interval=lambda key, job, elapsed: 0.05)
+        watcher.watch("k", object())
+        start = time.time()
+        self.assertEqual(watcher.wait(), set(["k"]))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(watcher.watched, {})
+
+    def testOneCallbackPerJob(self):
+        callbacks = []
+        job = SimpleNamespace(add_done_callback=callbacks.append)
+        watcher = JobWatcher(30)
+        watcher.watch("k", job)
+        callbacks[0](job)
+        self.assertEqual(watcher.wait(), set(["k"]))
+        # still running when evaluated, so watched again
+        watcher.watch("k", job)
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0](job)
+        self.assertEqual(watcher.wait(), set(["k"]))
+
+    def testCallbacksOfKeysNotWatchedAreDropped(self):
+        callbacks = []
+        job = SimpleNamespace(add_done_callback=callbacks.append)
+        watcher = JobWatcher(30)
+        watcher.watch("k", job)
+        callbacks[0](job)
+        self.assertEqual(watcher.wait(), set(["k"]))
+        # i.e. a reload on the main thread calling back again
+        callbacks[0](job)
+        self.assertEqual(watcher.wait(timeout=0.05), set())
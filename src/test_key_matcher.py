@@ -0,0 +1,34 @@
+import random
+import unittest
+
+from key_matcher import KeyMatcher
+
+
+class Test(unittest.TestCase):
+
+    def testFindsOverlappingPatterns(self):
+        matcher = KeyMatcher(["he", "she", "his", "hers"])
+        self.assertEqual(set(["he", "she", "hers"]),
+                         matcher.findAll("ushers"))
+        self.assertEqual(set(), matcher.findAll("hxs"))
+
+    def testPatternsWhichAreSuffixesOfOthers(self):
+        matcher = KeyMatcher(["ds.t ", "t ", "xds.t "])
+        self.assertEqual(set(["ds.t ", "t "]),
+                         matcher.findAll("select from ds.t "))
+        self.assertEqual(set(["t "]), matcher.findAll("ds.tt "))
+
+    def testPatternsWithSpaces(self):
+        matcher = KeyMatcher(["ds.my table "])
+        self.assertEqual(set(["ds.my table "]),
+                         matcher.findAll("from ds.my table x "))
+
+    def testMatchesSubstringSearch(self):
+        rnd = random.Random(7)
+        for i in range(200):
+            patterns = ["".join(rnd.choice("ab. ")
+                                for j in range(rnd.randint(1, 5)))
+                        for k in range(rnd.randint(1, 20))]
+            text = "".join(rnd.choice("ab. ") for j in range(60))
+            expected = set([p for p in patterns if p in text])
+            self.assertEqual(expected, KeyMatcher(patterns).findAll(text))
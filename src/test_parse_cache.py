@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from loader import loadSchemaFromString
+from parse_cache import ParseCache
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ParseCache()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def testYamlParsedOnceAndCopied(self):
+        path = self.write("local.vars", "a: 1\nb: {c: [1, 2]}\n")
+        first = self.cache.loadYaml(path)
+        first["b"]["c"].append(3)
+        second = self.cache.loadYaml(path)
+        self.assertEqual(second, {"a": 1, "b": {"c": [1, 2]}})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def testChangedFileIsParsedAgain(self):
+        path = self.write("local.vars", "a: 1\n", mtime=1000)
+        self.assertEqual(self.cache.loadYaml(path), {"a": 1})
+        self.write("local.vars", "a: 22\n", mtime=1000)
+        self.assertEqual(self.cache.loadYaml(path), {"a": 22})
+        self.write("local.vars", "a: 33\n", mtime=2000)
+        self.assertEqual(self.cache.loadYaml(path), {"a": 33})
+        self.assertEqual(self.cache.misses, 3)
+
+    def testSchemaAndTextKeptApart(self):
+        path = self.write("t.schema", " a:STRING,b:INTEGER\n")
+        schema = self.cache.loadSchema(path, loadSchemaFromString)
+        self.assertEqual([f.name for f in schema], ["a", "b"])
+        self.assertEqual(self.cache.read(path), " a:STRING,b:INTEGER\n")
+        schema.pop()
+        self.assertEqual(len(self.cache.loadSchema(path, loadSchemaFromString)), 2)
+
+    def testMissingFileRaises(self):
+        with self.assertRaises(FileNotFoundError):
+            self.cache.loadYaml(os.path.join(self.tmp.name, "nope.vars"))
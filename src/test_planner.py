@@ -0,0 +1,39 @@
+import unittest
+
+from planner import Plan, formatBytes, parseBytes
+
+
+class Test(unittest.TestCase):
+
+    def testParseBytes(self):
+        self.assertEqual(parseBytes("5000"), 5000)
+        self.assertEqual(parseBytes("2KB"), 2048)
+        self.assertEqual(parseBytes("1.5 tb"), int(1.5 * 1024 ** 4))
+        self.assertEqual(parseBytes("200GiB"), 200 * 1024 ** 3)
+        with self.assertRaises(Exception):
+            parseBytes("lots")
+        with self.assertRaises(Exception):
+            parseBytes("1.2.3GB")
+
+    def testFormatBytes(self):
+        self.assertEqual(formatBytes(0), "0 B")
+        self.assertEqual(formatBytes(1023), "1023 B")
+        self.assertEqual(formatBytes(1536), "1.50 KB")
+        self.assertEqual(formatBytes(3 * 1024 ** 4), "3.00 TB")
+        self.assertEqual(formatBytes(2048 * 1024 ** 5), "2048.00 PB")
+
+    def testPlanReport(self):
+        plan = Plan()
+        plan.add("ds.a", "missing", "p.ds")
+        plan.add("ds.v", "changed", "p.ds")
+        plan.bytes["ds.a"] = 2048
+        plan.criticalPath = ["ds.a"]
+        plan.criticalSeconds = 12.3
+        self.assertEqual(str(plan), "\n".join([
+            "plan:",
+            "  would execute ds.a because missing, 2.00 KB",
+            "  would execute ds.v because changed, not a query",
+            "bytes processed per dataset:",
+            "  p.ds: 2.00 KB",
+            "total bytes processed: 2.00 KB (2048) by 1 queries",
+            "critical path (1 resources, ~12 seconds): ds.a"]))
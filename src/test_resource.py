@@ -1,16 +1,22 @@
 import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 
 import mock
 from google.cloud.bigquery.client import Client
 from google.cloud.bigquery.dataset import Dataset
 from google.cloud.bigquery.job import SourceFormat
 from google.cloud.bigquery.job import QueryJob
+from google.cloud.bigquery.external_config import ExternalConfig
+from google.cloud.bigquery.schema import SchemaField
 from google.cloud.bigquery.table import Table
+from google.cloud.exceptions import NotFound
 
 import resource
 from resource import strictSubstring, \
     BqDatasetBackedResource, BqViewBackedTableResource, \
-    BqQueryBasedResource, BqDataLoadTableResource
+    BqQueryBasedResource, BqDataLoadTableResource, \
+    BqExternalTableBasedResource
 
 import pytest
 
@@ -322,5 +328,262 @@ def testPrintNoErrorResultToStdout(capsys):
     assert not err
     assert out is not None
 
+
+def testTableSnapshotOneGetTablePerCheck():
+    resource.tables.clear()
+    view = BqViewBackedTableResource(["select 1"], Table("p.snap.v"), None)
+    client = mock.Mock()
+    client.get_table.return_value = Table.from_api_repr({
+        "tableReference": {"projectId": "p", "datasetId": "snap",
+                           "tableId": "v"},
+        "lastModifiedTime": "1700000000000",
+        "description": view.makeQueryHashTag()})
+    view.bqClient = client
+
+    assert view.exists()
+    assert not view.shouldUpdate()
+    assert view.updateTime() == 1700000000000
+    assert client.get_table.call_count == 1
+
+    view.invalidate()
+    view.updateTime()
+    assert client.get_table.call_count == 2
+
+
+def testTableSnapshotRemembersMissingTables():
+    resource.tables.clear()
+    client = mock.Mock()
+    client.get_table.side_effect = NotFound("no table")
+    view = BqViewBackedTableResource(["select 1"], Table("p.snap.gone"),
+                                     client)
+
+    assert not view.exists()
+    assert not view.exists()
+    with pytest.raises(NotFound):
+        view.updateTime()
+    assert client.get_table.call_count == 1
+
+
+def prefetchClient(rows):
+    client = mock.Mock()
+    client.query.return_value.result.return_value = rows
+    client.get_table.side_effect = NotFound("no table")
+    return client
+
+
+def testPrefetchServesDatasetFromSnapshot():
+    resource.tables.clear()
+    view = BqViewBackedTableResource(["select 1"], Table("p.pre.v"), None)
+    described = '"made by\\nbqm2 ' + view.makeQueryHashTag() + '"'
+    client = prefetchClient([
+        {"table_id": "v", "type": 2, "creation_time": 1600000000000,
+         "last_modified_time": 1700000000000, "description": described,
+         "expiration": 'TIMESTAMP "2030-01-02T03:04:05.000Z"'},
+        {"table_id": "odd", "type": 1, "creation_time": 1,
+         "last_modified_time": 2, "description": "not a literal",
+         "expiration": None}])
+    view.bqClient = client
+    resource.tables.prefetch(client, [Table("p.pre.v"), Table("p.pre.w")])
+    assert client.query.call_count == 1
+
+    assert view.exists()
+    assert not view.shouldUpdate()
+    assert view.updateTime() == 1700000000000
+    assert view.table.description.startswith("made by\nbqm2")
+    assert view.table.expires.year == 2030
+    assert not resource.tables.tableExists(client, Table("p.pre.missing"))
+    assert client.get_table.call_count == 0
+
+    # undecodable and invalidated tables are left to get_table
+    assert not resource.tables.tableExists(client, Table("p.pre.odd"))
+    view.invalidate()
+    assert not view.exists()
+    assert client.get_table.call_count == 2
+
+
+def testPrefetchedExternalTableIsCreatedAsDefined():
+    resource.tables.clear()
+    config = ExternalConfig("CSV")
+    config.source_uris = ["gs://bucket/ext/*.csv"]
+    table = Table("p.preext.e", schema=[SchemaField("a", "STRING")])
+    external = BqExternalTableBasedResource(None, table, config)
+    client = prefetchClient([
+        {"table_id": "e", "type": 3, "creation_time": 1600000000000,
+         "last_modified_time": 1700000000000, "description": None,
+         "expiration": None}])
+    client.create_table.side_effect = lambda table: table
+    external.bqClient = client
+    resource.tables.prefetch(client, [table])
+
+    assert external.updateTime() == 1700000000000
+    assert external.shouldUpdate()
+    external.create()
+    created = client.create_table.call_args[0][0]
+    assert created.external_data_configuration.source_uris == \
+        ["gs://bucket/ext/*.csv"]
+    assert [f.name for f in created.schema] == ["a"]
+    assert client.get_table.call_count == 0
+
+
+def testPrefetchLeavesFailedDatasetsToGetTable():
+    resource.tables.clear()
+    client = prefetchClient([])
+    client.query.side_effect = NotFound("no dataset")
+    resource.tables.prefetch(client, [Table("p.nods.t")])
+    assert not resource.tables.tableExists(client, Table("p.nods.t"))
+    assert client.get_table.call_count == 1
+
+
+def testJobIdPrefixOfDashedTables():
+    assert "create-ds-my-table" == resource.build_jobid_prefix_key_from_jobid(
+        resource.makeJobName(["create", "ds", "my-table"]))
+    assert "create-ds-t" == resource.build_jobid_prefix_key_from_jobid(
+        "create-ds-t-legacy")
+    assert resource.build_jobid_prefix_key_from_jobid("bquxjob_1") is None
+
+
+def jobsClient(pagesByState):
+    consumed = []
+
+    def pages(state):
+        for number, page in enumerate(pagesByState.get(state, [])):
+            consumed.append((state, number))
+            yield page
+
+    def list_jobs(**kwargs):
+        assert kwargs["min_creation_time"] is not None
+        return SimpleNamespace(pages=pages(kwargs["state_filter"]))
+
+    client = mock.Mock()
+    client.list_jobs.side_effect = list_jobs
+    return client, consumed
+
+
+def listedJob(name, destination=None, state="RUNNING", hoursAgo=1):
+    return SimpleNamespace(job_id=name if name.startswith("bquxjob") else
+                           resource.makeJobName(["create", "ds", name]),
+                           destination=destination, state=state,
+                           created=datetime.now(timezone.utc) - timedelta(hours=hoursAgo))
+
+
+def testLoadTableJobsStopsOnceWantedTablesAreFound():
+    mine = listedJob("a")
+    foreign = listedJob("bquxjob_1", destination=Dataset("p.ds").table("b-c"))
+    other = listedJob("z")
+    client, consumed = jobsClient({"running": [[mine], [foreign], [other]],
+                                   "pending": [[other]]})
+    jobs = resource.BqJobs(client)
+    jobs.loadTableJobs(set(["create-ds-a", "create-ds-b-c"]))
+
+    assert jobs.getJobForTable(Table("p.ds.a"), "create") is mine
+    assert jobs.getJobForTable(Table("p.ds.b-c"), "create") is foreign
+    assert ("running", 2) not in consumed
+    assert sorted([call.kwargs["state_filter"]
+                   for call in client.list_jobs.call_args_list]) \
+        == ["pending", "running"]
+
+
+def testLoadTableJobsStopsAtTheWindow():
+    recent = listedJob("a")
+    old = listedJob("b", hoursAgo=30)
+    client, consumed = jobsClient({"running": [[recent], [old], [listedJob("c")]]})
+    jobs = resource.BqJobs(client)
+    # most managed tables have no running job
+    jobs.loadTableJobs(set(["create-ds-a", "create-ds-b", "create-ds-x"]))
+    assert jobs.getJob("create-ds-a") is recent
+    assert jobs.getJob("create-ds-b") is None
+    assert ("running", 2) not in consumed
+    assert client.list_jobs.call_args.kwargs["min_creation_time"].tzinfo is not None
+
+
+def testLoadTableJobsPrefersRunningJobs():
+    pending = listedJob("a", state="PENDING", hoursAgo=0)
+    running = listedJob("a")
+    for order in [["pending", "running"], ["running", "pending"]]:
+        client, consumed = jobsClient({"running": [[running]], "pending": [[pending]]})
+        jobs = resource.BqJobs(client)
+        for state in order:
+            jobs.__loadTableJobs__(state)
+        assert jobs.getJob("create-ds-a") is running, order
+
+
+def testLoadTableJobsScansWindowWithoutWanted():
+    job = listedJob("a")
+    client, consumed = jobsClient({"running": [[], [job]]})
+    jobs = resource.BqJobs(client)
+    jobs.loadTableJobs()
+    assert jobs.getJob("create-ds-a") is job
+    assert ("running", 1) in consumed
+
+
+def trackedJob(jobId, state, reloads):
+    job = QueryJob(jobId, "select 1", client=SimpleNamespace(project="p"))
+
+    def setState(state):
+        job._set_properties({"jobReference": {"projectId": "p", "jobId": jobId},
+                             "status": {"state": state},
+                             "statistics": {"creationTime": "1700000000000"},
+                             "configuration": {"query": {"query": "select 1"}}})
+
+    def reload():
+        reloads.append(jobId)
+        setState("DONE")
+
+    setState(state)
+    job.reload = reload
+    return job
+
+
+def testJobTrackerListsRatherThanReloads():
+    reloads = []
+    jobs = [trackedJob(f"create-ds-t{i}", "RUNNING", reloads) for i in range(100)]
+    listed = [trackedJob(job.job_id, "RUNNING", []) for job in jobs[1:]]
+    client, consumed = jobsClient({"running": [listed[:60], listed[60:]], "pending": [[]]})
+    tracker = resource.JobTracker(client, since=datetime.now(timezone.utc))
+    done = []
+    for job in jobs:
+        tracker.track(job, done.append)
+
+    tracker.refresh()
+    # 3 pages and the one job no longer listed
+    assert tracker.calls == 4
+    assert reloads == ["create-ds-t0"]
+    assert done == [jobs[0]]
+    assert len(tracker.jobs) == 99
+    assert client.list_jobs.call_args.kwargs["min_creation_time"] \
+        == datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)
+
+    # refreshed jobs are not reloaded again by isRunning
+    assert resource.isJobRunning(jobs[1])
+    assert not resource.isJobRunning(jobs[0])
+    assert reloads == ["create-ds-t0"]
+
+
+def testJobTrackerUpdatesJobsInPlace():
+    job = trackedJob("create-ds-a", "PENDING", [])
+    client, _ = jobsClient({"running": [[trackedJob("create-ds-a", "RUNNING", [])]]})
+    tracker = resource.JobTracker(client, since=datetime.now(timezone.utc))
+    tracker.track(job, lambda job: None)
+    tracker.refresh()
+    assert job.state == "RUNNING"
+
+
+def test_query_jobs_labelled_with_definition():
+    client = mock.Mock()
+    config = resource.QueryJobConfig(labels={"team": "data"})
+    rsrc = resource.BqQueryBackedTableResource(
+        ["select 1"], Table("p.ds.t"), client, None, config, None, None)
+    rsrc.create()
+    jobConfig = client.query.call_args.kwargs["job_config"]
+    label = rsrc.makeQueryHashTag().split(":")[1]
+    assert jobConfig.labels == {"team": "data", resource.DEFINITION_LABEL: label}
+    assert config.labels == {"team": "data"}
+
+    assert rsrc.jobIsCurrent(SimpleNamespace(labels={resource.DEFINITION_LABEL: label}))
+    assert not rsrc.jobIsCurrent(SimpleNamespace(labels={resource.DEFINITION_LABEL: "x"}))
+    # jobs from before labels
+    assert rsrc.jobIsCurrent(SimpleNamespace(labels={}, query="select 1"))
+    assert not rsrc.jobIsCurrent(SimpleNamespace(labels={}, query="select 2"))
+
 #if __name__ == '__main__':
 #    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from google.api_core.exceptions import BadRequest, Forbidden, InternalServerError, \
+    TooManyRequests
+
+from retry_policy import PERMANENT, QUOTA, TRANSIENT, RetryPolicy, classifyError
+
+
+class Test(unittest.TestCase):
+
+    def testClassifyJobErrors(self):
+        self.assertEqual(classifyError({"reason": "rateLimitExceeded"}), QUOTA)
+        self.assertEqual(classifyError({"reason": "quotaExceeded"}), QUOTA)
+        self.assertEqual(classifyError({"reason": "invalidQuery"}), PERMANENT)
+        self.assertEqual(classifyError({"reason": "backendError"}), TRANSIENT)
+        self.assertEqual(classifyError({"reason": "somethingNew"}), TRANSIENT)
+
+    def testClassifyApiErrors(self):
+        self.assertEqual(classifyError(Forbidden(
+            "too many", errors=[{"reason": "rateLimitExceeded"}])), QUOTA)
+        self.assertEqual(classifyError(Forbidden("no")), PERMANENT)
+        self.assertEqual(classifyError(TooManyRequests("slow down")), QUOTA)
+        self.assertEqual(classifyError(BadRequest(
+            "bad", errors=[{"reason": "invalid"}])), PERMANENT)
+        self.assertEqual(classifyError(InternalServerError("oops")), TRANSIENT)
+        self.assertEqual(classifyError(Exception("what")), TRANSIENT)
+
+    def testDelayDoublesWithJitter(self):
+        policy = RetryPolicy(base=2, quotaBase=30, cap=100, random=lambda: 0.5)
+        self.assertEqual([policy.delay(TRANSIENT, n) for n in range(4)],
+                         [1.5, 3, 6, 12])
+        self.assertEqual(policy.delay(QUOTA, 0), 22.5)
+        self.assertEqual(policy.delay(QUOTA, 5), 75)
+        self.assertEqual(RetryPolicy(base=2, random=lambda: 0).delay(TRANSIENT, 1), 2)
+        self.assertEqual(RetryPolicy(base=2, random=lambda: 1).delay(TRANSIENT, 1), 4)
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from scheduling import PrioritySlots, RunHistory, criticalPath, criticalPaths
+
+
+class Test(unittest.TestCase):
+
+    def testCriticalPaths(self):
+        dependencies = {"a": set(), "b": set(["a"]), "c": set(["b"]), "d": set(["a"]),
+                        "e": set(["outside"])}
+        durations = {"a": 1, "b": 5, "c": 1, "d": 2, "e": 3}
+        self.assertEqual(criticalPaths(dependencies, durations.get),
+                         {"a": 7, "b": 6, "c": 1, "d": 2, "e": 3})
+
+    def testCriticalPath(self):
+        dependencies = {"a": set(), "b": set(["a"]), "c": set(["b"]), "d": set(["a"]),
+                        "e": set(["outside"])}
+        durations = {"a": 1, "b": 5, "c": 1, "d": 2, "e": 3}
+        self.assertEqual(criticalPath(dependencies, durations.get), ["a", "b", "c"])
+        durations["d"] = 9
+        self.assertEqual(criticalPath(dependencies, durations.get), ["a", "d"])
+        self.assertEqual(criticalPath({}, durations.get), [])
+
+    def testRunHistoryAverages(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "history.json")
+            history = RunHistory(path).load()
+            self.assertEqual(history.duration("a"), 1.0)
+            history.record("a", 10)
+            history.record("a", 20)
+            history.record("b", 2)
+            history.save()
+
+            loaded = RunHistory(path).load()
+            self.assertEqual(loaded.duration("a"), 15)
+            self.assertEqual(loaded.duration("never"), 8.5)
+
+    def testRunHistoryIgnoresBadFile(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "history.json")
+            with open(path, "w") as f:
+                f.write("not json")
+            self.assertEqual(RunHistory(path).load().durations, {})
+
+    def testPrioritySlotsWakeLowestFirst(self):
+        order = []
+
+        async def run():
+            slots = PrioritySlots(1)
+
+            async def work(name, priority):
+                async with slots.slot(priority):
+                    order.append(name)
+                    await asyncio.sleep(0.01)
+
+            await slots.acquire()
+            tasks = [asyncio.create_task(work(name, priority))
+                     for (name, priority) in [("c", (3,)), ("a", (1,)), ("b", (2,))]]
+            await asyncio.sleep(0.01)
+            cancelled = asyncio.create_task(work("x", (0,)))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            slots.release()
+            await asyncio.gather(*tasks)
+            self.assertEqual(slots.free, 1)
+
+        asyncio.run(run())
+        self.assertEqual(order, ["a", "b", "c"])
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from google.cloud.exceptions import NotFound
+
+from state_store import SqliteStateStore, BqStateStore, openStateStore
+
+
+class Test(unittest.TestCase):
+
+    def testSqliteRoundTrip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "state.db")
+            store = openStateStore("sqlite:" + path, None)
+            self.assertIsNone(store.get("ds.t"))
+            store.put("ds.t", "queryhash:1", "create-ds-t-1", 1000)
+            store.put("ds.u", "queryhash:2")
+
+            again = openStateStore("sqlite:" + path, None)
+            self.assertEqual({"key": "ds.t", "definition_hash": "queryhash:1",
+                              "job_id": "create-ds-t-1",
+                              "dep_update_time": 1000},
+                             again.get("ds.t"))
+            self.assertEqual("queryhash:2",
+                             again.get("ds.u")["definition_hash"])
+
+            again.put("ds.t", "queryhash:1", "create-ds-t-1", 1000)
+            self.assertEqual(set(), again.dirty)
+
+    def testBqStoreReadsOnceAndWritesOnce(self):
+        client = mock.Mock()
+        client.list_rows.side_effect = NotFound("no state yet")
+        store = BqStateStore(client, "p.ds.state")
+        store.load()
+        self.assertEqual({}, store.records)
+
+        store.save()
+        client.load_table_from_json.assert_not_called()
+        store.put("ds.t", "queryhash:1")
+        store.put("ds.a", "queryhash:2")
+        store.save()
+        self.assertEqual(1, client.load_table_from_json.call_count)
+        rows = client.load_table_from_json.call_args[0][0]
+        self.assertEqual(["ds.a", "ds.t"], [row["key"] for row in rows])
+
+    def testUnknownStore(self):
+        with self.assertRaises(Exception):
+            openStateStore("postgres:somewhere", None)
@@ -1,11 +1,15 @@
 import json
+import string
+import timeit
 import unittest
 
 from datetime import datetime, timedelta
 
+from dateutil.relativedelta import relativedelta
 from frozendict import frozendict
 
-from tmplhelper import explodeTemplate, handleDateField, evalTmplRecurse
+from tmplhelper import explodeTemplate, handleDateField, evalTmplRecurse, \
+    iterExplodeTemplate, keysOfTemplate, compileTemplate, resolutionOrder
 
 
 class Test(unittest.TestCase):
@@ -25,6 +29,24 @@ class Test(unittest.TestCase):
                 "Should have thrown circular ref error")
             pass
 
+    def testEvalTmplRecurseCircularNamesKeysOnCycle(self):
+        input = {"a": "{b}", "b": "{a}", "c": "{a}_{d}", "d": "{d}",
+                 "e": "e", "filename": "f"}
+        with self.assertRaises(Exception) as raised:
+            evalTmplRecurse(input)
+        self.assertIn("template f vars: ['a', 'b', 'd'] contains a "
+                      "circular reference", str(raised.exception))
+
+    def testEvalTmplRecurseSharesOrderAcrossExpansions(self):
+        resolutionOrder.cache_clear()
+        for i in range(50):
+            result = evalTmplRecurse({"table": "{name}_{yyyymmdd}",
+                                      "name": "t_{region}",
+                                      "region": f"r{i}",
+                                      "yyyymmdd": "20240101"})
+            self.assertEqual(f"t_r{i}_20240101", result["table"])
+        self.assertEqual(1, resolutionOrder.cache_info().misses)
+
     def testEvalTmplRecurseUnmapped(self):
         input = {"a": '{b}', "c": "{a}"}
         try:
@@ -166,6 +188,25 @@ class Test(unittest.TestCase):
         expected = sorted(['20051230', '20051229', '20051228'])
         self.assertEqual(result, expected)
 
+    def testHandleDateFieldMatchesStrftime(self):
+        d = datetime(2024, 2, 29, 13, 45, 12)
+        units = {"yyyy": ("years", "%Y"), "yyyymm": ("months", "%Y%m"),
+                 "yyyymmdd": ("days", "%Y%m%d"), "yyyymmddhh": ("hours", "%Y%m%d%H")}
+        for key, (param, fmt) in units.items():
+            expected = sorted([(d + relativedelta(**{param: v})).strftime(fmt)
+                               for v in range(-30, 31)])
+            self.assertEqual(handleDateField(d, [30, -30], "foo_" + key), expected)
+
+    def testHandleDateFieldYearOfHours(self):
+        d = datetime(2023, 3, 26, 1, 30)
+        result = handleDateField(d, [-8760, 0], "yyyymmddhh")
+        expected = sorted([(d + timedelta(hours=v)).strftime("%Y%m%d%H")
+                           for v in range(-8760, 1)])
+        self.assertEqual(result, expected)
+        # the same range in another template, later in the hour, is shared
+        self.assertEqual(handleDateField(d.replace(minute=59), [-8760, 0], "bar_yyyymmddhh"),
+                         expected)
+
     def testExplodeTemplateSingleVar(self):
         templateVars = {"table": "{filename}_{keywords_table}",
                         "keywords_table": "url_kw",
@@ -283,6 +324,91 @@ class Test(unittest.TestCase):
         result = set(frozendict(x) for x in result)
         self.assertEqual(expected, result)
 
+    def testExplodeTemplateNestedOrder(self):
+        templateVars = {"a": ["1", "2"],
+                        "d": [{"e": ["x", "y"], "h": "i"}, {"e": "z"}],
+                        "b": ["3", "4"]}
+        result = [(m["a"], m["e"], m["b"]) for m in explodeTemplate(templateVars)]
+        self.assertEqual([("1", "x", "3"), ("1", "y", "3"),
+                          ("1", "x", "4"), ("1", "y", "4"),
+                          ("1", "z", "3"), ("1", "z", "4"),
+                          ("2", "x", "3"), ("2", "y", "3"),
+                          ("2", "x", "4"), ("2", "y", "4"),
+                          ("2", "z", "3"), ("2", "z", "4")], result)
+
+    def testIterExplodeTemplateIsLazy(self):
+        templateVars = {"yyyymmddhh": [-24 * 90, 0],
+                        "region": [str(i) for i in range(30)],
+                        "variant": [{"v": str(i)} for i in range(4)]}
+        expansions = iterExplodeTemplate(templateVars)
+        first = next(expansions)
+        self.assertEqual("0", first["region"])
+        self.assertEqual("0", first["v"])
+        self.assertEqual(30 * 4 * (24 * 90 + 1),
+                         1 + sum(1 for _ in expansions))
+
+    def testCompiledTemplateMatchesStrFormat(self):
+        values = {"a": "x", "b": 2, "c": 1.5, "d-e": "dash", "f": ["l"]}
+        for template in ["", "plain", "{a}", "{{a}} {a}{b}", "}}{{{c}}}",
+                         "{b:03d} {a!r}", "{f[0]}", "{d-e}", "x {a} {a} y"]:
+            self.assertEqual(template.format(**values),
+                             compileTemplate(template).format(values),
+                             template)
+
+        for template in ["{missing}", "{a} {missing:>3}"]:
+            with self.assertRaises(KeyError) as expected:
+                template.format(**values)
+            with self.assertRaises(KeyError) as compiled:
+                compileTemplate(template).format(values)
+            self.assertEqual(expected.exception.args, compiled.exception.args)
+
+        with self.assertRaises(IndexError):
+            compileTemplate("{}").format(values)
+        with self.assertRaises(ValueError):
+            compileTemplate("{a")
+
+    def testCompiledTemplateMatchesFormat(self):
+        """ keys and rendering of a template for wide date range expansions
+        are what keysOfTemplate and str.format gave before, from one
+        compile of the template """
+        template = "select * from `{project}.{dataset}.events_{yyyymmdd}` " \
+                   "where region = '{region}' and {{escaped}} = 1\n" * 4
+        expansions = [{"project": "p", "dataset": "d", "region": "eu",
+                       "yyyymmdd": str(20240000 + i)} for i in range(500)]
+        keys = set([x[1] for x in string.Formatter().parse(template) if x[1]])
+
+        compileTemplate.cache_clear()
+        for v in expansions:
+            self.assertEqual(keysOfTemplate(template), keys)
+            self.assertEqual(compileTemplate(template).format(v), template.format(**v))
+        info = compileTemplate.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2 * len(expansions) - 1)
+
+    def testCompiledTemplateBenchmark(self):
+        """ compiled templates against parsing and str.format on every
+        expansion.  Only reports the times unless compiling is far slower,
+        i.e. as the cache stopped working, so loaded machines don't fail it """
+        template = "select * from `{project}.{dataset}.events_{yyyymmdd}` " \
+                   "where region = '{region}' and {{escaped}} = 1\n" * 40
+        expansions = [{"project": "p", "dataset": "d", "region": "eu",
+                       "yyyymmdd": str(20240000 + i)} for i in range(2000)]
+
+        def parsedEveryTime():
+            for v in expansions:
+                set([x[1] for x in string.Formatter().parse(template) if x[1]])
+                template.format(**v)
+
+        def compiled():
+            for v in expansions:
+                keysOfTemplate(template)
+                compileTemplate(template).format(v)
+
+        before = min(timeit.repeat(parsedEveryTime, number=1, repeat=3))
+        after = min(timeit.repeat(compiled, number=1, repeat=3))
+        print(f"parsed every time {before:.4f}s, compiled {after:.4f}s")
+        self.assertLess(after, before * 2)
+
     def testBuildTemplateWithEmptyTable(self):
 
         n = datetime.today()
@@ -1,3 +1,5 @@
+import functools
+import itertools
 import string
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
@@ -24,49 +26,35 @@ def evalTmplRecurse(templateKeys: dict):
     find the k,v which are not templates and use them to format the
     unformatted values that we can.
 
+    Values are formatted in the order resolutionOrder gives for the
+    references among them, which is shared by all expansions of a vars
+    file.
+
     :param templateKeys: The values of the dict may be a template.
     :return: dict with same keys as templateKeys but fully formatted values
     """
     templateKeysCopy = templateKeys.copy()
-    keysNeeded = {}
-    usableKeys = {}
 
     helpers.format_all_date_keys(templateKeysCopy)
-    all_keys_needed = set()
 
-    for (k, v) in templateKeysCopy.items():
-        keys = keysOfTemplate(v)
-        if len(keys):
-            keysNeeded[k] = keys
-            all_keys_needed.update(keys)
-        else:
-            # format removes any {.} escaping
-            if isinstance(templateKeysCopy[k], str):
-                templateKeysCopy[k] = templateKeysCopy[k].format()
-            usableKeys[k] = templateKeysCopy[k]
+    (order, missing_keys, circular) = resolutionOrder(tuple([
+        (k, isinstance(v, str) and compileTemplate(v).keys or frozenset())
+        for (k, v) in templateKeysCopy.items()]))
 
-    missing_keys = all_keys_needed - set(templateKeysCopy.keys())
     if missing_keys:
         location = _get_template_key_location(templateKeys)
         raise Exception(f"template {location} vars: key contains unmapped value " +
-                        str(missing_keys))
-    while len(keysNeeded):
-        remaining = len(keysNeeded)
-        for (k, v) in templateKeysCopy.items():
-            if k in usableKeys:
-                continue
-
-            needed = keysNeeded[k]
-            if needed.issubset(usableKeys.keys()):
-                templateKeysCopy[k] = templateKeysCopy[k].format(
-                    **usableKeys)
-                usableKeys[k] = templateKeysCopy[k]
-                del keysNeeded[k]
+                        str(set(missing_keys)))
+    if circular:
+        location = _get_template_key_location(templateKeys)
+        raise Exception(f"template {location} vars: " +
+                        str(list(circular)) + " contains a circular reference")
 
-        if remaining == len(keysNeeded):
-            location = _get_template_key_location(templateKeys)
-            raise Exception(f"template {location} vars: " +
-                            str(keysNeeded) + " contains a circular reference")
+    for k in order:
+        # format also removes any {.} escaping
+        if isinstance(templateKeysCopy[k], str):
+            templateKeysCopy[k] = compileTemplate(
+                templateKeysCopy[k]).format(templateKeysCopy)
 
     for k, v in templateKeysCopy.items():
         if k.endswith("_dash2uscore"):
@@ -75,10 +63,112 @@ def evalTmplRecurse(templateKeys: dict):
     return templateKeysCopy
 
 
+@functools.lru_cache(maxsize=1024)
+def resolutionOrder(references: tuple) -> tuple:
+    """
+    :param references: (key, keys its value refers to) for each var
+    :return: (keys in an order where each key comes after the keys it
+    refers to, keys referred to which aren't vars, keys on a cycle of
+    references).  The order is only given when there are neither
+    missing keys nor cycles
+    """
+    needed = dict(references)
+    missing = frozenset().union(*needed.values()) - needed.keys()
+    if missing:
+        return ((), frozenset(missing), ())
+
+    dependants = {k: [] for k in needed}
+    waiting = {}
+    for (k, refs) in references:
+        waiting[k] = len(refs)
+        for ref in refs:
+            dependants[ref].append(k)
+
+    order = [k for (k, refs) in references if not refs]
+    for k in order:
+        for dependant in dependants[k]:
+            waiting[dependant] -= 1
+            if not waiting[dependant]:
+                order.append(dependant)
+
+    if len(order) == len(needed):
+        return (tuple(order), frozenset(), ())
+
+    # keys left wait on a cycle, name those on one
+    left = set(needed.keys()) - set(order)
+
+    def reaches(start, target):
+        seen = set()
+        stack = [r for r in needed[start] if r in left]
+        while stack:
+            k = stack.pop()
+            if k == target:
+                return True
+            if k not in seen:
+                seen.add(k)
+                stack.extend([r for r in needed[k] if r in left])
+        return False
+
+    return ((), frozenset(), tuple(sorted([k for k in left if reaches(k, k)])))
+
+
 def keysOfTemplate(strr):
     if not isinstance(strr, str):
         return set()
-    return set([x[1] for x in string.Formatter().parse(strr) if x[1]])
+    return set(compileTemplate(strr).keys)
+
+
+class CompiledTemplate:
+    """ A str.format template parsed once into its literal text and
+    field names.  format joins the pieces rather than parsing the
+    template again.  Templates with positional fields, attribute or
+    index lookups, conversions or format specs are left to str.format.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.pieces = []  # (isLiteral, literal text or field name)
+        self.keys = frozenset()
+        self.simple = True
+        keys = set()
+        for (literal, field, spec, conversion) in \
+                string.Formatter().parse(template):
+            if literal:
+                self.pieces.append((True, literal))
+            if field is None:
+                continue
+            if field:
+                keys.add(field)
+            if not field.isidentifier() or spec or conversion:
+                self.simple = False
+            self.pieces.append((False, field))
+        self.keys = frozenset(keys)
+
+    def format(self, values: dict) -> str:
+        """ template.format(**values) """
+        if not self.simple:
+            return self.template.format(**values)
+        return "".join([piece if isLiteral else format(values[piece])
+                        for (isLiteral, piece) in self.pieces])
+
+
+@functools.lru_cache(maxsize=4096)
+def compileTemplate(template: str) -> CompiledTemplate:
+    return CompiledTemplate(template)
+
+
+# the date keys by unit: the key suffix, how far dates of the unit may
+# be truncated without changing their formatting and that formatting
+DATE_UNITS = [
+    ("yyyy", "years", dict(month=1, day=1, hour=0),
+     lambda d: f"{d.year:04d}"),
+    ("yyyymm", "months", dict(day=1, hour=0),
+     lambda d: f"{d.year:04d}{d.month:02d}"),
+    ("yyyymmdd", "days", dict(hour=0),
+     lambda d: f"{d.year:04d}{d.month:02d}{d.day:02d}"),
+    ("yyyymmddhh", "hours", dict(),
+     lambda d: f"{d.year:04d}{d.month:02d}{d.day:02d}{d.hour:02d}"),
+]
 
 
 def handleDateField(dt: datetime, val, key) -> str:
@@ -95,43 +185,44 @@ def handleDateField(dt: datetime, val, key) -> str:
     if not isinstance(dt, datetime):
         raise Exception("dt must be an instance of datetime")
 
-    if key.endswith("yyyy"):
-        func = relativedelta
-        param = "years"
-        format = "%Y"
-    elif key.endswith("yyyymm"):
-        func = relativedelta
-        param = "months"
-        format = "%Y%m"
-    elif key.endswith("yyyymmdd"):
-        func = timedelta
-        param = "days"
-        format = "%Y%m%d"
-    elif key.endswith("yyyymmddhh"):
-        func = timedelta
-        param = "hours"
-        format = "%Y%m%d%H"
+    for (suffix, unit, truncation, format) in DATE_UNITS:
+        if key.endswith(suffix):
+            break
     else:
         return None
 
-    toFormat = []
     if isinstance(val, int):
-        params = {param: val}
-        newdate = dt + func(**params)
-        toFormat.append(newdate)
+        (lo, hi) = (val, val)
     elif isinstance(val, list) and len(val) == 2:
-        val = sorted([int(x) for x in val])
-        for v in range(int(val[0]), int(val[1]) + 1):
-            params = {param: v}
-            newdate = dt + func(**params)
-            toFormat.append(newdate)
+        (lo, hi) = sorted([int(x) for x in val])
     elif isinstance(val, str):
         return [val]
     else:
         raise Exception("Invalid datetime values to fill out.  Must "
                         "be int, 2 element array of ints, or string")
 
-    return sorted([dt.strftime(format) for dt in toFormat])
+    start = dt.replace(minute=0, second=0, microsecond=0, **truncation)
+    return list(dateRange(start, unit, lo, hi))
+
+
+@functools.lru_cache(maxsize=1024)
+def dateRange(start: datetime, unit: str, lo: int, hi: int) -> tuple:
+    """ start + lo .. start + hi units, formatted for the unit and
+    sorted.  start is truncated to the unit so all templates of a run,
+    and all date keys of the same unit, share one range.
+    """
+    format = [f for (_, u, _, f) in DATE_UNITS if u == unit][0]
+    if unit in ["days", "hours"]:
+        step = timedelta(**{unit: 1})
+        d = start + timedelta(**{unit: lo})
+        formatted = []
+        for _ in range(hi - lo + 1):
+            formatted.append(format(d))
+            d += step
+    else:
+        formatted = [format(start + relativedelta(**{unit: v}))
+                     for v in range(lo, hi + 1)]
+    return tuple(sorted(formatted))
 
 
 def explodeTemplate(templateVars: dict):
@@ -139,43 +230,44 @@ def explodeTemplate(templateVars: dict):
     Goal of this method is simply to replace
     any array elements with simple string expansions
 
-    :return:
+    :return: the list iterExplodeTemplate yields
     """
+    return list(iterExplodeTemplate(templateVars))
+
+
+def iterExplodeTemplate(templateVars: dict, now: datetime = None):
+    """
+    Yields the expansions of templateVars one at a time, in the order
+    explodeTemplate lists them, rather than building them all first.
+    Each list value is one factor of an itertools.product.  Combinations
+    which still hold lists, i.e. from map of maps, are exploded in turn.
+
+    :param now: date fields are relative to it, the same for all
+    expansions
+    """
+    if now is None:
+        now = datetime.now()
 
     # check for key with yyyymm, yyyymmdd, or yyyymmddhh
     # and handle it specially
     for (k, v) in templateVars.items():
-        date_vals = handleDateField(datetime.now(), v, k)
+        date_vals = handleDateField(now, v, k)
         if date_vals is not None:
             templateVars[k] = date_vals
 
     topremute = []
     for (k, v) in templateVars.items():
-        items = []
         if isinstance(v, list):
-            for vv in v:
-                items.append((k, vv))
-        else:
-            items.append((k, v))
-        topremute.append(items)
-
-    collect = []
-    out = []
-    makeCombinations(topremute, out, collect)
-    # now make maps
-    maps = []
-    for s in collect:
-        maps.append(handle_map_of_maps(dict(s)))
-
-    final = []
-    for m in maps:
-        types = set([type(x) for x in m.values()])
-        if list in types:
-            final += explodeTemplate(m)
+            topremute.append([(k, vv) for vv in v])
         else:
-            final.append(m)
+            topremute.append([(k, v)])
 
-    return final
+    for combination in itertools.product(*topremute):
+        m = handle_map_of_maps(dict(combination))
+        if any(type(x) is list for x in m.values()):
+            yield from iterExplodeTemplate(m, now)
+        else:
+            yield m
 
 
 def handle_map_of_maps(m):